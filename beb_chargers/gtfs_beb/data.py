@@ -2,16 +2,40 @@ import pandas as pd
 import googlemaps
 import pickle
 import logging
+import os
 import time
+import zipfile
 import numpy as np
 from pathlib import Path
 from collections.abc import Iterable
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from datetime import datetime, timedelta
-from openrouteservice import client
 from dotenv import dotenv_values, find_dotenv
+from beb_chargers.gtfs_beb.snapshot import cached_hash_files, \
+    hash_zip_members, load_tables, save_tables
+from beb_chargers.gtfs_beb.deadhead import open_deadhead_store, \
+    plan_requests, BatchFetcher, DeadheadMatrix, DeadheadProvider, \
+    DeadheadStats, DEFAULT_STATS, ORSProvider, RoadGraphProvider, \
+    StraightLineProvider
+from beb_chargers.gtfs_beb.geo import haversine_np, manhattan_np, \
+    LocationRegistry
 
 logger = logging.getLogger('gtfs_data')
 
+# Day-of-week columns of calendar.txt, ordered to match
+# datetime.weekday() (Monday is 0)
+DOW_COLS = [
+    'monday', 'tuesday', 'wednesday', 'thursday', 'friday', 'saturday',
+    'sunday'
+]
+# GTFS ID columns that can be interned as int32 codes
+ID_COLS = ['trip_id', 'block_id', 'shape_id', 'route_id']
+# Columns of the shapes summary that are added to each trip
+SHAPE_SUMMARY_COLS = [
+    'start_lat', 'start_lon', 'end_lat', 'end_lon', 'total_dist'
+]
+
 
 class GTFSError(Exception):
     pass
@@ -20,10 +44,16 @@ class GTFSError(Exception):
 class GTFSData:
     """
     Class for reading and processing GTFS data.
+
+    When a newer version of a feed is loaded with prior=<GTFSData for
+    the previous version>, only shape summaries are reused. Trip
+    summaries are always rebuilt, and deadhead is reused through the
+    deadhead store, which is keyed by coordinates.
     """
     def __init__(
             self, calendar_file, calendar_dates_file, trips_file, shapes_file,
-            routes_file, stop_times_file):
+            routes_file, stop_times_file, lazy_stop_times=False,
+            table_workers=1, prior=None):
         """
         Constructor for GTFSData class.
 
@@ -37,21 +67,86 @@ class GTFSData:
         :param shapes_file:
         :param routes_file:
         :param stop_times_file:
+        :param lazy_stop_times: if True, don't read stop_times.txt up
+            front. Instead, stop times are streamed from the file in
+            chunks when they are first needed, keeping only the first
+            and last stop of the requested trips. Use this for large
+            feeds when only a few dates or routes are analyzed. In this
+            case, stop_times_df is None and trip_times_df only covers
+            trips that have been loaded.
+        :param table_workers: number of threads used to parse the large
+            tables (trips.txt, shapes.txt, and stop_times.txt)
+            concurrently. The CSV parser releases the GIL, so this
+            speeds up loading large feeds.
+        :param prior: GTFSData object for a previous version of this
+            feed. Summaries of shapes that haven't changed are copied
+            from it rather than recomputed. See :py:meth:`_reuse_prior`.
         """
+        with ThreadPoolExecutor(max_workers=max(table_workers, 1)) as pool:
+            trips_future = pool.submit(
+                self._load_table,
+                filename=trips_file,
+                required_cols=[
+                    'trip_id', 'route_id', 'service_id', 'block_id',
+                    'shape_id'
+                ],
+                dtype={
+                    'trip_id': str,
+                    'route_id': str,
+                    'service_id': str,
+                    'block_id': str,
+                    'shape_id': str
+                }
+            )
+            shapes_future = pool.submit(
+                self._load_table,
+                shapes_file,
+                required_cols=[
+                    'shape_id', 'shape_pt_lat', 'shape_pt_lon',
+                    'shape_pt_sequence'
+                ],
+                dtype={
+                    'shape_id': str
+                }
+            )
+            if lazy_stop_times:
+                stop_times_future = None
+            else:
+                stop_times_future = pool.submit(
+                    self._load_table,
+                    stop_times_file,
+                    required_cols=['trip_id', 'arrival_time'],
+                    dtype={'trip_id': str}
+                )
 
-        self.trips_df = self._load_table(
-            filename=trips_file,
-            required_cols=[
-                'trip_id', 'route_id', 'service_id', 'block_id', 'shape_id'
-            ],
-            dtype={
-                'trip_id': str,
-                'route_id': str,
-                'service_id': str,
-                'block_id': str,
-                'shape_id': str
-            }
-        )
+            # Read the small tables while the large ones are parsed
+            self._load_calendar_tables(
+                calendar_file, calendar_dates_file, routes_file)
+
+            self.trips_df = trips_future.result()
+            self._filter_by_trip_type()
+            self.shapes_df = shapes_future.result()
+            # IDs repeat on every row of the long tables, so they're
+            # kept as categoricals (which snapshots load without copying)
+            self.shapes_df['shape_id'] = \
+                self.shapes_df['shape_id'].astype('category')
+            if stop_times_future is None:
+                self.stop_times_df = None
+            else:
+                self.stop_times_df = self._parse_stop_times(
+                    stop_times_future.result())
+
+        self._init_from_tables(stop_times_file, prior=prior)
+
+    def _load_calendar_tables(
+            self, calendar_file, calendar_dates_file, routes_file):
+        """
+        Read routes.txt, calendar.txt, and calendar_dates.txt.
+
+        :param calendar_file:
+        :param calendar_dates_file:
+        :param routes_file:
+        """
         self.routes_df = self._load_table(
             filename=routes_file,
             required_cols=['route_id', 'route_short_name', 'route_type'],
@@ -63,7 +158,6 @@ class GTFSData:
             }
         )
         self.routes_df.set_index('route_id', inplace=True)
-        self._filter_by_trip_type()
 
         # At least one of calendar.txt and calendar_dates.txt is
         # required, but it's okay to have just one of them.
@@ -107,39 +201,326 @@ class GTFSData:
                 'be provided.'
             )
 
-        self.shapes_df = self._load_table(
-            shapes_file,
-            required_cols=[
-                'shape_id', 'shape_pt_lat', 'shape_pt_lon', 'shape_pt_sequence'
-            ],
-            dtype={
-                'shape_id': str
+    def _init_from_tables(self, stop_times_file=None, prior=None):
+        """
+        Finish setting up this object once all GTFS tables have been
+        assigned, whether they were parsed from CSV or restored from a
+        snapshot.
+
+        :param stop_times_file: source of stop_times.txt, used to
+            stream stop times on demand if stop_times_df was not loaded
+        :param prior: GTFSData object for a previous version of this
+            feed to reuse summaries from, optional
+        """
+        self.shapes_summary_df = getattr(self, 'shapes_summary_df', None)
+        self._shape_fingerprints = None
+        self._build_service_calendar()
+        self._stop_times_file = stop_times_file
+        # Trips whose stop times have been streamed so far (lazy mode)
+        self._stop_time_trips = set()
+        self.lazy_stop_times = self.stop_times_df is None
+        # First and last stop time of each trip (in seconds since
+        # midnight), which is all we need from stop_times.txt
+        if getattr(self, 'trip_times_df', None) is None:
+            if self.lazy_stop_times:
+                self.trip_times_df = get_trip_time_bounds(
+                    pd.Series(dtype=object), pd.Series(dtype=np.int32))
+            else:
+                self.trip_times_df = get_trip_time_bounds(
+                    self.stop_times_df['trip_id'],
+                    self.stop_times_df['arrival_sec'])
+        if prior is not None:
+            self._reuse_prior(prior)
+        if getattr(self, 'trip_summary_df', None) is None:
+            self._build_trip_summary()
+        # Position of each trip's service_id in service_id_index, so
+        # the trips on a date are found by indexing the service mask
+        self._trip_summary_sids = self.service_id_index.get_indexer(
+            self.trip_summary_df['service_id'])
+        # Dense code for every trip, block, shape, and route ID
+        self.id_index = {
+            c: pd.Index(pd.unique(self.trips_df[c].dropna()), name=c)
+            for c in ID_COLS
+        }
+
+    def _snapshot_tables(self):
+        """
+        Get the parsed tables that are saved in a columnar snapshot.
+        With lazy stop times, stop_times_df and trip_times_df are left
+        out since they only hold whatever has been streamed so far.
+
+        :return: dict of DataFrames keyed by attribute name
+        """
+        return {
+            'trips_df': self.trips_df,
+            'routes_df': self.routes_df,
+            'calendar_df': self.calendar_df,
+            'calendar_dates_df': self.calendar_dates_df,
+            'shapes_df': self.shapes_df,
+            'stop_times_df':
+                None if self.lazy_stop_times else self.stop_times_df,
+            'trip_times_df':
+                None if self.lazy_stop_times else self.trip_times_df,
+            'shapes_summary_df': self.shapes_summary_df,
+            'trip_summary_df': self.trip_summary_df
+        }
+
+    @classmethod
+    def from_tables(cls, tables, stop_times_file=None):
+        """
+        Create a GTFSData object from already-parsed tables, e.g. those
+        restored from a snapshot.
+
+        :param tables: dict of DataFrames keyed by attribute name, as
+            returned by :py:meth:`_snapshot_tables`
+        :param stop_times_file: source of stop_times.txt, required if
+            tables['stop_times_df'] is None (lazy loading)
+        :return: GTFSData object
+        """
+        obj = cls.__new__(cls)
+        for name, df in tables.items():
+            setattr(obj, name, df)
+        obj._init_from_tables(stop_times_file)
+        return obj
+
+    @staticmethod
+    def _feed_files(dir_name):
+        """
+        Get the paths of all GTFS files we read from a feed directory.
+
+        :param dir_name: directory containing GTFS .txt files
+        :return: dict of file paths keyed by constructor argument name
+        """
+        return {
+            'calendar_file': '{}/calendar.txt'.format(dir_name),
+            'calendar_dates_file': '{}/calendar_dates.txt'.format(dir_name),
+            'trips_file': '{}/trips.txt'.format(dir_name),
+            'shapes_file': '{}/shapes.txt'.format(dir_name),
+            'routes_file': '{}/routes.txt'.format(dir_name),
+            'stop_times_file': '{}/stop_times.txt'.format(dir_name)
+        }
+
+    @classmethod
+    def _snapshot_path(
+            cls, dir_name, snapshot_dir=None, lazy_stop_times=False):
+        """
+        Get the path of the snapshot of a feed directory, which is keyed
+        by a content hash of its files. The hash is cached in the
+        snapshot directory along with the size and modification time of
+        each file, so files are only read again once they change.
+
+        :param dir_name: directory containing GTFS .txt files
+        :param snapshot_dir: directory where snapshots are stored.
+            Defaults to a .snapshot folder inside dir_name.
+        :param lazy_stop_times: True for the snapshot used with lazy
+            stop times
+        :return: Path of snapshot directory
+        """
+        files = cls._feed_files(dir_name)
+        if snapshot_dir is None:
+            snapshot_dir = Path(dir_name) / '.snapshot'
+        if lazy_stop_times:
+            # stop_times.txt isn't part of a lazy snapshot, so there's
+            # no need to hash it (it's usually the largest file).
+            hashed_files = [
+                f for k, f in files.items() if k != 'stop_times_file']
+            snapshot_key = 'lazy-' + cached_hash_files(
+                hashed_files, Path(snapshot_dir) / 'file_hashes.json')
+        else:
+            snapshot_key = cached_hash_files(
+                files.values(), Path(snapshot_dir) / 'file_hashes.json')
+        return Path(snapshot_dir) / snapshot_key
+
+    @classmethod
+    def from_dir(
+            cls, dir_name: str | Path, use_snapshot: bool = True,
+            snapshot_dir: str | Path = None, lazy_stop_times: bool = False,
+            table_workers: int = 1, prior=None):
+        """
+        Load GTFS data from a directory of .txt files.
+
+        Parsing the CSV files is slow for large feeds, so by default the
+        parsed tables are saved as a columnar snapshot keyed by a
+        content hash of the source files. Later loads of the same feed
+        memory-map the snapshot instead of parsing the CSVs again, and
+        any change to the source files produces a new key.
+
+        :param dir_name: directory containing GTFS .txt files
+        :param use_snapshot: True to read and write snapshots
+        :param snapshot_dir: directory where snapshots are stored.
+            Defaults to a .snapshot folder inside dir_name.
+        :param lazy_stop_times: True to stream stop_times.txt on demand
+            rather than loading it up front (see :py:meth:`__init__`)
+        :param table_workers: number of threads used to parse tables
+            if there is no snapshot (see :py:meth:`__init__`)
+        :param prior: GTFSData object for a previous version of this
+            feed to reuse unchanged summaries from if there is no
+            snapshot (see :py:meth:`__init__`)
+        :return: GTFSData object
+        """
+        files = cls._feed_files(dir_name)
+        if not use_snapshot:
+            return cls(
+                **files, lazy_stop_times=lazy_stop_times,
+                table_workers=table_workers, prior=prior)
+
+        snapshot_path = cls._snapshot_path(
+            dir_name, snapshot_dir, lazy_stop_times)
+        tables = load_tables(snapshot_path)
+        if tables is not None:
+            logger.info('Loaded GTFS snapshot {}'.format(snapshot_path))
+            return cls.from_tables(
+                tables, stop_times_file=files['stop_times_file'])
+
+        obj = cls(
+            **files, lazy_stop_times=lazy_stop_times,
+            table_workers=table_workers, prior=prior)
+        obj._save_snapshot(snapshot_path)
+        return obj
+
+    def _save_snapshot(self, snapshot_path):
+        """
+        Save a snapshot of the parsed tables, if possible.
+
+        :param snapshot_path: directory to write the snapshot to
+        :return: True if the snapshot was saved
+        """
+        try:
+            save_tables(snapshot_path, self._snapshot_tables())
+        except OSError as e:
+            # A read-only data directory shouldn't prevent loading
+            logger.warning('Could not save GTFS snapshot: {}'.format(e))
+            return False
+        return True
+
+    @classmethod
+    def from_zip(
+            cls, path: str | Path, use_snapshot: bool = True,
+            snapshot_dir: str | Path = None, lazy_stop_times: bool = False,
+            table_workers: int = 1, prior=None):
+        """
+        Load GTFS data directly from a zipped feed, without extracting
+        it. Each table is streamed from the archive into the CSV
+        parser, and with lazy_stop_times=True, stop_times.txt is
+        streamed and filtered from the archive whenever stop times are
+        needed. The .txt files may be at the top level of the archive
+        or inside a single folder.
+
+        Snapshots work as in :py:meth:`from_dir`. They are keyed by the
+        CRC and size of each member recorded in the archive, so the
+        archive doesn't even need to be read to find a snapshot.
+
+        :param path: path to .zip file
+        :param use_snapshot: True to read and write snapshots
+        :param snapshot_dir: directory where snapshots are stored.
+            Defaults to a .snapshot folder next to the archive.
+        :param lazy_stop_times: True to stream stop_times.txt on demand
+            rather than loading it up front (see :py:meth:`__init__`)
+        :param table_workers: number of threads used to parse tables
+            if there is no snapshot (see :py:meth:`__init__`)
+        :param prior: GTFSData object for a previous version of this
+            feed to reuse unchanged summaries from if there is no
+            snapshot (see :py:meth:`__init__`)
+        :return: GTFSData object
+        """
+        path = Path(path)
+        with zipfile.ZipFile(path) as zf:
+            members = {
+                Path(i.filename).name: i.filename for i in zf.infolist()
+                if not i.is_dir()
             }
-        )
-        self.stop_times_df = self._load_table(
-            stop_times_file,
-            required_cols=['trip_id', 'arrival_time'],
-            dtype={'trip_id': str}
-        )
-        self.shapes_summary_df = None
+
+        files = dict()
+        for k, fname in cls._feed_files('.').items():
+            name = Path(fname).name
+            files[k] = ZipMember(path, members.get(name, name))
+        if not use_snapshot:
+            return cls(
+                **files, lazy_stop_times=lazy_stop_times,
+                table_workers=table_workers, prior=prior)
+
+        hashed_members = [
+            m.name for k, m in files.items()
+            if not (lazy_stop_times and k == 'stop_times_file')
+        ]
+        snapshot_key = '{}{}-{}'.format(
+            'lazy-' if lazy_stop_times else '', path.stem,
+            hash_zip_members(path, hashed_members))
+        if snapshot_dir is None:
+            snapshot_dir = path.parent / '.snapshot'
+        snapshot_path = Path(snapshot_dir) / snapshot_key
+
+        tables = load_tables(snapshot_path)
+        if tables is not None:
+            logger.info('Loaded GTFS snapshot {}'.format(snapshot_path))
+            return cls.from_tables(
+                tables, stop_times_file=files['stop_times_file'])
+
+        obj = cls(
+            **files, lazy_stop_times=lazy_stop_times,
+            table_workers=table_workers, prior=prior)
+        obj._save_snapshot(snapshot_path)
+        return obj
 
     @classmethod
-    def from_dir(cls, dir_name: str | Path):
-        trips_file = '{}/trips.txt'.format(dir_name)
-        calendar_file = '{}/calendar.txt'.format(dir_name)
-        calendar_dates_file = '{}/calendar_dates.txt'.format(dir_name)
-        shapes_file = '{}/shapes.txt'.format(dir_name)
-        routes_file = '{}/routes.txt'.format(dir_name)
-        stop_times_file = '{}/stop_times.txt'.format(dir_name)
-
-        return cls(
-            calendar_file=calendar_file,
-            calendar_dates_file=calendar_dates_file,
-            trips_file=trips_file,
-            shapes_file=shapes_file,
-            routes_file=routes_file,
-            stop_times_file=stop_times_file
-        )
+    def load_many(
+            cls, dirs, workers: int = None, table_workers: int = 1,
+            use_snapshot: bool = True, snapshot_dir: str | Path = None,
+            lazy_stop_times: bool = False):
+        """
+        Load several GTFS feeds in parallel, e.g. to compare agencies.
+
+        Each feed is loaded with :py:meth:`from_dir` in its own process.
+        With snapshots enabled, worker processes only write the
+        snapshot of each feed and the feeds are then memory-mapped in
+        this process, so the parsed tables never have to be pickled
+        between processes.
+
+        :param dirs: list of directories containing GTFS .txt files
+        :param workers: number of worker processes. Defaults to the
+            number of CPUs, capped at the number of feeds.
+        :param table_workers: number of threads each worker uses to
+            parse the tables of one feed
+        :param use_snapshot: True to read and write snapshots
+        :param snapshot_dir: directory where snapshots are stored.
+            Defaults to a .snapshot folder inside each feed directory.
+        :param lazy_stop_times: True to stream stop_times.txt on demand
+            rather than loading it up front (see :py:meth:`__init__`)
+        :return: list of GTFSData objects, in the same order as dirs
+        """
+        dirs = list(dirs)
+        if workers is None:
+            workers = os.cpu_count() or 1
+        workers = min(workers, len(dirs))
+        load_kwargs = dict(
+            use_snapshot=use_snapshot, snapshot_dir=snapshot_dir,
+            lazy_stop_times=lazy_stop_times, table_workers=table_workers)
+        if workers <= 1:
+            return [cls.from_dir(d, **load_kwargs) for d in dirs]
+
+        load_start = time.time()
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            results = list(pool.map(
+                _load_feed, [cls] * len(dirs), dirs,
+                [load_kwargs] * len(dirs)))
+
+        feeds = list()
+        for dir_name, result in zip(dirs, results):
+            if isinstance(result, Path):
+                tables = load_tables(result)
+                if tables is not None:
+                    result = cls.from_tables(
+                        tables,
+                        stop_times_file=cls._feed_files(
+                            dir_name)['stop_times_file'])
+                else:
+                    # Snapshot was removed in the meantime
+                    result = cls.from_dir(dir_name, **load_kwargs)
+            feeds.append(result)
+
+        logger.info('Loaded {} GTFS feeds in {:.2f} seconds'.format(
+            len(dirs), time.time() - load_start))
+        return feeds
 
     @staticmethod
     def from_pickle(fname):
@@ -170,7 +551,8 @@ class GTFSData:
         :param dtype: dict giving column data types, optional
         :return: DataFrame of loaded data, or raise an appropriate error
         """
-        df = pd.read_csv(filename, index_col=index_col, dtype=dtype)
+        with open_gtfs_file(filename) as f:
+            df = pd.read_csv(f, index_col=index_col, dtype=dtype)
         if all(c in df.columns for c in required_cols):
             if optional_cols is not None:
                 if not isinstance(optional_cols, list):
@@ -196,6 +578,24 @@ class GTFSData:
                     filename, missing_cols))
 
 
+    @staticmethod
+    def _parse_stop_times(st_df):
+        """
+        Convert arrival times in a stop_times.txt table from strings to
+        int32 seconds since midnight. Stops without an arrival time
+        (allowed by GTFS for stops that aren't timepoints) are dropped.
+
+        :param st_df: DataFrame with columns trip_id and arrival_time
+        :return: DataFrame with columns trip_id (categorical) and
+            arrival_sec
+        """
+        arrival_sec = time_str_to_seconds(st_df['arrival_time'])
+        has_time = arrival_sec.notna()
+        return pd.DataFrame({
+            'trip_id': st_df['trip_id'][has_time].astype('category'),
+            'arrival_sec': arrival_sec[has_time].astype(np.int32)
+        })
+
     @staticmethod
     def filter_df(df, col, value):
         """
@@ -236,37 +636,47 @@ class GTFSData:
         self.trips_df = self.trips_df[
             ~self.trips_df['route_id'].isin(bad_rts)]
 
-    def calculate_shape_dists(self):
+    def encode_ids(self, df, cols=None):
+        """
+        Replace GTFS ID columns of a DataFrame with dense int32 codes.
+
+        Optimization and simulation inputs built from the encoded
+        DataFrame are keyed by integers rather than strings, which
+        saves memory and speeds up lookups on large instances. Results
+        are converted back with :py:meth:`decode_ids` or by passing
+        self.id_index to the model.
+
+        :param df: DataFrame with ID columns or index levels
+        :param cols: ID columns to encode, defaults to all of ID_COLS
+            that are present
+        :return: DataFrame with encoded IDs
+        """
+        return encode_id_columns(df, self.id_index, cols)
+
+    def decode_ids(self, df, cols=None):
+        """
+        Convert int32 ID codes created by :py:meth:`encode_ids` back to
+        the original GTFS IDs.
+
+        :param df: DataFrame with encoded ID columns or index levels
+        :param cols: ID columns to decode, defaults to all of ID_COLS
+            that are present
+        :return: DataFrame with original IDs
+        """
+        return decode_id_columns(df, self.id_index, cols)
+
+    def calculate_shape_dists(self, shape_ids=None):
         """
         Use the shape points provided in shape_df to calculate the
-        total length of all shapes included in the table.
-        """
-        gb = self.shapes_df.groupby('shape_id')
-        shapes_list = list()
-        dists_list = list()
-        for shape_id, shape_grp in gb:
-            shape_grp = shape_grp.sort_values(
-                by='shape_pt_sequence').reset_index()
-            # Add columns that give coordinates of last point
-            shape_grp[['prev_lat', 'prev_lon']] = shape_grp[
-                ['shape_pt_lat', 'shape_pt_lon']].shift(1)
-            # First point in the shape doesn't have a predecessor. Just
-            # set it to itself so the distance is zero.
-            shape_grp.loc[0, 'prev_lat'] = shape_grp.loc[0, 'shape_pt_lat']
-            shape_grp.loc[0, 'prev_lon'] = shape_grp.loc[0, 'shape_pt_lon']
-            # Calculate distance between points
-            shape_grp['seq_dist'] = haversine_np(
-                shape_grp['shape_pt_lon'], shape_grp['shape_pt_lat'],
-                shape_grp['prev_lon'], shape_grp['prev_lat'])
-            # Add total distance to list
-            shapes_list.append(shape_id)
-            dists_list.append(shape_grp['seq_dist'].sum())
-
-        # Build dataframe of results
-        manual_dists = pd.DataFrame(
-            {'shape_id': shapes_list, 'manual_dist': dists_list}
-        ).set_index('shape_id')
-        return manual_dists
+        total length of shapes included in the table.
+
+        :param shape_ids: list of shape_id values to calculate. If None,
+            all shapes in the table are included.
+        :return: DataFrame indexed by shape_id with column manual_dist
+        """
+        shape_dists = summarize_shape_points(self.shapes_df, shape_ids)
+        return shape_dists[['total_dist']].rename(
+            columns={'total_dist': 'manual_dist'})
 
     def summarize_shapes(self, shape_ids):
         """
@@ -282,35 +692,15 @@ class GTFSData:
             summarized. saves computation time if we don't need to
             process all shape_ids in the table.
         """
-        if self.shapes_summary_df is None:
-            shapes_to_add = shape_ids
-        else:
-            shapes_to_add = [
-                s for s in shape_ids
-                if s not in self.shapes_summary_df.index.unique()
-            ]
+        shapes_to_add = pd.Index(shape_ids).unique()
+        if self.shapes_summary_df is not None:
+            shapes_to_add = shapes_to_add.difference(
+                self.shapes_summary_df.index)
 
-        if not shapes_to_add:
+        if shapes_to_add.empty:
             return
 
-        # Filter down to just the shapes we need to add
-        shapes_df = self.shapes_df[self.shapes_df['shape_id'].isin(
-            shapes_to_add)]
-        shapes_multi = shapes_df.set_index(
-            ['shape_id', 'shape_pt_sequence'])
-
-        shapes_summary = pd.DataFrame()
-        shapes_summary[['start_lat', 'start_lon']] = shapes_multi.groupby(
-            'shape_id').apply(lambda x: x.sort_index().iloc[0])[
-            ['shape_pt_lat', 'shape_pt_lon']]
-        shapes_summary[['end_lat', 'end_lon']] = \
-            shapes_multi.groupby('shape_id').apply(
-                lambda x: x.sort_index().iloc[-1])[
-                ['shape_pt_lat', 'shape_pt_lon']]
-        # Calculate distances of all shapes (in miles)
-        shape_dists_df = self.calculate_shape_dists()
-        # Add these to the summary DF
-        shapes_summary['total_dist'] = shape_dists_df
+        shapes_summary = summarize_shape_points(self.shapes_df, shapes_to_add)
         # Update the summary df
         if self.shapes_summary_df is None:
             self.shapes_summary_df = shapes_summary
@@ -319,67 +709,285 @@ class GTFSData:
                 [self.shapes_summary_df, shapes_summary]
             )
 
+    def get_shape_fingerprints(self):
+        """
+        Get a fingerprint of every shape, which changes whenever any of
+        its points change.
+
+        :return: uint64 Series indexed by shape_id
+        """
+        if getattr(self, '_shape_fingerprints', None) is None:
+            self._shape_fingerprints = get_group_fingerprints(
+                self.shapes_df['shape_id'],
+                self.shapes_df[[
+                    'shape_pt_lat', 'shape_pt_lon', 'shape_pt_sequence']]
+            )
+        return self._shape_fingerprints
+
+    def _reuse_prior(self, prior):
+        """
+        Copy the shapes_summary_df rows of shapes whose points haven't
+        changed from a previous version of this feed. Other shapes are
+        summarized as usual when they're needed.
+
+        :param prior: GTFSData object for the previous feed version
+        """
+        if prior.shapes_summary_df is None:
+            return
+        same_shapes = _same_fingerprints(
+            self.get_shape_fingerprints(), prior.get_shape_fingerprints())
+        same_shapes = same_shapes.intersection(prior.shapes_summary_df.index)
+        self.shapes_summary_df = prior.shapes_summary_df.loc[
+            same_shapes].copy()
+        logger.info(
+            'Reused summaries of {} shapes from prior feed version'.format(
+                len(same_shapes)))
+
+    def _build_service_calendar(self):
+        """
+        Build a dense boolean matrix of which service_id values are in
+        service on each date covered by calendar.txt and
+        calendar_dates.txt.
+
+        Rows of self.service_matrix correspond to the consecutive dates
+        in self.service_dates and columns to self.service_id_index.
+        Weekly patterns from calendar.txt are applied first, then
+        additions and removals from calendar_dates.txt, so looking up
+        the service on any date only requires indexing one row. If the
+        feed has neither file, the matrix is empty and no service runs
+        on any date.
+        """
+        sid_lists = list()
+        date_lists = list()
+        if self.calendar_df is not None:
+            sid_lists.append(self.calendar_df['service_id'])
+            date_lists += [
+                self.calendar_df['start_date'], self.calendar_df['end_date']]
+        if self.calendar_dates_df is not None:
+            sid_lists.append(self.calendar_dates_df['service_id'])
+            date_lists.append(self.calendar_dates_df['date'])
+
+        if not sid_lists:
+            self.service_id_index = pd.Index([], dtype=object, name='service_id')
+            self.service_dates = pd.DatetimeIndex([], name='date')
+            self.service_matrix = np.zeros((0, 0), dtype=bool)
+            return
+
+        self.service_id_index = pd.Index(
+            pd.unique(pd.concat(sid_lists, ignore_index=True).to_numpy()),
+            name='service_id'
+        )
+        all_dates = pd.concat(date_lists, ignore_index=True).dropna()
+        if all_dates.empty:
+            self.service_dates = pd.DatetimeIndex([], name='date')
+        else:
+            self.service_dates = pd.date_range(
+                all_dates.min(), all_dates.max(), freq='D', name='date')
+        self.service_matrix = np.zeros(
+            (len(self.service_dates), len(self.service_id_index)), dtype=bool)
+
+        if self.calendar_df is not None and not self.calendar_df.empty:
+            cal_df = self.calendar_df
+            dates = self.service_dates.to_numpy()[:, np.newaxis]
+            # (n_dates x n_calendar_rows) matrices
+            in_range = (dates >= cal_df['start_date'].to_numpy()) & (
+                dates <= cal_df['end_date'].to_numpy())
+            dow_flags = cal_df[DOW_COLS].to_numpy() == 1
+            on_dow = dow_flags[:, self.service_dates.dayofweek].T
+            sid_codes = self.service_id_index.get_indexer(cal_df['service_id'])
+            # OR rather than assign, in case a service_id is repeated
+            np.logical_or.at(
+                self.service_matrix, (slice(None), sid_codes),
+                in_range & on_dow)
+
+        if self.calendar_dates_df is not None \
+                and not self.calendar_dates_df.empty:
+            cd_df = self.calendar_dates_df
+            date_ix = (cd_df['date'] - self.service_dates[0]).dt.days.to_numpy()
+            sid_codes = self.service_id_index.get_indexer(cd_df['service_id'])
+            added = (cd_df['exception_type'] == 1).to_numpy()
+            removed = (cd_df['exception_type'] == 2).to_numpy()
+            self.service_matrix[date_ix[added], sid_codes[added]] = True
+            self.service_matrix[date_ix[removed], sid_codes[removed]] = False
+
+    def get_service_mask(self, input_date):
+        """
+        Get a boolean array indicating which service_id values in
+        self.service_id_index are in service on the given date.
+
+        :param input_date: datetime.datetime object giving specific date
+        :return: boolean numpy array with one entry per service_id
+        """
+        if len(self.service_dates) == 0:
+            return np.zeros(len(self.service_id_index), dtype=bool)
+        date_ix = (pd.Timestamp(input_date).normalize()
+                   - self.service_dates[0]).days
+        if 0 <= date_ix < len(self.service_dates):
+            return self.service_matrix[date_ix]
+        else:
+            # No service outside the dates covered by the feed
+            return np.zeros(len(self.service_id_index), dtype=bool)
+
     def get_service_ids(self, input_date):
         """
         Get service IDs corresponding to the given input date.
 
         :param input_date: datetime.datetime object giving specific date
-        :return: list of service_ids in service on the given date
+        :return: set of service_ids in service on the given date
         """
-        if self.calendar_df is None:
-            ids_cal = list()
-        else:
-            after_start = input_date >= self.calendar_df['start_date']
-            before_end = input_date <= self.calendar_df['end_date']
-            calendar_filt = self.calendar_df[(after_start & before_end)]
-
-            dow = input_date.weekday()
-            dow_dict = {
-                0: 'monday',
-                1: 'tuesday',
-                2: 'wednesday',
-                3: 'thursday',
-                4: 'friday',
-                5: 'saturday',
-                6: 'sunday'
-            }
-            dow_col = dow_dict[dow]
-            calendar_filt = calendar_filt[calendar_filt[dow_col] == 1]
+        return set(self.service_id_index[self.get_service_mask(input_date)])
 
-            ids_cal = calendar_filt['service_id'].tolist()
+    def get_trip_ids(self, input_date=None, routes=None):
+        """
+        Get the IDs of all trips operating on the given date and/or
+        routes, using only trips.txt, routes.txt, and the calendar.
+
+        :param input_date: datetime.datetime giving date of operation.
+            If None, trips on all dates are included.
+        :param routes: iterable of route_id or route_short_name values.
+            If None, trips on all routes are included.
+        :return: set of trip_id values
+        """
+        trips = self.trips_df
+        if input_date is not None:
+            trips = self.filter_df(
+                trips, 'service_id', self.get_service_ids(input_date))
+        if routes is not None:
+            routes = set(str(r) for r in routes)
+            rt_match = self.routes_df.index.isin(routes) \
+                | self.routes_df['route_short_name'].isin(routes)
+            trips = self.filter_df(
+                trips, 'route_id', self.routes_df.index[rt_match])
+        return set(trips['trip_id'])
+
+    def load_stop_times(
+            self, trip_ids=None, input_date=None, routes=None,
+            chunksize=1_000_000):
+        """
+        Stream stop_times.txt and keep only the stop times of the given
+        trips. Only the first and last stop time of each trip are kept
+        (in trip_times_df), since those are all we use to set trip start
+        and end times.
+
+        Trips can be given explicitly, or resolved from a date and/or
+        set of routes with :py:meth:`get_trip_ids`. Trips that were
+        already loaded are skipped, so calling this repeatedly for
+        different dates only reads what's new. This has no effect
+        unless the object was created with lazy_stop_times=True.
+
+        :param trip_ids: iterable of trip_id values
+        :param input_date: date used to resolve trip_ids if not given
+        :param routes: routes used to resolve trip_ids if not given
+        :param chunksize: number of rows of stop_times.txt to read at
+            a time, which bounds peak memory use
+        """
+        if not self.lazy_stop_times:
+            return
 
-        if self.calendar_dates_df is None:
-            service_add = list()
-            service_rmv = list()
-        else:
-            service_except = self.calendar_dates_df[
-                self.calendar_dates_df['date'] == input_date]
-            if len(service_except) > 0:
-                service_add = service_except[
-                    service_except['exception_type'] == 1][
-                    'service_id'].tolist()
-                service_rmv = service_except[
-                    service_except['exception_type'] == 2][
-                    'service_id'].tolist()
+        if trip_ids is None:
+            trip_ids = self.get_trip_ids(input_date, routes)
+        trip_ids = set(trip_ids) - self._stop_time_trips
+        if not trip_ids:
+            return
 
-            else:
-                service_add = list()
-                service_rmv = list()
+        if self._stop_times_file is None:
+            raise GTFSError(
+                'No stop_times.txt source is available to load stop times.')
+
+        load_start = time.time()
+        parts = list()
+        with open_gtfs_file(self._stop_times_file) as f, pd.read_csv(
+                f, usecols=['trip_id', 'arrival_time'],
+                dtype={'trip_id': str, 'arrival_time': str},
+                chunksize=chunksize) as reader:
+            for chunk in reader:
+                chunk = chunk[chunk['trip_id'].isin(trip_ids)]
+                if not chunk.empty:
+                    chunk = self._parse_stop_times(chunk)
+                    parts.append(get_trip_time_bounds(
+                        chunk['trip_id'], chunk['arrival_sec']))
+
+        if parts:
+            # A trip may span chunks, so reduce once more
+            new_bounds = pd.concat(parts).groupby(level=0).agg(
+                {'start_sec': 'min', 'end_sec': 'max'})
+            self.trip_times_df = pd.concat([self.trip_times_df, new_bounds])
+
+        self._stop_time_trips |= trip_ids
+        logger.debug(
+            'Streamed stop times for {} trips in {:.2f} seconds'.format(
+                len(trip_ids), time.time() - load_start))
+
+    def _build_trip_summary(self):
+        """
+        Build the trip summary table used to look up trip data on any
+        date. It joins trips.txt with routes.txt, the shapes summary,
+        and (unless stop times are loaded lazily) the first and last
+        stop time of each trip, keeping only bus trips. Rows are sorted
+        by block and start time, so the trips on a given date are just
+        a filter of this table and are already in block order.
+
+        The result is stored as self.trip_summary_df. In lazy mode it
+        has no start_sec and end_sec columns; these are merged in from
+        trip_times_df after the needed stop times are streamed.
+        """
+        trips = pd.merge(
+            self.trips_df, self.routes_df, left_on='route_id',
+            right_index=True)
+        trips = self.filter_df(trips, 'route_type', 3)
+        self.summarize_shapes(shape_ids=trips['shape_id'])
+        if self.shapes_summary_df is not None:
+            trips = pd.merge(
+                trips, self.shapes_summary_df[SHAPE_SUMMARY_COLS],
+                left_on='shape_id', right_index=True)
+        else:
+            trips = trips.iloc[:0].assign(
+                **{c: pd.Series(dtype=float) for c in SHAPE_SUMMARY_COLS})
 
-        # Combine the results
-        all_ids = set(ids_cal + service_add)
-        if service_add:
-            len_before = len(set(ids_cal))
-            logger.debug('Additions from calendar_dates: {}'.format(
-                len(all_ids) - len_before))
+        if not self.lazy_stop_times:
+            trips = pd.merge(
+                trips, self.trip_times_df, left_on='trip_id',
+                right_index=True)
+            trips = trips.sort_values(by=['block_id', 'start_sec'])
+        self.trip_summary_df = trips.reset_index(drop=True)
 
-        if service_rmv:
-            len_before = len(set(all_ids))
-            all_ids = set([i for i in all_ids if i not in service_rmv])
-            logger.debug('Removals from calendar_dates: {}'.format(
-                len(all_ids) - len_before))
+    def _finish_trip_data(self, trips, ref_date, sorted_trips=False):
+        """
+        Convert trip start and end times from seconds to timestamps on
+        the reference date and number the trips in each block.
 
-        return all_ids
+        :param trips: DataFrame of trips with columns start_sec and
+            end_sec and the columns in SHAPE_SUMMARY_COLS
+        :param ref_date: reference date used in time columns
+        :param sorted_trips: True if trips are already sorted by
+            block_id and start_sec
+        :return: DataFrame of trips with columns start_time, end_time,
+            and trip_idx in place of start_sec and end_sec
+        """
+        if not sorted_trips:
+            trips = trips.sort_values(by=['block_id', 'start_sec'])
+
+        # Trips are sorted by block, so trip indexes count up from the
+        # first row of each run of equal block_id values
+        blocks = trips['block_id'].to_numpy()
+        row_ix = np.arange(len(trips))
+        is_first = np.ones(len(trips), dtype=bool)
+        is_first[1:] = blocks[1:] != blocks[:-1]
+        block_start_ix = np.maximum.accumulate(np.where(is_first, row_ix, 0))
+
+        ref_date = pd.Timestamp(ref_date)
+        other_cols = [
+            c for c in trips.columns
+            if c not in SHAPE_SUMMARY_COLS + ['start_sec', 'end_sec']
+        ]
+        return trips[other_cols].assign(
+            start_time=ref_date + pd.to_timedelta(
+                trips['start_sec'].to_numpy(), unit='s'),
+            end_time=ref_date + pd.to_timedelta(
+                trips['end_sec'].to_numpy(), unit='s'),
+            trip_idx=row_ix - block_start_ix + 1,
+            **{c: trips[c] for c in SHAPE_SUMMARY_COLS}
+        )
 
     def add_trip_data(self, df, ref_date):
         """
@@ -405,77 +1013,52 @@ class GTFSData:
         if len(df) == 0:
             raise ValueError('Empty DataFrame')
 
-        # Get stop times only for the relevant trips
-        st_filt = self.filter_df(
-            self.stop_times_df, 'trip_id', df['trip_id'].tolist())
-        # TODO: use pd.to_timedelta() instead of to_datetime_safe()
-        # Convert times from string to datetime
-        try:
-            st_filt.loc[:, 'arrival_time'] = to_datetime_safe(
-                st_filt['arrival_time'], ref_date
-            )
-        except GTFSError:
-            pass
-        # Get start time of every trip
-        start_times = st_filt.groupby('trip_id').apply(
-            lambda x: x['arrival_time'].min()).sort_values().rename(
-            'start_time')
-        # Get end time of every trip
-        end_times = st_filt.groupby('trip_id').apply(
-            lambda x: x['arrival_time'].max()).sort_values().rename('end_time')
-        # Merge start and end times together
-        trip_times = pd.merge(
-            start_times, end_times, left_index=True, right_index=True)
-        # Add this data to trips DF
+        # Get first and last stop times of the relevant trips, which
+        # are already parsed to seconds since midnight
+        self.load_stop_times(trip_ids=df['trip_id'])
         trips_mrg = pd.merge(
-            df, trip_times, left_on='trip_id', right_index=True)
-        # Add trip indexes
-        trips_mrg = trips_mrg.sort_values(by=['block_id', 'start_time'])
-        trips_mrg['trip_idx'] = trips_mrg.groupby('block_id').cumcount() + 1
+            df, self.trip_times_df, left_on='trip_id', right_index=True)
 
         # Merge in start/end coords and distance from shapes summary
         # First, we need to ensure the trips are processed in
         # shapes_summary_df to get their coords and distances.
-        shape_id_list = list(trips_mrg['shape_id'].unique())
-        self.summarize_shapes(shape_ids=shape_id_list)
-
+        self.summarize_shapes(shape_ids=trips_mrg['shape_id'])
         trips_mrg = pd.merge(
-            trips_mrg, self.shapes_summary_df, left_on='shape_id',
-            right_index=True)
+            trips_mrg, self.shapes_summary_df[SHAPE_SUMMARY_COLS],
+            left_on='shape_id', right_index=True)
 
-        return trips_mrg
+        return self._finish_trip_data(trips_mrg, ref_date)
 
     @staticmethod
     def add_deadhead(trips_df):
-        trips_df = trips_df.sort_values(by=['block_id', 'trip_idx'])
-        block_gb = trips_df.groupby('block_id')
-        dh_dfs = list()
-        for block_id, block_df in block_gb:
-            block_df[['dh_dest_lat', 'dh_dest_lon']] = block_df[
-                ['start_lat', 'start_lon']].shift(-1)
-            dh_dfs.append(block_df)
-        trips_df = pd.concat(dh_dfs)
-
-        # Gather unique OD pairs for all deadhead trips
-        od_pairs = trips_df[
-            ['end_lat', 'end_lon', 'dh_dest_lat', 'dh_dest_lon']]
-        od_pairs = od_pairs.drop_duplicates().dropna().reset_index(drop=True)
+        """
+        Add the deadhead from the end of each trip to the start of the
+        next trip on its block, as columns dh_dest_lat, dh_dest_lon, and
+        dh_dist. The last trip of each block has no deadhead.
+
+        :param trips_df: DataFrame of trips
+        :return: DataFrame of trips sorted by block_id and trip_idx,
+            with a new RangeIndex
+        """
+        # The index is replaced anyway, and may be named after a column
+        trips_df = trips_df.reset_index(drop=True).sort_values(
+            by=['block_id', 'trip_idx'])
+        next_start = trips_df.groupby('block_id')[
+            ['start_lat', 'start_lon']].shift(-1)
+        trips_df = trips_df.assign(
+            dh_dest_lat=next_start['start_lat'],
+            dh_dest_lon=next_start['start_lon']
+        ).reset_index(drop=True)
 
         # Use Manhattan distance to calculate deadhead distance. Much
         # faster/easier than using a distance API and should be close.
-        od_pairs['dh_dist'] = manhattan_np(
-            od_pairs['end_lon'], od_pairs['end_lat'],
-            od_pairs['dh_dest_lon'], od_pairs['dh_dest_lat']
-        )
+        trips_df['dh_dist'] = np.nan_to_num(manhattan_np(
+            trips_df['end_lon'].to_numpy(), trips_df['end_lat'].to_numpy(),
+            trips_df['dh_dest_lon'].to_numpy(),
+            trips_df['dh_dest_lat'].to_numpy()
+        ))
 
-        # Merge DH dists into trip DF
-        merged_trips = pd.merge(
-            trips_df, od_pairs,
-            on=['end_lat', 'end_lon', 'dh_dest_lat', 'dh_dest_lon'],
-            how='left'
-        ).fillna({'dh_dist': 0})
-
-        return merged_trips
+        return trips_df
 
     def get_trips_from_sids(self, sids, ref_date=None, add_data=False):
         """
@@ -487,6 +1070,15 @@ class GTFSData:
             returned DataFrame
         :return: DataFrame of trip data for matching trips
         """
+        if add_data:
+            if isinstance(sids, str) or not isinstance(sids, Iterable):
+                sids = [sids]
+            # Match on service_id itself, since trips.txt may use
+            # service IDs that aren't in the calendar
+            trip_mask = self.trip_summary_df['service_id'].isin(
+                list(sids)).to_numpy()
+            return self._get_trip_summary(trip_mask, ref_date)
+
         # Get only the relevant trips
         trips_filt = self.filter_df(self.trips_df, 'service_id', sids)
         # Merge in route data (name, description, and route type)
@@ -495,113 +1087,85 @@ class GTFSData:
 
         # Only keep bus routes
         trips_mrg = self.filter_df(trips_mrg, 'route_type', 3)
-        if add_data:
-            # Get stop times and shape data only for the relevant trips
-            trips_mrg = self.add_trip_data(trips_mrg, ref_date)
 
         return trips_mrg
 
-    def get_trips_from_date(self, input_date):
+    def get_trips_from_date(self, input_date, add_data=False,
+                            block_ids=None):
         """
         Given a date, gather all needed data on all trips operating.
 
+        With add_data=True, this is a filter of the precomputed trip
+        summary table on the service calendar, so the cost of building
+        trips for many dates is dominated by the size of the output.
+
         :param input_date: date of operation
-        :return: dictionary of all relevant trip data
+        :param add_data: True if all trip data (e.g. start/end coords,
+            stop times, and trip distances) should be added to the
+            returned DataFrame
+        :param block_ids: if given with add_data=True, only get trips on
+            these blocks. With lazy_stop_times, only the stop times of
+            these trips are streamed.
+        :return: DataFrame of trip data for trips in service
         """
+        if add_data:
+            # Service IDs not in the calendar (code -1) are never in
+            # service on a date
+            sid_mask = np.append(self.get_service_mask(input_date), False)
+            return self._get_trip_summary(
+                sid_mask[self._trip_summary_sids], input_date, block_ids)
+
         # Get service IDs operating on the given date
         sids = self.get_service_ids(input_date)
         # Get only the relevant trips
         return self.get_trips_from_sids(sids, ref_date=input_date)
 
-    def get_n_trips_per_day(self):
-        # Identify busiest day
-        dow_dict = {
-            0: 'monday',
-            1: 'tuesday',
-            2: 'wednesday',
-            3: 'thursday',
-            4: 'friday',
-            5: 'saturday',
-            6: 'sunday'
-        }
-
-        sid_df = pd.DataFrame(
-            self.trips_df.groupby('service_id')['trip_id'].nunique().rename('n_trips')
-        )
-        sid_df['n_blocks'] = self.trips_df.groupby('service_id')['block_id'].nunique()
-
-        if self.calendar_df is not None:
-            cal_df = self.calendar_df.copy()
-
-            cal_df = cal_df.melt(
-                cal_df[['service_id', 'start_date', 'end_date']]
-            ).rename({'variable': 'weekday'}, axis=1)
-            cal_df = cal_df[cal_df['value'] == 1].drop('value', axis=1)
-            # Sometimes, all day values are 0 for some reason. In this case,
-            # disregard calendar.txt and move on.
-            if cal_df.empty:
-                patterns = pd.DataFrame(
-                    columns=['date', 'weekday', 'service_id']
-                )
-            else:
-                # Now match up dates and SID values
-                patterns = cal_df[['service_id', 'start_date', 'end_date', 'weekday']]
-                patterns['date'] = [
-                    pd.date_range(s, e, freq='d')
-                    for s, e in zip(
-                        patterns['start_date'],
-                        patterns['end_date'])]
-                patterns = patterns.explode('date').drop(['start_date', 'end_date'], axis=1)
-
-                dates_ix = pd.date_range(
-                    cal_df['start_date'].min(), cal_df['end_date'].max(), freq='D'
-                )
-
-                dates_df = pd.DataFrame(
-                    data={
-                        'date': dates_ix.to_numpy(),
-                        'weekday': dates_ix.dayofweek.to_series().apply(lambda x: dow_dict[x])}
-                )
-
-                # Match dates with service IDs
-                patterns = pd.merge(dates_df, patterns, on=['date', 'weekday'])
-
-        else:
-            patterns = pd.DataFrame(
-                columns=['date', 'weekday', 'service_id']
-            )
-
-        # Incorporate exceptions from calendar_dates
-        if self.calendar_dates_df is not None:
-            cal_dates_df = self.calendar_dates_df.copy()
-            service_add = cal_dates_df[cal_dates_df['exception_type'] == 1].drop(
-                'exception_type', axis=1)
-            service_rmv = cal_dates_df[cal_dates_df['exception_type'] == 2].drop(
-                'exception_type', axis=1)
-
-            # Add service IDs based on calendar_dates
-            if len(service_add) > 0:
-                service_add['weekday'] = service_add['date'].dt.dayofweek.apply(
-                    lambda x: dow_dict[x])
-                patterns = pd.concat([patterns, service_add], ignore_index=True)
-
-            # Remove service IDs based on calendar_dates
-            for _, row in service_rmv.sort_values(by='date').iterrows():
-                match = (patterns['service_id'] == row['service_id']) & (
-                        patterns['date'] == row['date'])
-                patterns = patterns[~match]
+    def _get_trip_summary(self, trip_mask, ref_date, block_ids=None):
+        """
+        Get the rows of the trip summary table selected by the given
+        mask, with times on the reference date.
 
-        # Bring in number of trips and blocks based on service IDs
-        patterns = pd.merge(patterns, sid_df, on='service_id')
+        :param trip_mask: boolean array with one entry per row of
+            self.trip_summary_df
+        :param ref_date: reference date used in time columns
+        :param block_ids: if given, only get trips on these blocks
+        :return: DataFrame of trip data for matching trips
+        """
+        trips = self.trip_summary_df[trip_mask]
+        if block_ids is not None:
+            # Select blocks before any stop times are streamed
+            trips = trips[trips['block_id'].isin(block_ids)]
+        if trips.empty:
+            raise ValueError('No trips in service')
+
+        if self.lazy_stop_times:
+            self.load_stop_times(trip_ids=trips['trip_id'])
+            trips = pd.merge(
+                trips, self.trip_times_df, left_on='trip_id',
+                right_index=True)
+            return self._finish_trip_data(trips, ref_date)
+
+        return self._finish_trip_data(trips, ref_date, sorted_trips=True)
 
-        day_totals = patterns.groupby('date')[['n_trips']].sum()
+    def get_n_trips_per_day(self):
+        """
+        Count the number of trips in service on every date in the feed,
+        e.g. to identify the busiest day.
 
-        return day_totals
+        :return: DataFrame indexed by date with column n_trips, covering
+            all dates that have at least one trip
+        """
+        sid_trips = self.trips_df.groupby('service_id')['trip_id'].nunique()
+        sid_trips = sid_trips.reindex(self.service_id_index, fill_value=0)
+        n_trips = self.service_matrix.astype(np.int64) @ sid_trips.to_numpy()
+        day_totals = pd.DataFrame(
+            {'n_trips': n_trips}, index=self.service_dates)
+        return day_totals[day_totals['n_trips'] > 0]
 
     @staticmethod
     def add_depot_deadhead(
             trips_df: pd.DataFrame, depot_lat: float, depot_lon: float
-            , osm_fname = None
+            , osm_fname = None, dh_provider = None
     ):
         """
         Add deadhead trips to and from depot. Note that these are not
@@ -615,60 +1179,49 @@ class GTFSData:
         :param trips_df: DataFrame of trips
         :param depot_lat: depot latitude
         :param depot_lon: depot longitude
+        :param osm_fname: filename of deadhead store
+        :param dh_provider: :py:class:`DeadheadProvider` used to
+            calculate deadhead (OpenRouteService by default)
         :return:
         """
         trips_df = trips_df.set_index('trip_id')
-        pullin_coords = list()
-        pullout_coords = list()
-        gb = trips_df.groupby('block_id')
-        for block_id, subdf in gb:
-            # Sort trips
-            subdf = subdf.sort_values(by='trip_idx', ascending=True)
-
-            # Get pull-out trip info
-            pullout = subdf.iloc[0]
-            pullout_coords.append(
-                (pullout.loc['start_lat'], pullout.loc['start_lon'])
-            )
-
-            # Get pull-in trip info
-            pullin = subdf.iloc[-1]
-            pullin_coords.append(
-                (pullin.loc['end_lat'], pullin.loc['end_lon'])
-            )
-
-        # Remove duplicates
-        pullout_coords = list(set(pullout_coords))
-        pullin_coords = list(set(pullin_coords))
+        first_pos, last_pos = get_block_bounds(
+            trips_df['block_id'], trips_df['trip_idx'])
+
+        # Unique pull-out and pull-in locations
+        pullout_coords = pd.MultiIndex.from_arrays([
+            trips_df['start_lat'].to_numpy()[first_pos],
+            trips_df['start_lon'].to_numpy()[first_pos]
+        ])
+        pullin_coords = pd.MultiIndex.from_arrays([
+            trips_df['end_lat'].to_numpy()[last_pos],
+            trips_df['end_lon'].to_numpy()[last_pos]
+        ])
+        pullout_locs = pullout_coords.unique()
+        pullin_locs = pullin_coords.unique()
 
         # Get OSM data
+        depot = (depot_lat, depot_lon)
         dh_data = get_updated_osm_data(
-            origins=[(depot_lat, depot_lon)] + pullin_coords,
-            dests=[(depot_lat, depot_lon)] + pullout_coords
-            , filename=osm_fname
+            origins=[depot] + pullin_locs.tolist(),
+            dests=[depot] + pullout_locs.tolist()
+            , filename=osm_fname, provider=dh_provider
         )
-
-        # Add to trip distances
-        for block_id, subdf in gb:
-            # Sort trips
-            subdf = subdf.sort_values(by='trip_idx', ascending=True)
-            # Add pull-out distance to first trip
-            t0 = subdf.iloc[0]
-            trips_df.loc[
-                t0.name, 'total_dist'
-            ] += dh_data[
-                (depot_lat, depot_lon),
-                (t0['start_lat'], t0['start_lon'])
-            ]['distance']
-
-            # Add pull-in distance to last trip
-            tlast = subdf.iloc[-1]
-            trips_df.loc[
-                tlast.name, 'total_dist'
-            ] += dh_data[
-                (tlast['end_lat'], tlast['end_lon']),
-                (depot_lat, depot_lon)
-            ]['distance']
+        pullout_dists = np.array(
+            [dh_data[depot, c]['distance'] for c in pullout_locs],
+            dtype=float)
+        pullin_dists = np.array(
+            [dh_data[c, depot]['distance'] for c in pullin_locs],
+            dtype=float)
+
+        # Add pull-out distance to first trip and pull-in distance to
+        # last trip of each block
+        total_dist = trips_df['total_dist'].to_numpy(dtype=float, copy=True)
+        total_dist[first_pos] += pullout_dists[
+            pullout_locs.get_indexer(pullout_coords)]
+        total_dist[last_pos] += pullin_dists[
+            pullin_locs.get_indexer(pullin_coords)]
+        trips_df['total_dist'] = total_dist
 
         return trips_df.reset_index()
 
@@ -677,222 +1230,426 @@ class GTFSData:
     def build_opt_inputs(
         charging_blocks, trip_df, charge_nodes, charge_coords,
         depot_coords
-        , osm_fname=None
+        , osm_fname=None, dh_provider=None
     ):
         """
         Build inputs for optimization model.
 
+        This is the dict form of :py:meth:`build_opt_arrays`, which
+        takes the same arguments.
+
         :return: dictionary of keyword arguments for ChargerLocationModel
         """
-        trip_start_times = dict()
-        trip_start_locs = dict()
-        trip_end_times = dict()
-        trip_end_locs = dict()
-        trip_dists = dict()
-        inter_trip_times = dict()
-        inter_trip_dists = dict()
-        # Earliest time any trip starts (so we can map time in minutes
-        # from start back to time of day)
-        zero_time = None
-
-        block_gb = trip_df.groupby('block_id')
-        for v in charging_blocks:
-            block_df = block_gb.get_group(v)
-            # Make extra sure trips are sorted in order
-            block_df = block_df.sort_values(by='trip_idx')
-            for i, t in enumerate(block_df.index):
-                # Add 1 to the trip index to account for deadheading
-                # from depot, which we model as trip 0
-                t_idx = i + 1
-
-                fmt_str = '%H:%M:%S'
-                t_ref = datetime.strptime('00:00:00', fmt_str)
-                if not zero_time or t_ref < zero_time:
-                    zero_time = t_ref
-
-                start_time = block_df.at[t, 'start_time']
-                trip_start_times[v, t_idx] = \
-                    (start_time - t_ref).total_seconds() / 60
-                trip_start_locs[v, t_idx] = (
-                    block_df.at[t, 'start_lat'], block_df.at[t, 'start_lon'])
-
-                end_time = block_df.at[t, 'end_time']
-                trip_end_times[v, t_idx] = \
-                    (end_time - t_ref).total_seconds() / 60
-                trip_end_locs[v, t_idx] = (
-                    block_df.at[t, 'end_lat'], block_df.at[t, 'end_lon'])
-
-                trip_dists[v, t_idx] = block_df.at[t, 'total_dist']
-
-        # Calculate all necessary distances. Uses two calls, but file is saved
-        # in between and reloaded so everything ends up in osm_charger_data.
-        unique_start_locs = list(set(trip_start_locs.values()))
-        unique_end_locs = list(set(trip_end_locs.values()))
-        charger_locs = list(set(charge_coords.values()))
-
-        osm_charger_data = get_dh_dict(
-            unique_start_locs, unique_end_locs, charger_locs, depot_coords
-            , osm_fname=osm_fname
+        return GTFSData.build_opt_arrays(
+            charging_blocks, trip_df, charge_nodes, charge_coords,
+            depot_coords, osm_fname=osm_fname, dh_provider=dh_provider
+        ).to_kwargs()
+
+    @staticmethod
+    def build_opt_arrays(
+        charging_blocks, trip_df, charge_nodes, charge_coords,
+        depot_coords
+        , osm_fname=None, dh_provider=None
+    ):
+        """
+        Build inputs for optimization model as dense arrays.
+
+        Each block is modeled as its trips plus a pull-out trip from
+        the depot (trip 0) and a pull-in trip to the depot (the last
+        trip). All inputs are gathered with array indexing from
+        deadhead matrices between unique locations, so there is no
+        Python work per trip or per trip and charger.
+
+        :param charging_blocks: block IDs to include
+        :param trip_df: DataFrame of trips, including all trips of the
+            blocks in charging_blocks
+        :param charge_nodes: list of charging site names
+        :param charge_coords: dict of (lat, lon) of each charging site
+        :param depot_coords: (lat, lon) of the depot
+        :param osm_fname: filename of OSM deadhead cache
+        :param dh_provider: :py:class:`DeadheadProvider` used to
+            calculate deadhead (OpenRouteService by default)
+        :return: :py:class:`OptInputArrays`
+        """
+        block_ids = pd.Index(list(charging_blocks))
+        block_codes = block_ids.get_indexer(trip_df['block_id'])
+        in_blocks = block_codes >= 0
+        block_codes = block_codes[in_blocks]
+        trips = trip_df[in_blocks]
+        # Make extra sure trips are sorted in order
+        order = np.lexsort((trips['trip_idx'].to_numpy(), block_codes))
+        block_codes = block_codes[order]
+        trips = trips.iloc[order]
+
+        n_trips = np.bincount(block_codes, minlength=len(block_ids))
+        if (n_trips == 0).any():
+            raise KeyError(
+                'No trips found for blocks {}'.format(
+                    block_ids[n_trips == 0].tolist()))
+        # Each block has its trips plus pull-out and pull-in trips
+        block_offsets = np.r_[0, np.cumsum(n_trips + 2)]
+        trip_offsets = np.r_[0, np.cumsum(n_trips)]
+        trip_rows = block_offsets[block_codes] + 1 + np.arange(len(trips)) \
+            - trip_offsets[block_codes]
+        first_rows = block_offsets[:-1] + 1
+        last_rows = block_offsets[1:] - 2
+        pullout_rows = block_offsets[:-1]
+        pullin_rows = block_offsets[1:] - 1
+        n_rows = block_offsets[-1]
+        # Is each real trip followed by another trip on its block?
+        has_next = np.r_[block_codes[1:] == block_codes[:-1], False]
+
+        # Times are in minutes from midnight on 1/1/1900, the date
+        # strptime() gives for a time of day with no date
+        zero_time = datetime.strptime('00:00:00', '%H:%M:%S')
+        start_mins = (trips['start_time'] - zero_time).dt.total_seconds(
+            ).to_numpy() / 60
+        end_mins = (trips['end_time'] - zero_time).dt.total_seconds(
+            ).to_numpy() / 60
+
+        # Unique locations, and the location index of each trip
+        start_codes, start_locs = pd.MultiIndex.from_arrays([
+            trips['start_lat'].to_numpy(), trips['start_lon'].to_numpy()
+        ]).factorize()
+        end_codes, end_locs = pd.MultiIndex.from_arrays([
+            trips['end_lat'].to_numpy(), trips['end_lon'].to_numpy()
+        ]).factorize()
+        start_locs = start_locs.tolist()
+        end_locs = end_locs.tolist()
+        charger_locs = [charge_coords[s] for s in charge_nodes]
+        depot_coords = tuple(depot_coords)
+
+        dh_matrix = DeadheadMatrix.from_dh_data(get_dh_dict(
+            start_locs, end_locs, list(set(charger_locs)), depot_coords
+            , osm_fname=osm_fname, provider=dh_provider
+        ))
+        end_chg_dist, end_chg_time = dh_matrix.get_block(
+            end_locs, charger_locs)
+        chg_start_dist, chg_start_time = dh_matrix.get_block(
+            charger_locs, start_locs)
+        inter_dist, inter_time = dh_matrix.get_block(end_locs, start_locs)
+        pullout_dist, _ = dh_matrix.get_block([depot_coords], start_locs)
+        pullin_dist, _ = dh_matrix.get_block(end_locs, [depot_coords])
+
+        start_times = np.empty(n_rows)
+        end_times = np.empty(n_rows)
+        start_times[trip_rows] = start_mins
+        end_times[trip_rows] = end_mins
+        start_times[pullout_rows] = start_times[first_rows]
+        end_times[pullout_rows] = start_times[first_rows]
+        # Maintain penalty for late arrival to depot
+        start_times[pullin_rows] = end_times[last_rows]
+        end_times[pullin_rows] = end_times[last_rows]
+
+        trip_dists = np.empty(n_rows)
+        trip_dists[trip_rows] = trips['total_dist'].to_numpy(dtype=float)
+        first_trips = trip_offsets[:-1]
+        last_trips = trip_offsets[1:] - 1
+        trip_dists[pullout_rows] = pullout_dist[0, start_codes[first_trips]]
+        trip_dists[pullin_rows] = pullin_dist[end_codes[last_trips], 0]
+
+        # Deadhead to the next trip; zero for the last trip of the block
+        # and the depot trips
+        inter_trip_dists = np.zeros(n_rows)
+        inter_trip_times = np.zeros(n_rows)
+        next_rows = trip_rows[has_next]
+        next_pairs = (end_codes[has_next], np.roll(start_codes, -1)[has_next])
+        inter_trip_dists[next_rows] = inter_dist[next_pairs]
+        inter_trip_times[next_rows] = inter_time[next_pairs]
+
+        # Deadhead between trips and chargers. Don't charge until first
+        # real trip is complete (bus fully charged when leaving depot
+        # anyway) or after final trip (to depot).
+        n_sites = len(charger_locs)
+        start_chg_dists = np.full((n_rows, n_sites), 1000.)
+        start_chg_times = np.full((n_rows, n_sites), 1000.)
+        end_chg_dists = np.full((n_rows, n_sites), 1000.)
+        end_chg_times = np.full((n_rows, n_sites), 1000.)
+        start_chg_dists[trip_rows] = chg_start_dist[:, start_codes].T
+        start_chg_times[trip_rows] = chg_start_time[:, start_codes].T
+        end_chg_dists[trip_rows] = end_chg_dist[end_codes]
+        end_chg_times[trip_rows] = end_chg_time[end_codes]
+        # Charging distance/time at the start of depot return trip are
+        # the same as at end of final "real" trip
+        start_chg_dists[pullin_rows] = end_chg_dists[last_rows]
+        start_chg_times[pullin_rows] = end_chg_times[last_rows]
+
+        return OptInputArrays(
+            block_ids=block_ids.to_numpy(),
+            block_offsets=block_offsets,
+            sites=list(charge_nodes),
+            trip_start_times=start_times,
+            trip_end_times=end_times,
+            trip_dists=trip_dists,
+            inter_trip_dists=inter_trip_dists,
+            inter_trip_times=inter_trip_times,
+            trip_start_chg_dists=start_chg_dists,
+            trip_start_chg_times=start_chg_times,
+            trip_end_chg_dists=end_chg_dists,
+            trip_end_chg_times=end_chg_times,
+            zero_time=zero_time
         )
 
-        trip_start_chg_dists = dict()
-        trip_start_chg_times = dict()
-        trip_end_chg_dists = dict()
-        trip_end_chg_times = dict()
-        for v in charging_blocks:
-            block_df = block_gb.get_group(v)
-            for i, t in enumerate(block_df.index):
-                # Add 1 to the trip index to account for deadheading
-                # from depot, which we model as trip 0
-                t_idx = i + 1
-                for s in charge_nodes:
-                    osm_start = osm_charger_data[
-                        charge_coords[s], trip_start_locs[v, t_idx]]
-                    osm_end = osm_charger_data[
-                        trip_end_locs[v, t_idx], charge_coords[s]]
-                    trip_start_chg_dists[v, t_idx, s] = osm_start['distance']
-                    trip_start_chg_times[v, t_idx, s] = osm_start['duration']
-                    trip_end_chg_dists[v, t_idx, s] = osm_end['distance']
-                    trip_end_chg_times[v, t_idx, s] = osm_end['duration']
-
-                # TODO: update this condition to reflect depot trips?
-                if i < len(block_df) - 1:
-                    # Add inter-trip details if there are any trips
-                    # remaining
-                    osm_inter = osm_charger_data[
-                        trip_end_locs[v, t_idx], trip_start_locs[v, t_idx + 1]]
-                    inter_trip_dists[v, t_idx] = osm_inter['distance']
-                    inter_trip_times[v, t_idx] = osm_inter['duration']
-
-            # Add in trips to/from depot at end/start of day.
-            osm_trip_0 = osm_charger_data[
-                depot_coords, trip_start_locs[v, 1]]
-            trip_dists[v, 0] = osm_trip_0['distance']
-            trip_start_times[v, 0] = trip_start_times[v, 1]
-            trip_end_times[v, 0] = trip_start_times[v, 1]
-            inter_trip_dists[v, 0] = 0
-            inter_trip_times[v, 0] = 0
-
-            end_idx = t_idx + 1
-            osm_last_trip = osm_charger_data[
-                trip_end_locs[v, end_idx - 1], depot_coords]
-            trip_dists[v, end_idx] = osm_last_trip['distance']
-            # Maintain penalty for late arrival to depot
-            trip_start_times[v, end_idx] = trip_end_times[v, end_idx - 1]
-            trip_end_times[v, end_idx] = trip_end_times[v, end_idx - 1]
-            inter_trip_dists[v, end_idx - 1] = 0
-            inter_trip_times[v, end_idx - 1] = 0
-            inter_trip_dists[v, end_idx] = 0
-            inter_trip_times[v, end_idx] = 0
-
-            for s in charge_nodes:
-                # Add data for initial trip from depot
-                # Don't charge until first real trip is complete (bus
-                # fully charged when leaving depot anyway)
-                trip_start_chg_dists[v, 0, s] = 1000
-                trip_start_chg_times[v, 0, s] = 1000
-                trip_end_chg_dists[v, 0, s] = 1000
-                trip_end_chg_times[v, 0, s] = 1000
-
-                # Add data for final trip to depot
-                # Charging distance/time at the start of depot return
-                # trip are the same as at end of final "real" trip
-                trip_start_chg_dists[v, end_idx, s] = trip_end_chg_dists[
-                    v, end_idx - 1, s]
-                trip_start_chg_times[v, end_idx, s] = trip_end_chg_times[
-                    v, end_idx - 1, s]
-                # No sense in charging after final trip (to depot)
-                trip_end_chg_dists[v, end_idx, s] = 1000
-                trip_end_chg_times[v, end_idx, s] = 1000
-
-        veh_trip_pairs = list(trip_start_times.keys())
-
-        opt_kwargs = {
-            'veh_trip_pairs': veh_trip_pairs,
-            'trip_start_times': trip_start_times,
-            'trip_end_times': trip_end_times,
-            'trip_dists': trip_dists,
-            'inter_trip_dists': inter_trip_dists,
-            'trip_start_chg_dists': trip_start_chg_dists,
-            'trip_end_chg_dists': trip_end_chg_dists,
-            'inter_trip_times': inter_trip_times,
-            'trip_start_chg_times': trip_start_chg_times,
-            'trip_end_chg_times': trip_end_chg_times,
-            'zero_time': zero_time}
-
-        return opt_kwargs
-
-
-def get_updated_osm_data(origins, dests, filename=None):
+
+class OptInputArrays:
+    """
+    Trip inputs for :py:class:`ChargerLocationModel` as dense arrays,
+    built by :py:meth:`GTFSData.build_opt_arrays`.
+
+    Rows of the per-trip arrays are model trips grouped by block: the
+    trips of block_ids[b] are rows block_offsets[b] through
+    block_offsets[b+1] - 1, in trip index order, starting with the
+    pull-out trip (trip 0) and ending with the pull-in trip. Columns of
+    the trip x site arrays follow the order of sites.
+    """
+    def __init__(
+            self, block_ids, block_offsets, sites, trip_start_times,
+            trip_end_times, trip_dists, inter_trip_dists, inter_trip_times,
+            trip_start_chg_dists, trip_start_chg_times, trip_end_chg_dists,
+            trip_end_chg_times, zero_time):
+        """
+        :param block_ids: array of block IDs
+        :param block_offsets: array of first row of each block, plus
+            the total number of rows
+        :param sites: list of charging site names
+        :param trip_start_times: trip start times in minutes
+        :param trip_end_times: trip end times in minutes
+        :param trip_dists: trip distances in miles
+        :param inter_trip_dists: deadhead distance to next trip
+        :param inter_trip_times: deadhead time to next trip
+        :param trip_start_chg_dists: trip x site deadhead distances from
+            chargers to trip starts
+        :param trip_start_chg_times: trip x site deadhead times from
+            chargers to trip starts
+        :param trip_end_chg_dists: trip x site deadhead distances from
+            trip ends to chargers
+        :param trip_end_chg_times: trip x site deadhead times from
+            trip ends to chargers
+        :param zero_time: datetime that times are measured from
+        """
+        self.block_ids = block_ids
+        self.block_offsets = block_offsets
+        self.sites = sites
+        self.trip_start_times = trip_start_times
+        self.trip_end_times = trip_end_times
+        self.trip_dists = trip_dists
+        self.inter_trip_dists = inter_trip_dists
+        self.inter_trip_times = inter_trip_times
+        self.trip_start_chg_dists = trip_start_chg_dists
+        self.trip_start_chg_times = trip_start_chg_times
+        self.trip_end_chg_dists = trip_end_chg_dists
+        self.trip_end_chg_times = trip_end_chg_times
+        self.zero_time = zero_time
+
+        # Block and trip index of every row
+        n_per_block = np.diff(block_offsets)
+        self.row_blocks = np.repeat(np.arange(len(block_ids)), n_per_block)
+        self.row_trip_idx = np.arange(block_offsets[-1]) \
+            - block_offsets[self.row_blocks]
+        self.block_index = {v: b for b, v in enumerate(block_ids.tolist())}
+        self.site_index = {s: i for i, s in enumerate(sites)}
+
+    def get_row(self, v, t):
+        """
+        Get the row of a model trip.
+
+        :param v: block ID
+        :param t: trip index within the block
+        :return: row index
+        """
+        return self.block_offsets[self.block_index[v]] + t
+
+    def to_kwargs(self):
+        """
+        Convert to the dict form returned by
+        :py:meth:`GTFSData.build_opt_inputs`, which
+        :py:class:`ChargerLocationModel` takes as keyword arguments.
+
+        :return: dict of keyword arguments
+        """
+        blocks = self.block_ids[self.row_blocks].tolist()
+        trip_idx = self.row_trip_idx.tolist()
+        # Real trips of every block first, then depot trips
+        is_depot = np.zeros(len(blocks), dtype=bool)
+        is_depot[self.block_offsets[:-1]] = True
+        is_depot[self.block_offsets[1:] - 1] = True
+        rows = np.r_[np.flatnonzero(~is_depot), np.flatnonzero(is_depot)]
+        vt = [(blocks[r], trip_idx[r]) for r in rows.tolist()]
+
+        def vt_dict(arr):
+            return dict(zip(vt, arr[rows].tolist()))
+
+        def vts_dict(arr):
+            values = arr[rows].ravel().tolist()
+            keys = [(v, t, s) for (v, t) in vt for s in self.sites]
+            return dict(zip(keys, values))
+
+        return {
+            'veh_trip_pairs': vt,
+            'trip_start_times': vt_dict(self.trip_start_times),
+            'trip_end_times': vt_dict(self.trip_end_times),
+            'trip_dists': vt_dict(self.trip_dists),
+            'inter_trip_dists': vt_dict(self.inter_trip_dists),
+            'trip_start_chg_dists': vts_dict(self.trip_start_chg_dists),
+            'trip_end_chg_dists': vts_dict(self.trip_end_chg_dists),
+            'inter_trip_times': vt_dict(self.inter_trip_times),
+            'trip_start_chg_times': vts_dict(self.trip_start_chg_times),
+            'trip_end_chg_times': vts_dict(self.trip_end_chg_times),
+            'zero_time': self.zero_time}
+
+
+def get_deadhead_data(
+        relations, filename=None, provider=None, registry=None,
+        fetcher=None, stats=None, dry_run=False):
+    """
+    Get time/distance data for several (origins, dests) relations at
+    once. All OD pairs needed across the relations are looked up in the
+    store together, and the missing ones are grouped into as few
+    rectangular matrix requests as possible (see
+    :py:func:`plan_requests`), so the store is opened once and no pair
+    is requested twice.
+
+    :param relations: list of (origins, dests) tuples. Deadhead is
+        needed from every origin to every destination of each relation.
+    :param filename: String giving file name of the deadhead store
+        (see :py:func:`open_deadhead_store`) to check for existing data
+        and write updated data. A legacy .pickle file name is migrated
+        to a store next to it.
+    :param provider: :py:class:`DeadheadProvider` used to calculate
+        deadhead. Defaults to OpenRouteService. The store is only used
+        for cacheable providers.
+    :param registry: optional :py:class:`LocationRegistry`. If given,
+        deadhead is only requested between the representatives of the
+        origins and destinations, and each pair gets the deadhead of
+        its representatives.
+    :param fetcher: :py:class:`BatchFetcher` used to request missing
+        data from a cacheable provider, to control concurrency, rate
+        limiting and retries. Defaults to BatchFetcher(provider). If
+        given without a provider, the fetcher's provider is used.
+    :param stats: :py:class:`DeadheadStats` to record store hits and
+        misses, API calls, routes requested, time spent fetching and
+        store size in. Defaults to :py:data:`DEFAULT_STATS`.
+    :param dry_run: if True, don't fetch anything. Instead, return a
+        dict with the number of OD pairs needed ('pairs'), found in the
+        store ('hits') and missing ('misses'), and the number of matrix
+        requests ('requests') and API calls ('api_calls') it would take
+        to fetch the missing pairs.
+    :return: Dictionary of charging data for all (origin, dest) pairs
+        of all relations. Newly fetched data is also added to the store
+        for future use.
+    """
+    if provider is None:
+        provider = ORSProvider() if fetcher is None else fetcher.provider
+    if fetcher is None:
+        fetcher = BatchFetcher(provider)
+    if stats is None:
+        stats = DEFAULT_STATS
+    relations = [
+        (list(dict.fromkeys(origins)), list(dict.fromkeys(dests)))
+        for origins, dests in relations]
+    if registry is not None:
+        rep_relations = [
+            (registry.resolve(origins), registry.resolve(dests))
+            for origins, dests in relations]
+        n_pairs = 0
+        n_rep_pairs = 0
+        for origins, dests in relations:
+            reduction = registry.get_reduction(origins, dests)
+            n_pairs += reduction['pairs']
+            n_rep_pairs += reduction['rep_pairs']
+        logger.info(
+            'Location clustering reduced {} OD pairs to {} ({:.1%} '
+            'fewer).'.format(n_pairs, n_rep_pairs,
+                             1 - n_rep_pairs / max(n_pairs, 1)))
+        rep_data = get_deadhead_data(
+            rep_relations, filename=filename, provider=provider,
+            fetcher=fetcher, stats=stats, dry_run=dry_run)
+        if dry_run:
+            return rep_data
+        return {
+            (org, dst): rep_data[rep_org, rep_dst]
+            for (origins, dests), (rep_origins, rep_dests) in zip(
+                relations, rep_relations)
+            for org, rep_org in zip(origins, rep_origins)
+            for dst, rep_dst in zip(dests, rep_dests)}
+
+    needed = {
+        (org, dst) for origins, dests in relations
+        for org in origins for dst in dests}
+    if not provider.cacheable:
+        # Calculated locally, so there is nothing to cache or request
+        if dry_run:
+            return {'pairs': len(needed), 'hits': 0, 'misses': len(needed),
+                    'requests': 0, 'api_calls': 0}
+        dh_start = time.time()
+        dh_data = dict()
+        for origins, dests in relations:
+            dh_data.update(provider.get_dh_data(origins, dests))
+        stats.add(routes_requested=len(needed),
+                  seconds=time.time() - dh_start)
+        return dh_data
+
+    with open_deadhead_store(filename) as store:
+        charging_travel_data = store.get_many(needed)
+        missing = needed.difference(charging_travel_data)
+        requests = plan_requests(missing, provider.max_elements)
+        if dry_run:
+            return {'pairs': len(needed), 'hits': len(charging_travel_data),
+                    'misses': len(missing), 'requests': len(requests),
+                    'api_calls': fetcher.n_calls(requests)}
+        stats.add(hits=len(charging_travel_data), misses=len(missing))
+
+        if missing:
+            logger.info(
+                '{} of {} OD pairs not in store. Requesting them in {} '
+                'matrices.'.format(len(missing), len(needed), len(requests)))
+            osm_start = time.time()
+            # Save each response as it arrives so a failed call
+            # doesn't lose the earlier ones
+            try:
+                osm_dh_data = fetcher.fetch_many(
+                    requests, on_chunk=store.put_many, stats=stats)
+            finally:
+                stats.add(seconds=time.time() - osm_start)
+            charging_travel_data.update(
+                (pair, osm_dh_data[pair]) for pair in missing)
+            logger.info(
+                'Deadhead matrix returned in {:.2f} seconds.'.format(
+                    time.time() - osm_start))
+        stats.bytes_stored = store.nbytes
+    return charging_travel_data
+
+
+def get_updated_osm_data(
+        origins, dests, filename=None, provider=None, registry=None,
+        fetcher=None, stats=None, dry_run=False):
     """
     Update time/distance data for charging. Checks for existence of
     data to minimize unnecessary API calls.
 
     :param origins: Origin coordinates
     :param dests: Destination coordinates
-    :param filename: String giving file name to check for existing data
-        and write updated data
-    :return: Dictionary of all charging data. Also pickles the updated
-        dict for future use.
+    :param filename: String giving file name of the deadhead store
+        (see :py:func:`open_deadhead_store`) to check for existing data
+        and write updated data. A legacy .pickle file name is migrated
+        to a store next to it.
+    :param provider: :py:class:`DeadheadProvider` used to calculate
+        deadhead. Defaults to OpenRouteService. The store is only used
+        for cacheable providers.
+    :param registry: optional :py:class:`LocationRegistry` (see
+        :py:func:`get_deadhead_data`)
+    :param fetcher: optional :py:class:`BatchFetcher` (see
+        :py:func:`get_deadhead_data`)
+    :param stats: optional :py:class:`DeadheadStats` (see
+        :py:func:`get_deadhead_data`)
+    :param dry_run: if True, return an estimate of the data to fetch
+        instead of fetching it (see :py:func:`get_deadhead_data`)
+    :return: Dictionary of charging data for all (origin, dest) pairs.
+        Newly fetched data is also added to the store for future use.
     """
-    if filename is None:
-        filename = str(Path(__file__).resolve().parent.parent /
-                       'data' / 'osm' / 'osm_charge_data.pickle')
-
-    # Read in saved dict of calculated costs
-    try:
-        with open(filename, 'rb') as handle:
-            charging_travel_data = pickle.load(handle)
-    except FileNotFoundError:
-        # If file doesn't exist, create new dict
-        charging_travel_data = dict()
-
-    orig_osm = list()
-    dest_osm = list()
-    for org in origins:
-        for dst in dests:
-            if (org, dst) not in charging_travel_data:
-                if org not in orig_osm:
-                    orig_osm.append(org)
-                if dst not in dest_osm:
-                    dest_osm.append(dst)
-
-    if orig_osm and dest_osm:
-        n_dests = len(dest_osm)
-        n_orig = len(orig_osm)
-        osm_start = time.time()
-        # Don't exceed OSM call size limit
-        if n_dests * n_orig <= 3500:
-            osm_dh_data = get_osm_distance(orig_osm, dest_osm)
-            charging_travel_data = {**charging_travel_data, **osm_dh_data}
-        else:
-            if n_dests >= 3500:
-                raise ValueError(
-                    'Too many destinations to make any API calls.')
-            n_orig_per_call = int(np.floor(3500 / n_dests))
-            n_calls = int(np.ceil(n_orig / n_orig_per_call))
-            logger.info(
-                '{} unique route requests. {} ORS calls required.'.format(
-                    n_dests*n_orig, n_calls))
-            for c in range(n_calls):
-                logger.info('API request {} underway.'.format(c+1))
-                if c == n_calls-1:
-                    part_origs = orig_osm[c*n_orig_per_call:]
-                else:
-                    part_origs = orig_osm[
-                                 c*n_orig_per_call:(c+1)*n_orig_per_call]
-                osm_dh_data = get_osm_distance(part_origs, dest_osm)
-                charging_travel_data = {
-                    **charging_travel_data, **osm_dh_data}
-        logger.info(
-            'OpenRouteService matrix returned in {:.2f} seconds.'.format(
-                time.time() - osm_start))
-
-        with open(filename, 'wb') as handle:
-            pickle.dump(charging_travel_data, handle,
-                        protocol=pickle.HIGHEST_PROTOCOL)
-
-    return charging_travel_data
+    return get_deadhead_data(
+        [(origins, dests)], filename=filename, provider=provider,
+        registry=registry, fetcher=fetcher, stats=stats, dry_run=dry_run)
 
 
 def get_osm_distance(orig_list, dest_list):
@@ -906,82 +1663,44 @@ def get_osm_distance(orig_list, dest_list):
     :return: Dict of distance and duration to drive from orig to dest,
         as calculated by OpenRouteService
     """
-    # Openrouteservice setup
-    try:
-        config = dotenv_values(find_dotenv())
-        ors_key = config['ORS_KEY']
+    return ORSProvider().get_dh_data(orig_list, dest_list)
 
-    except KeyError:
-        raise KeyError(
-            'No Openrouteservice key found in .env file. For more information'
-            ', please see the project README file.'
-        )
-    ors = client.Client(key=ors_key)
-
-    # ORS uses reverse coordinate order (lon, then lat)
-    orig_list_osm = [list(reversed(o)) for o in orig_list]
-    dest_list_osm = [list(reversed(d)) for d in dest_list]
-    all_coords = orig_list_osm + dest_list_osm
-    orig_ix = list(range(len(orig_list_osm)))
-    dest_ix = [len(orig_list_osm) + i for i in range(len(dest_list_osm))]
-    logger.info('OSM request: {} origins, {} destinations ({} total '
-                 'routes)'.format(len(orig_ix), len(dest_ix),
-                                  len(orig_ix)*len(dest_ix)))
-    params_matrix = {'profile': 'driving-hgv',
-                     'metrics': ['duration', 'distance'],
-                     'locations': all_coords,
-                     'sources': orig_ix,
-                     'destinations': dest_ix}
-    res = ors.distance_matrix(**params_matrix)
-
-    # Get the distance and time, converting from meters to miles and
-    # from seconds to minutes
-    out_dict = dict()
-    for o_ix in orig_ix:
-        for d_ix in range(len(dest_list)):
-            try:
-                dh_dict = {
-                    'distance': res['distances'][o_ix][d_ix] / 1609,
-                    'duration': res['durations'][o_ix][d_ix] / 60}
-            except TypeError:
-                # Sometimes ORS returns None for distance/duration. If
-                # this happens, use Manhattan distance and 20 mph speed
-                orig_lon, orig_lat = orig_list_osm[o_ix]
-                dest_lon, dest_lat = dest_list_osm[d_ix]
-                dh_dist = manhattan_np(
-                    lon1=orig_lon, lat1=orig_lat, lon2=dest_lon, lat2=dest_lat
-                )
-                dh_time = dh_dist * 60 / 20
-                dh_dict = {
-                    'distance': dh_time,
-                    'duration': dh_time
-                }
-            out_dict[tuple(orig_list[o_ix]), tuple(dest_list[d_ix])] = dh_dict
 
-    return out_dict
+def get_gmaps_client(key=None):
+    """
+    Create a Google Maps client.
 
+    :param key: Google Maps API key. If None, GMAPS_KEY is read from
+        the .env file.
+    :return: googlemaps.Client
+    """
+    if key is None:
+        try:
+            config = dotenv_values(find_dotenv())
+            key = config['GMAPS_KEY']
+        except KeyError:
+            raise KeyError(
+                'No Google Maps key found in .env file. For more information'
+                ', please see the project README file.'
+            )
+    return googlemaps.Client(key=key)
 
-def get_gmap_directions(orig, dest):
+
+def get_gmap_directions(orig, dest, client=None):
     """
     Get Google directions between a pair of points.
 
     :param orig: Origin coordinates, tuple of (lat, lon) values
     :param dest: Destination coordinates, tuple of (lat, lon) values
+    :param client: googlemaps.Client to use. If None, a new one is
+        created with the key from the .env file. Pass one in to reuse
+        its connection across many requests.
     :return: Directions to drive from orig to dest,
         as calculated by Google Maps, as encoded polyline
     """
-    # Google API key
-    try:
-        config = dotenv_values(find_dotenv())
-        gmaps_key = config['GMAPS_KEY']
-    except KeyError:
-        raise KeyError(
-            'No Openrouteservice key found in .env file. For more information'
-            ', please see the project README file.'
-        )
-
-    gmaps = googlemaps.Client(key=gmaps_key)
-    directions = gmaps.directions(orig, dest, 'driving')
+    if client is None:
+        client = get_gmaps_client()
+    directions = client.directions(orig, dest, 'driving')
     return directions[0]['overview_polyline']['points']
 
 
@@ -1001,64 +1720,310 @@ def turn_over_datetime(dt_str):
     return dt_obj
 
 
-def to_datetime_safe(srs, date):
+def time_str_to_seconds(srs):
     """
-    Safely convert a Pandas Series of GTFS time strings to datetime
-    objects. This custom function does is necessary because feeds often
-    use a time string with > 24 hour formatting, e.g. 25:00:00 meaning
-    1:00 a.m. the following day.
+    Convert a Pandas Series of GTFS time strings (%H:%M:%S, where the
+    hours may exceed 23) to seconds since midnight.
 
-    :param srs: series to be formatted as datetime
-    :param date: reference date prepended to all times
+    :param srs: Series of time strings
+    :return: Series of seconds since midnight (float, since missing
+        times are returned as NaN)
     """
-    df = pd.DataFrame(srs)
     try:
-        df[['hrs', 'min', 'sec']] = df[srs.name].str.split(
-            ':', expand=True).astype(int)
+        return pd.to_timedelta(srs.str.strip()).dt.total_seconds()
     except ValueError:
         raise GTFSError(
             'time string not formatted properly, should be "%H:%M:%S"'
         )
 
-    # Calculate seconds since midnight
-    df['total_sec'] = 3600*df['hrs'] + 60*df['min'] + df['sec']
-    df[srs.name] = pd.to_datetime(df['total_sec'], origin=date, unit='s')
-    return df[srs.name]
 
+def get_trip_time_bounds(trip_ids, arrival_secs):
+    """
+    Get the first and last arrival time of every trip.
+
+    :param trip_ids: Series of trip_id values
+    :param arrival_secs: Series of arrival times in seconds since
+        midnight, aligned with trip_ids
+    :return: DataFrame indexed by trip_id with int32 columns start_sec
+        and end_sec
+    """
+    gb = pd.Series(arrival_secs.to_numpy()).groupby(
+        trip_ids.to_numpy(), sort=False)
+    bounds = pd.DataFrame({'start_sec': gb.min(), 'end_sec': gb.max()})
+    bounds.index.name = 'trip_id'
+    return bounds.astype(np.int32)
+
+
+def get_block_bounds(block_ids, trip_idxs):
+    """
+    Find the first and last trip of every block.
+
+    :param block_ids: Series of block IDs
+    :param trip_idxs: Series of trip indexes, aligned with block_ids
+    :return: tuple of integer arrays giving the positions of the first
+        and last trip of each block in the input
+    """
+    codes = pd.factorize(block_ids)[0]
+    order = np.lexsort((trip_idxs.to_numpy(), codes))
+    codes = codes[order]
+    is_new = np.ones(len(codes), dtype=bool)
+    is_new[1:] = codes[1:] != codes[:-1]
+    is_end = np.ones(len(codes), dtype=bool)
+    is_end[:-1] = is_new[1:]
+    return order[is_new], order[is_end]
+
+
+def get_group_fingerprints(keys, df):
+    """
+    Calculate a fingerprint for each group of rows of a DataFrame.
+
+    Every row is hashed, and the row hashes of each group are summed
+    (with uint64 wraparound). The sum doesn't depend on row order, so
+    columns that define the order (like shape_pt_sequence) should be
+    included in df.
+
+    :param keys: Series of group keys, aligned with df
+    :param df: DataFrame of values to fingerprint
+    :return: uint64 Series indexed by group key
+    """
+    row_hashes = pd.util.hash_pandas_object(df, index=False).to_numpy()
+    codes, uniques = pd.factorize(keys)
+    order = np.argsort(codes, kind='stable')
+    codes = codes[order]
+    if len(codes):
+        starts = np.flatnonzero(np.r_[True, codes[1:] != codes[:-1]])
+        fps = np.add.reduceat(row_hashes[order], starts)
+        group_ix = codes[starts]
+    else:
+        fps = np.array([], dtype=np.uint64)
+        group_ix = np.array([], dtype=int)
+    return pd.Series(
+        fps, index=pd.Index(np.asarray(uniques)[group_ix], name=keys.name),
+        dtype=np.uint64)
+
+
+def _same_fingerprints(fps, prior_fps):
+    """
+    Get the keys that have the same fingerprint in both Series.
+    """
+    common = fps.index.intersection(prior_fps.index)
+    same = fps[common].to_numpy() == prior_fps[common].to_numpy()
+    return common[same]
 
-def haversine_np(lon1, lat1, lon2, lat2):
+
+class ZipMember:
+    """
+    A file inside a zip archive, which can be given to
+    :py:class:`GTFSData` in place of a filename.
     """
-    Calculate the great circle distance between two points
-    on the earth (specified in decimal degrees)
+    def __init__(self, zip_path, name):
+        """
+        :param zip_path: path to .zip file
+        :param name: name of the member within the archive
+        """
+        self.zip_path = Path(zip_path)
+        self.name = name
 
-    All args must be of equal length.
+    def __repr__(self):
+        return 'ZipMember({!r}, {!r})'.format(str(self.zip_path), self.name)
 
-    credit: https://stackoverflow.com/a/29546836/8576714
 
+@contextmanager
+def open_gtfs_file(source):
     """
-    lon1, lat1, lon2, lat2 = map(np.radians, [lon1, lat1, lon2, lat2])
+    Context manager giving something pd.read_csv can read from a GTFS
+    file source. Filenames are passed through unchanged, and members of
+    zip archives are opened as a stream without extracting them.
 
-    dlon = lon2 - lon1
-    dlat = lat2 - lat1
+    :param source: filename or :py:class:`ZipMember`
+    """
+    if not isinstance(source, ZipMember):
+        yield source
+        return
 
-    a = np.sin(dlat / 2.0) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin(dlon / 2.0) ** 2
+    with zipfile.ZipFile(source.zip_path) as zf:
+        try:
+            member = zf.open(source.name)
+        except KeyError:
+            raise FileNotFoundError(
+                'No file {} in {}'.format(source.name, source.zip_path))
+        with member:
+            yield member
 
-    c = 2 * np.arcsin(np.sqrt(a))
-    km = 6378.137 * c
-    miles = km / 1.609
-    return miles
 
+def _load_feed(cls, dir_name, load_kwargs):
+    """
+    Load one feed in a worker process for :py:meth:`GTFSData.load_many`.
 
-def manhattan_np(lon1, lat1, lon2, lat2):
+    :return: path of the feed's snapshot if it exists or could be
+        written, otherwise the GTFSData object itself
     """
-    Calculate the Manhattan (l1-norm) distance between two points
-    on the earth (specified in decimal degrees)
+    if not load_kwargs['use_snapshot']:
+        return cls.from_dir(dir_name, **load_kwargs)
 
-    Works by calculating 2 haversine distances.
+    snapshot_path = cls._snapshot_path(
+        dir_name, load_kwargs['snapshot_dir'], load_kwargs['lazy_stop_times'])
+    if (snapshot_path / 'manifest.json').exists():
+        return snapshot_path
 
+    obj = cls(
+        **cls._feed_files(dir_name),
+        lazy_stop_times=load_kwargs['lazy_stop_times'],
+        table_workers=load_kwargs['table_workers'])
+    if obj._save_snapshot(snapshot_path):
+        return snapshot_path
+    return obj
+
+
+def _map_id_columns(df, id_index, cols, func):
+    """
+    Apply func(values, index) to each ID column or index level of df
+    that has an entry in id_index.
+    """
+    if cols is None:
+        cols = ID_COLS
+    index_names = list(df.index.names)
+    cols = [
+        c for c in cols if c in id_index
+        and (c in df.columns or c in index_names)
+    ]
+    if not cols:
+        return df
+
+    in_index = any(c in index_names for c in cols)
+    if in_index:
+        df = df.reset_index()
+    else:
+        df = df.copy()
+    for c in cols:
+        df[c] = func(df[c], id_index[c])
+    if in_index:
+        df = df.set_index(index_names)
+    return df
+
+
+def _encode_ids(srs, index):
+    if pd.api.types.is_integer_dtype(srs):
+        # Already encoded
+        return srs
+    codes = index.get_indexer(srs)
+    # Missing IDs are encoded as -1, but unknown IDs are an error
+    unknown = (codes < 0) & srs.notna().to_numpy()
+    if unknown.any():
+        raise ValueError(
+            'Unknown {} values: {}'.format(
+                index.name, srs[unknown].unique()[:5].tolist()))
+    return codes.astype(np.int32)
+
+
+def _decode_ids(srs, index):
+    if not pd.api.types.is_integer_dtype(srs):
+        # Not encoded
+        return srs
+    codes = srs.to_numpy()
+    missing = codes < 0
+    ids = index.take(np.where(missing, 0, codes)).to_numpy()
+    if missing.any():
+        # Codes of -1 are missing IDs
+        ids = ids.astype(object)
+        ids[missing] = np.nan
+    return ids
+
+
+def encode_id_columns(df, id_index, cols=None):
+    """
+    Replace GTFS ID columns and index levels with int32 codes.
+
+    :param df: DataFrame with ID columns
+    :param id_index: dict mapping ID column names to a pd.Index of
+        unique IDs, where the position of each ID is its code
+    :param cols: ID columns to encode, defaults to all of ID_COLS
+    :return: DataFrame with encoded IDs. Columns that are already
+        integers are left as they are.
+    """
+    return _map_id_columns(df, id_index, cols, _encode_ids)
+
+
+def decode_id_columns(df, id_index, cols=None):
+    """
+    Convert int32 ID codes created by :py:func:`encode_id_columns`
+    back to the original IDs. Codes of -1 are decoded as NaN.
+
+    :param df: DataFrame with encoded ID columns
+    :param id_index: dict mapping ID column names to a pd.Index of
+        unique IDs, where the position of each ID is its code
+    :param cols: ID columns to decode, defaults to all of ID_COLS
+    :return: DataFrame with original IDs. Columns that aren't integers
+        are left as they are.
     """
-    return haversine_np(lon1, lat1, lon2, lat1) + haversine_np(
-        lon2, lat1, lon2, lat2
+    return _map_id_columns(df, id_index, cols, _decode_ids)
+
+
+def to_datetime_safe(srs, date):
+    """
+    Safely convert a Pandas Series of GTFS time strings to datetime
+    objects. This custom function does is necessary because feeds often
+    use a time string with > 24 hour formatting, e.g. 25:00:00 meaning
+    1:00 a.m. the following day.
+
+    :param srs: series to be formatted as datetime
+    :param date: reference date prepended to all times
+    """
+    return pd.Timestamp(date) + pd.to_timedelta(
+        time_str_to_seconds(srs), unit='s')
+
+
+def summarize_shape_points(shapes_df: pd.DataFrame, shape_ids=None):
+    """
+    Get the start and end coordinates and total length (in miles) of
+    shapes in a single vectorized pass.
+
+    Shape points are sorted once by shape and sequence, so each shape
+    is a contiguous segment of the sorted arrays. Distances between
+    consecutive points are then summed per segment with
+    np.add.reduceat, rather than processing each shape separately.
+
+    :param shapes_df: DF of trip shapes, from GTFS shapes.txt
+    :param shape_ids: shape IDs to summarize. If None, all shapes in
+        shapes_df are summarized.
+    :return: DataFrame indexed by shape_id with columns start_lat,
+        start_lon, end_lat, end_lon, and total_dist
+    """
+    if shape_ids is not None:
+        shapes_df = shapes_df[shapes_df['shape_id'].isin(shape_ids)]
+
+    codes, uniques = pd.factorize(shapes_df['shape_id'], sort=True)
+    order = np.lexsort((shapes_df['shape_pt_sequence'].to_numpy(), codes))
+    codes = codes[order]
+    lats = shapes_df['shape_pt_lat'].to_numpy(dtype=float)[order]
+    lons = shapes_df['shape_pt_lon'].to_numpy(dtype=float)[order]
+
+    # Index of first and last point of each shape in sorted arrays
+    if len(codes):
+        starts = np.flatnonzero(np.r_[True, codes[1:] != codes[:-1]])
+        ends = np.r_[starts[1:], len(codes)] - 1
+    else:
+        starts = ends = np.array([], dtype=int)
+
+    # Distance from each point to the one before it. The first point of
+    # each shape has no predecessor, so its distance is zero.
+    seq_dists = np.zeros(len(codes))
+    if len(codes) > 1:
+        seq_dists[1:] = haversine_np(lons[1:], lats[1:], lons[:-1], lats[:-1])
+    seq_dists[starts] = 0
+
+    total_dists = np.add.reduceat(seq_dists, starts) \
+        if len(starts) else np.array([])
+
+    return pd.DataFrame(
+        {
+            'start_lat': lats[starts],
+            'start_lon': lons[starts],
+            'end_lat': lats[ends],
+            'end_lon': lons[ends],
+            'total_dist': total_dists
+        },
+        index=pd.Index(np.asarray(uniques), name='shape_id')
     )
 
 
@@ -1081,6 +2046,10 @@ def get_dh_dict(
         charger_locs: list[tuple[float, float]],
         depot_coords: list[tuple[float, float]] | tuple[float, float] = None
         , osm_fname = None
+        , provider: DeadheadProvider = None
+        , registry: LocationRegistry = None
+        , stats: DeadheadStats = None
+        , dry_run: bool = False
 ) -> dict[
         tuple[tuple[float, float], tuple[float, float]],
         dict[str, float]
@@ -1096,9 +2065,17 @@ def get_dh_dict(
     :param trip_end_locs: list of trip end coordinates
     :param charger_locs: list of charger coordinates
     :param depot_coords: list or tuple of depot coordinates
+    :param osm_fname: filename of deadhead store
+    :param provider: :py:class:`DeadheadProvider` used to calculate
+        deadhead (OpenRouteService by default)
+    :param registry: optional :py:class:`LocationRegistry` used to
+        cluster nearby locations (see :py:func:`get_updated_osm_data`)
+    :param stats: optional :py:class:`DeadheadStats` to record cache
+        and API usage in (see :py:func:`get_deadhead_data`)
+    :param dry_run: if True, return the number of missing OD pairs and
+        the API calls needed to fetch them instead of the deadhead data
+        (see :py:func:`get_deadhead_data`)
     """
-    # Calculate all necessary distances. Uses two calls, but file is saved
-    # in between and reloaded so everything ends up in osm_charger_data.
     unique_start_locs = list(set(trip_start_locs))
     unique_end_locs = list(set(trip_end_locs))
     if depot_coords is not None:
@@ -1108,20 +2085,13 @@ def get_dh_dict(
             charger_locs = charger_locs + depot_coords
         else:
             raise TypeError('depot_coords must be list or tuple')
-    # Get distances from trip ends to chargers
-    # (note this function writes and reloads a file each time)
-    _ = get_updated_osm_data(
-        unique_end_locs, charger_locs
-        , filename=osm_fname
-    )
-    # Get distances from chargers to trip starts
-    _ = get_updated_osm_data(
-        charger_locs, unique_start_locs
-        , filename=osm_fname
-    )
-    # Get distances between trips
-    osm_charger_data = get_updated_osm_data(
-        unique_end_locs, unique_start_locs
-        , filename=osm_fname
+    # Get distances from trip ends to chargers, from chargers to trip
+    # starts, and between trips in a single lookup
+    osm_charger_data = get_deadhead_data(
+        [(unique_end_locs, charger_locs),
+         (charger_locs, unique_start_locs),
+         (unique_end_locs, unique_start_locs)]
+        , filename=osm_fname, provider=provider, registry=registry
+        , stats=stats, dry_run=dry_run
     )
     return osm_charger_data
@@ -0,0 +1,1142 @@
+import bz2
+import gzip
+import logging
+import os
+import pickle
+import random
+import re
+import sqlite3
+import threading
+import time
+import xml.etree.ElementTree as ET
+import numpy as np
+import pandas as pd
+import requests
+from pathlib import Path
+from dotenv import dotenv_values, find_dotenv
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from openrouteservice import client
+from openrouteservice import exceptions as ors_exceptions
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import dijkstra
+from scipy.spatial import cKDTree
+from beb_chargers.gtfs_beb.geo import haversine_np, haversine_pairwise, \
+    manhattan_pairwise
+
+logger = logging.getLogger('deadhead')
+
+# Default location of the deadhead store, and of the pickled dict it
+# replaces
+DEFAULT_STORE = (
+    Path(__file__).resolve().parent.parent / 'data' / 'osm'
+    / 'osm_charge_data.sqlite')
+LEGACY_PICKLE = DEFAULT_STORE.with_suffix('.pickle')
+
+
+class DeadheadStore:
+    """
+    On-disk store of deadhead distances and durations keyed by
+    (origin, destination) coordinate pairs.
+
+    Data is kept in a SQLite database with a primary key on the four
+    coordinates, so lookups only touch the requested pairs instead of
+    loading the whole cache. Writes are append-only: a pair that is
+    already stored is never overwritten. The database uses write-ahead
+    logging, so any number of processes can read while one writes.
+    Each process should open its own store rather than sharing one
+    across a fork.
+    """
+    def __init__(self, path, timeout=60.):
+        """
+        :param path: path to SQLite database file, created if needed
+        :param timeout: seconds to wait for a concurrent writer to
+            release its lock
+        """
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.conn = sqlite3.connect(str(self.path), timeout=timeout)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        with self.conn:
+            self.conn.execute(
+                'CREATE TABLE IF NOT EXISTS deadhead ('
+                'orig_lat REAL NOT NULL, orig_lon REAL NOT NULL, '
+                'dest_lat REAL NOT NULL, dest_lon REAL NOT NULL, '
+                'distance REAL, duration REAL, '
+                'PRIMARY KEY (orig_lat, orig_lon, dest_lat, dest_lon)'
+                ') WITHOUT ROWID')
+            self.conn.execute(
+                'CREATE TABLE IF NOT EXISTS imports ('
+                'source TEXT PRIMARY KEY, fingerprint TEXT)')
+        # Requested keys are staged in a temporary table and joined
+        # against the store, which is much faster than one query per
+        # pair for large batches
+        self.conn.execute(
+            'CREATE TEMP TABLE IF NOT EXISTS request ('
+            'orig_lat REAL, orig_lon REAL, dest_lat REAL, dest_lon REAL)')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __len__(self):
+        return self.conn.execute('SELECT COUNT(*) FROM deadhead').fetchone()[0]
+
+    def close(self):
+        self.conn.close()
+
+    @property
+    def nbytes(self):
+        """Size of the database in bytes, including uncheckpointed WAL
+        pages."""
+        page_count = self.conn.execute('PRAGMA page_count').fetchone()[0]
+        page_size = self.conn.execute('PRAGMA page_size').fetchone()[0]
+        return page_count * page_size
+
+    def get_many(self, pairs):
+        """
+        Look up deadhead data for a batch of coordinate pairs.
+
+        :param pairs: iterable of (orig, dest) tuples, where each of
+            orig and dest is a (lat, lon) tuple
+        :return: dict of {'distance', 'duration'} dicts keyed by
+            (orig, dest), for the requested pairs that are stored
+        """
+        keys = dict()
+        for (o, d) in pairs:
+            keys[float(o[0]), float(o[1]), float(d[0]), float(d[1])] = (o, d)
+        if not keys:
+            return dict()
+
+        with self.conn:
+            self.conn.execute('DELETE FROM request')
+            self.conn.executemany(
+                'INSERT INTO request VALUES (?, ?, ?, ?)', keys.keys())
+            rows = self.conn.execute(
+                'SELECT d.orig_lat, d.orig_lon, d.dest_lat, d.dest_lon, '
+                'd.distance, d.duration FROM request r JOIN deadhead d '
+                'ON d.orig_lat = r.orig_lat AND d.orig_lon = r.orig_lon '
+                'AND d.dest_lat = r.dest_lat AND d.dest_lon = r.dest_lon'
+            ).fetchall()
+            self.conn.execute('DELETE FROM request')
+
+        return {
+            keys[rw[:4]]: {'distance': rw[4], 'duration': rw[5]}
+            for rw in rows}
+
+    def put_many(self, dh_data):
+        """
+        Add deadhead data to the store. Pairs that are already stored
+        keep their existing values.
+
+        :param dh_data: dict of {'distance', 'duration'} dicts keyed by
+            (orig, dest) coordinate pairs
+        :return: number of pairs added
+        """
+        rows = [
+            (float(o[0]), float(o[1]), float(d[0]), float(d[1]),
+             v['distance'], v['duration'])
+            for (o, d), v in dh_data.items()]
+        with self.conn:
+            n_before = self.conn.total_changes
+            self.conn.executemany(
+                'INSERT OR IGNORE INTO deadhead VALUES (?, ?, ?, ?, ?, ?)',
+                rows)
+            return self.conn.total_changes - n_before
+
+    def to_dict(self):
+        """
+        Read the full store into a dict.
+
+        :return: dict of {'distance', 'duration'} dicts keyed by
+            (orig, dest)
+        """
+        rows = self.conn.execute('SELECT * FROM deadhead')
+        return {
+            ((rw[0], rw[1]), (rw[2], rw[3])): {
+                'distance': rw[4], 'duration': rw[5]}
+            for rw in rows}
+
+    def import_pickle(self, filename):
+        """
+        Add the contents of a pickled deadhead dict, as written by
+        earlier versions of :py:func:`get_updated_osm_data`. Each file
+        is only read again if it has changed since it was last
+        imported.
+
+        :param filename: path to pickle file
+        :return: number of pairs added
+        """
+        filename = Path(filename).resolve()
+        try:
+            stat = filename.stat()
+        except FileNotFoundError:
+            return 0
+
+        fingerprint = '{}:{}'.format(stat.st_size, stat.st_mtime_ns)
+        done = self.conn.execute(
+            'SELECT fingerprint FROM imports WHERE source = ?',
+            (str(filename),)).fetchone()
+        if done is not None and done[0] == fingerprint:
+            return 0
+
+        with open(filename, 'rb') as handle:
+            dh_data = pickle.load(handle)
+        n_added = self.put_many(dh_data)
+        with self.conn:
+            self.conn.execute(
+                'INSERT OR REPLACE INTO imports VALUES (?, ?)',
+                (str(filename), fingerprint))
+        logger.info('Imported {} deadhead pairs from {}'.format(
+            n_added, filename))
+        return n_added
+
+
+def open_deadhead_store(filename=None):
+    """
+    Open the deadhead store for the given cache filename.
+
+    For backwards compatibility, filename may point to a pickled dict
+    (ending in .pickle). In that case the store is kept next to it
+    with a .sqlite extension, and the pickle's contents are imported
+    into it the first time it is used (and again if the pickle is
+    modified).
+
+    :param filename: path to deadhead store or legacy pickle file, or
+        None to use the package default
+    :return: :py:class:`DeadheadStore`
+    """
+    if filename is None:
+        path = DEFAULT_STORE
+        legacy = LEGACY_PICKLE
+    else:
+        path = Path(filename)
+        legacy = None
+        if path.suffix == '.pickle':
+            legacy = path
+            path = path.with_suffix('.sqlite')
+
+    store = DeadheadStore(path)
+    if legacy is not None and os.path.exists(legacy):
+        store.import_pickle(legacy)
+    return store
+
+
+class DeadheadMatrix:
+    """
+    Dense matrix of deadhead distances (miles) and durations (minutes)
+    from a set of origins to a set of destinations.
+
+    Each origin and destination coordinate is mapped to a row or column
+    index, and values are kept in float32 arrays, so a pair takes 8
+    bytes instead of a dict entry holding a dict. Pairs that were never
+    calculated are NaN. Lookups for many pairs at once are done with
+    :py:meth:`get_indexer` and :py:meth:`gather`.
+    """
+    def __init__(self, origins, dests, distances, durations):
+        """
+        :param origins: list of (lat, lon) origin coordinates
+        :param dests: list of (lat, lon) destination coordinates
+        :param distances: array of distances with shape
+            (len(origins), len(dests))
+        :param durations: array of durations with the same shape
+        """
+        self.origins = [tuple(o) for o in origins]
+        self.dests = [tuple(d) for d in dests]
+        self.distances = distances
+        self.durations = durations
+        self.orig_index = {o: i for i, o in enumerate(self.origins)}
+        self.dest_index = {d: i for i, d in enumerate(self.dests)}
+        self._orig_mi = None
+        self._dest_mi = None
+
+    @classmethod
+    def from_dh_data(cls, dh_data, dtype=np.float32):
+        """
+        Build a matrix from a dict of deadhead data, as returned by
+        :py:func:`get_updated_osm_data` or :py:func:`get_dh_dict`.
+
+        :param dh_data: dict of {'distance', 'duration'} dicts keyed by
+            (orig, dest)
+        :param dtype: dtype of the value arrays
+        :return: DeadheadMatrix
+        """
+        origins = list(dict.fromkeys(o for (o, _) in dh_data))
+        dests = list(dict.fromkeys(d for (_, d) in dh_data))
+        orig_index = {o: i for i, o in enumerate(origins)}
+        dest_index = {d: i for i, d in enumerate(dests)}
+        rows = np.fromiter(
+            (orig_index[o] for (o, _) in dh_data), dtype=int,
+            count=len(dh_data))
+        cols = np.fromiter(
+            (dest_index[d] for (_, d) in dh_data), dtype=int,
+            count=len(dh_data))
+        distances = np.full((len(origins), len(dests)), np.nan, dtype=dtype)
+        durations = np.full((len(origins), len(dests)), np.nan, dtype=dtype)
+        distances[rows, cols] = [v['distance'] for v in dh_data.values()]
+        durations[rows, cols] = [v['duration'] for v in dh_data.values()]
+        return cls(origins, dests, distances, durations)
+
+    @classmethod
+    def from_frame(cls, df, dtype=np.float32):
+        """
+        Build a matrix from a DataFrame of deadhead data indexed by
+        (orig_lat, orig_lon, dest_lat, dest_lon) with distance and
+        duration columns.
+
+        :param df: DataFrame of deadhead data
+        :param dtype: dtype of the value arrays
+        :return: DeadheadMatrix
+        """
+        orig_codes, origins = pd.MultiIndex.from_arrays([
+            df.index.get_level_values(0), df.index.get_level_values(1)
+        ]).factorize()
+        dest_codes, dests = pd.MultiIndex.from_arrays([
+            df.index.get_level_values(2), df.index.get_level_values(3)
+        ]).factorize()
+        distances = np.full((len(origins), len(dests)), np.nan, dtype=dtype)
+        durations = np.full((len(origins), len(dests)), np.nan, dtype=dtype)
+        distances[orig_codes, dest_codes] = df['distance'].to_numpy()
+        durations[orig_codes, dest_codes] = df['duration'].to_numpy()
+        return cls(origins.tolist(), dests.tolist(), distances, durations)
+
+    def __len__(self):
+        return int(np.isfinite(self.distances).sum())
+
+    @property
+    def nbytes(self):
+        return self.distances.nbytes + self.durations.nbytes
+
+    def to_dict(self):
+        """
+        Convert to a dict of deadhead data keyed by (orig, dest).
+
+        :return: dict of {'distance', 'duration'} dicts
+        """
+        rows, cols = np.nonzero(np.isfinite(self.distances))
+        dists = self.distances[rows, cols].tolist()
+        durations = self.durations[rows, cols].tolist()
+        return {
+            (self.origins[i], self.dests[j]): {
+                'distance': dist, 'duration': dur}
+            for i, j, dist, dur in zip(
+                rows.tolist(), cols.tolist(), dists, durations)}
+
+    def to_frame(self):
+        """
+        Convert to a DataFrame indexed by (orig_lat, orig_lon, dest_lat,
+        dest_lon) with distance and duration columns. Values are
+        float64 whatever the matrix dtype, like the frames this replaces.
+
+        :return: DataFrame of deadhead data
+        """
+        rows, cols = np.nonzero(np.isfinite(self.distances))
+        orig = np.asarray(self.origins, dtype=float).reshape(-1, 2)[rows]
+        dest = np.asarray(self.dests, dtype=float).reshape(-1, 2)[cols]
+        index = pd.MultiIndex.from_arrays(
+            [orig[:, 0], orig[:, 1], dest[:, 0], dest[:, 1]],
+            names=['orig_lat', 'orig_lon', 'dest_lat', 'dest_lon'])
+        return pd.DataFrame({
+            'distance': self.distances[rows, cols].astype(float),
+            'duration': self.durations[rows, cols].astype(float)},
+            index=index)
+
+    def get_indexer(self, lats, lons, dest=False):
+        """
+        Get the row (or column) index of each coordinate.
+
+        :param lats: array of latitudes
+        :param lons: array of longitudes
+        :param dest: True to look up destinations rather than origins
+        :return: int array of indices, -1 where a coordinate is unknown
+        """
+        if dest:
+            if self._dest_mi is None:
+                self._dest_mi = pd.MultiIndex.from_tuples(
+                    self.dests, names=['lat', 'lon'])
+            mi = self._dest_mi
+        else:
+            if self._orig_mi is None:
+                self._orig_mi = pd.MultiIndex.from_tuples(
+                    self.origins, names=['lat', 'lon'])
+            mi = self._orig_mi
+        return mi.get_indexer(pd.MultiIndex.from_arrays(
+            [np.asarray(lats, dtype=float), np.asarray(lons, dtype=float)]))
+
+    def gather(self, orig_ix, dest_ix):
+        """
+        Get deadhead for arrays of origin and destination indices.
+
+        :param orig_ix: array of origin (row) indices
+        :param dest_ix: array of destination (column) indices, which
+            is broadcast against orig_ix
+        :return: tuple of (distance, duration) arrays, NaN where either
+            index is -1 or the pair was not calculated
+        """
+        orig_ix, dest_ix = np.broadcast_arrays(orig_ix, dest_ix)
+        found = (orig_ix >= 0) & (dest_ix >= 0)
+        dists = np.full(orig_ix.shape, np.nan, dtype=self.distances.dtype)
+        durations = np.full(orig_ix.shape, np.nan, dtype=self.durations.dtype)
+        dists[found] = self.distances[orig_ix[found], dest_ix[found]]
+        durations[found] = self.durations[orig_ix[found], dest_ix[found]]
+        return dists, durations
+
+    def get_block(self, origins, dests):
+        """
+        Get deadhead between every one of the given origins and
+        destinations.
+
+        :param origins: list of (lat, lon) origin coordinates
+        :param dests: list of (lat, lon) destination coordinates
+        :return: tuple of (distance, duration) arrays of shape
+            (len(origins), len(dests))
+        """
+        rows = np.array(
+            [self.orig_index[tuple(o)] for o in origins], dtype=int)
+        cols = np.array(
+            [self.dest_index[tuple(d)] for d in dests], dtype=int)
+        ix = np.ix_(rows, cols)
+        return self.distances[ix], self.durations[ix]
+
+    def lookup(self, orig, dest):
+        """
+        Get deadhead between a single pair of coordinates.
+
+        :param orig: (lat, lon) origin
+        :param dest: (lat, lon) destination
+        :return: dict of distance and duration
+        """
+        i = self.orig_index[tuple(orig)]
+        j = self.dest_index[tuple(dest)]
+        dist = self.distances[i, j]
+        if np.isnan(dist):
+            raise KeyError((orig, dest))
+        return {'distance': float(dist),
+                'duration': float(self.durations[i, j])}
+
+    def save(self, path):
+        """
+        Save the matrix to a directory of .npy files that
+        :py:meth:`load` can memory-map.
+
+        :param path: directory to write to
+        """
+        path = Path(path)
+        path.mkdir(parents=True, exist_ok=True)
+        np.save(path / 'origins.npy',
+                np.asarray(self.origins, dtype=float).reshape(-1, 2))
+        np.save(path / 'dests.npy',
+                np.asarray(self.dests, dtype=float).reshape(-1, 2))
+        np.save(path / 'distances.npy', self.distances)
+        np.save(path / 'durations.npy', self.durations)
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        """
+        Load a matrix saved by :py:meth:`save`. With mmap, the value
+        arrays are memory-mapped read-only, so processes that load the
+        same matrix share its pages.
+
+        :param path: directory the matrix was saved to
+        :param mmap: True to memory-map the value arrays
+        :return: DeadheadMatrix
+        """
+        path = Path(path)
+        mmap_mode = 'r' if mmap else None
+        return cls(
+            [tuple(o) for o in np.load(path / 'origins.npy').tolist()],
+            [tuple(d) for d in np.load(path / 'dests.npy').tolist()],
+            np.load(path / 'distances.npy', mmap_mode=mmap_mode),
+            np.load(path / 'durations.npy', mmap_mode=mmap_mode))
+
+
+class DeadheadProvider:
+    """
+    Source of deadhead distances (in miles) and durations (in minutes)
+    between coordinates.
+
+    Subclasses implement :py:meth:`get_matrix`. Providers that are
+    expensive or rate-limited set cacheable to True so that
+    :py:func:`get_updated_osm_data` keeps their results in the deadhead
+    store and only requests missing pairs.
+    """
+    #: Whether results should be saved in the deadhead store
+    cacheable = False
+    #: Maximum number of origin-destination pairs per request, or None
+    #: if unlimited
+    max_elements = None
+    #: Maximum number of requests per minute, or None if unlimited
+    requests_per_minute = None
+    #: Exceptions after which a request may succeed if retried (see
+    #: :py:meth:`is_transient`)
+    transient_errors = ()
+
+    def is_transient(self, error):
+        """
+        :param error: exception raised by a request
+        :return: True if the request may succeed if retried
+        """
+        return isinstance(error, self.transient_errors)
+
+    def get_matrix(self, origins, dests):
+        """
+        Get deadhead between every origin and destination.
+
+        :param origins: list of (lat, lon) origin coordinates
+        :param dests: list of (lat, lon) destination coordinates
+        :return: tuple of (distance, duration) arrays of shape
+            (len(origins), len(dests))
+        """
+        raise NotImplementedError
+
+    def get_dh_data(self, origins, dests):
+        """
+        Get deadhead between every origin and destination as a dict.
+
+        :param origins: list of (lat, lon) origin coordinates
+        :param dests: list of (lat, lon) destination coordinates
+        :return: dict of {'distance', 'duration'} dicts keyed by
+            (orig, dest)
+        """
+        dists, durations = self.get_matrix(origins, dests)
+        dists = dists.tolist()
+        durations = durations.tolist()
+        out_dict = dict()
+        for i, o in enumerate(origins):
+            for j, d in enumerate(dests):
+                out_dict[tuple(o), tuple(d)] = {
+                    'distance': dists[i][j], 'duration': durations[i][j]}
+        return out_dict
+
+
+def _coord_arrays(coords):
+    coords = np.asarray(coords, dtype=float).reshape(-1, 2)
+    return coords[:, 0], coords[:, 1]
+
+
+class StraightLineProvider(DeadheadProvider):
+    """
+    Deadhead estimated from straight-line distance between points at a
+    constant speed. Needs no network access.
+    """
+    def __init__(self, speed_mph=20., metric='manhattan', circuity=1.):
+        """
+        :param speed_mph: assumed average speed in miles per hour
+        :param metric: 'manhattan' or 'haversine'
+        :param circuity: factor applied to the straight-line distance
+            to account for indirect routes
+        """
+        if metric not in ('manhattan', 'haversine'):
+            raise ValueError('metric must be "manhattan" or "haversine"')
+        self.speed_mph = speed_mph
+        self.metric = metric
+        self.circuity = circuity
+
+    def get_matrix(self, origins, dests):
+        o_lat, o_lon = _coord_arrays(origins)
+        d_lat, d_lon = _coord_arrays(dests)
+        dist_fn = manhattan_pairwise if self.metric == 'manhattan' \
+            else haversine_pairwise
+        dists = self.circuity * dist_fn(o_lon, o_lat, d_lon, d_lat)
+        return dists, dists * 60 / self.speed_mph
+
+    def get_geometry(self, orig, dest):
+        """
+        Get the path assumed between two points, for plotting.
+
+        :param orig: origin (lat, lon) tuple
+        :param dest: destination (lat, lon) tuple
+        :return: float32 array of (lat, lon) points along the path:
+            a straight line, or for the Manhattan metric, east-west
+            then north-south
+        """
+        if self.metric == 'manhattan':
+            points = [orig, (orig[0], dest[1]), dest]
+        else:
+            points = [orig, dest]
+        return np.array(points, dtype=np.float32)
+
+
+class ORSProvider(DeadheadProvider):
+    """
+    Driving deadhead from the OpenRouteService matrix API. Pairs that
+    ORS can't route fall back to Manhattan distance at 20 mph.
+    """
+    cacheable = True
+    max_elements = 3500
+    # Matrix limit of the free ORS plan
+    requests_per_minute = 40
+    transient_errors = (
+        ors_exceptions.ApiError, ors_exceptions.Timeout,
+        ors_exceptions.HTTPError, requests.exceptions.ConnectionError)
+
+    def __init__(self, key=None, profile='driving-hgv', base_url=None):
+        """
+        :param key: ORS API key. If None, ORS_KEY is read from the .env
+            file (unless base_url points to another server).
+        :param profile: ORS routing profile
+        :param base_url: URL of the ORS server, if not the public API
+            (e.g. a self-hosted instance or :py:class:`MockMatrixServer`)
+        """
+        self.key = key
+        self.profile = profile
+        self.base_url = base_url
+        self.fallback = StraightLineProvider(speed_mph=20.)
+        # One client (and so one pooled HTTP session) per thread
+        self._local = threading.local()
+
+    def is_transient(self, error):
+        """
+        :param error: exception raised by a request
+        :return: True if the request may succeed if retried: rate
+            limit (HTTP 429) and server (5xx) errors, timeouts and
+            connection errors. Other HTTP errors, like a bad key or a
+            request that is too large, are permanent.
+        """
+        if isinstance(error, ors_exceptions.ApiError):
+            return error.status == 429 or error.status >= 500
+        if isinstance(error, ors_exceptions.HTTPError):
+            return error.status_code == 429 or error.status_code >= 500
+        return isinstance(error, self.transient_errors)
+
+    def get_client(self):
+        ors = getattr(self._local, 'client', None)
+        if ors is None:
+            if self.key is None and self.base_url is None:
+                try:
+                    config = dotenv_values(find_dotenv())
+                    self.key = config['ORS_KEY']
+                except KeyError:
+                    raise KeyError(
+                        'No Openrouteservice key found in .env file. For '
+                        'more information, please see the project README '
+                        'file.'
+                    )
+            kwargs = dict() if self.base_url is None \
+                else {'base_url': self.base_url}
+            # Rate limiting is left to BatchFetcher
+            ors = client.Client(
+                key=self.key, retry_over_query_limit=False, **kwargs)
+            self._local.client = ors
+        return ors
+
+    def get_matrix(self, origins, dests):
+        # ORS uses reverse coordinate order (lon, then lat)
+        orig_list_osm = [list(reversed(o)) for o in origins]
+        dest_list_osm = [list(reversed(d)) for d in dests]
+        orig_ix = list(range(len(orig_list_osm)))
+        dest_ix = [len(orig_list_osm) + i for i in range(len(dest_list_osm))]
+        logger.info('OSM request: {} origins, {} destinations ({} total '
+                    'routes)'.format(len(orig_ix), len(dest_ix),
+                                     len(orig_ix)*len(dest_ix)))
+        res = self.get_client().distance_matrix(
+            profile=self.profile, metrics=['duration', 'distance'],
+            locations=orig_list_osm + dest_list_osm, sources=orig_ix,
+            destinations=dest_ix)
+
+        # Convert from meters to miles and from seconds to minutes.
+        # Sometimes ORS returns None for distance/duration, which
+        # becomes NaN here.
+        dists = np.array(res['distances'], dtype=float) / 1609
+        durations = np.array(res['durations'], dtype=float) / 60
+        missing = np.isnan(dists) | np.isnan(durations)
+        if missing.any():
+            fb_dists, fb_durations = self.fallback.get_matrix(origins, dests)
+            dists[missing] = fb_dists[missing]
+            durations[missing] = fb_durations[missing]
+        return dists, durations
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket rate limiter. Tokens are added at a fixed
+    rate up to the bucket's capacity, and each request takes one.
+    """
+    def __init__(self, rate, capacity=1.):
+        """
+        :param rate: tokens added per second
+        :param capacity: maximum number of tokens, i.e. the largest
+            burst of requests allowed at once
+        """
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Block until a token is available, then take it."""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(
+                    self.capacity,
+                    self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class DeadheadStats:
+    """
+    Thread-safe counters describing deadhead lookups: store hits and
+    misses, API calls made (including retries), routes requested from
+    the provider, seconds spent fetching, and the size of the store in
+    bytes after the last lookup.
+    """
+    fields = ('hits', 'misses', 'api_calls', 'retries', 'routes_requested',
+              'seconds', 'bytes_stored')
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def __repr__(self):
+        return 'DeadheadStats({})'.format(', '.join(
+            '{}={}'.format(k, v) for k, v in self.as_dict().items()))
+
+    def reset(self):
+        """Set all counters to zero."""
+        with self.lock:
+            for k in self.fields:
+                setattr(self, k, 0)
+
+    def add(self, **counts):
+        """
+        Increment counters.
+
+        :param counts: amounts to add, keyed by counter name
+        """
+        with self.lock:
+            for k, v in counts.items():
+                if k not in self.fields:
+                    raise KeyError('Unrecognized counter: {}'.format(k))
+                setattr(self, k, getattr(self, k) + v)
+
+    def as_dict(self):
+        """
+        :return: dict of counter values keyed by name
+        """
+        with self.lock:
+            return {k: getattr(self, k) for k in self.fields}
+
+
+# Counters updated by every deadhead lookup that isn't given its own
+DEFAULT_STATS = DeadheadStats()
+
+
+class BatchFetcher:
+    """
+    Fetch a large deadhead matrix from a provider as concurrent chunked
+    requests.
+
+    Origins are split into chunks that fit the provider's request size
+    limit. Chunks are requested from a thread pool, throttled by a
+    token bucket, and retried with exponential backoff after transient
+    errors. Each chunk is handed to a callback as soon as it arrives,
+    so a failure partway through keeps the chunks already fetched.
+    """
+    def __init__(self, provider, workers=4, requests_per_minute=None,
+                 max_retries=4, backoff=2.):
+        """
+        :param provider: :py:class:`DeadheadProvider` to fetch from
+        :param workers: maximum number of requests in flight
+        :param requests_per_minute: request rate limit. Defaults to the
+            provider's limit.
+        :param max_retries: number of times a chunk is retried after a
+            transient error before giving up
+        :param backoff: delay in seconds before the first retry, which
+            doubles (with jitter) for each later retry
+        """
+        self.provider = provider
+        self.workers = workers
+        if requests_per_minute is None:
+            requests_per_minute = provider.requests_per_minute
+        self.bucket = None if requests_per_minute is None \
+            else TokenBucket(requests_per_minute / 60)
+        self.max_retries = max_retries
+        self.backoff = backoff
+
+    def split(self, origins, dests):
+        """
+        Split origins into chunks that don't exceed the provider's
+        request size limit.
+
+        :param origins: list of origin coordinates
+        :param dests: list of destination coordinates
+        :return: list of lists of origins
+        """
+        max_elements = self.provider.max_elements
+        if max_elements is None or len(origins) * len(dests) <= max_elements:
+            return [origins]
+
+        if len(dests) >= max_elements:
+            raise ValueError('Too many destinations to make any API calls.')
+        n_orig_per_call = max_elements // len(dests)
+        return [origins[i:i + n_orig_per_call]
+                for i in range(0, len(origins), n_orig_per_call)]
+
+    def _fetch_chunk(self, origins, dests, stats=None):
+        for attempt in range(self.max_retries + 1):
+            if self.bucket is not None:
+                self.bucket.acquire()
+            if stats is not None:
+                stats.add(api_calls=1,
+                          routes_requested=len(origins) * len(dests))
+            try:
+                return self.provider.get_dh_data(origins, dests)
+            except self.provider.transient_errors as e:
+                if attempt == self.max_retries \
+                        or not self.provider.is_transient(e):
+                    raise
+                if stats is not None:
+                    stats.add(retries=1)
+                delay = self.backoff * 2 ** attempt * (0.5 + random.random())
+                logger.warning(
+                    'Deadhead request failed ({!r}). Retrying in {:.1f} '
+                    'seconds.'.format(e, delay))
+                time.sleep(delay)
+
+    def n_calls(self, requests):
+        """
+        Count the requests needed to fetch the given matrices, not
+        including retries.
+
+        :param requests: list of (origins, dests) tuples
+        :return: number of requests
+        """
+        return sum(len(self.split(o, d)) for o, d in requests)
+
+    def fetch(self, origins, dests, on_chunk=None, stats=None):
+        """
+        Fetch deadhead between every origin and destination.
+
+        :param origins: list of origin coordinates
+        :param dests: list of destination coordinates
+        :param on_chunk: optional function called with the dict of
+            deadhead data from each chunk as it arrives, in the calling
+            thread (e.g. to save it)
+        :param stats: optional :py:class:`DeadheadStats` to count API
+            calls in
+        :return: dict of {'distance', 'duration'} dicts keyed by
+            (orig, dest)
+        """
+        return self.fetch_many(
+            [(origins, dests)], on_chunk=on_chunk, stats=stats)
+
+    def fetch_many(self, requests, on_chunk=None, stats=None):
+        """
+        Fetch several rectangular deadhead matrices, sharing one pool
+        and rate limit.
+
+        :param requests: list of (origins, dests) tuples
+        :param on_chunk: optional function called with the dict of
+            deadhead data from each chunk as it arrives, in the calling
+            thread (e.g. to save it)
+        :param stats: optional :py:class:`DeadheadStats` to count API
+            calls in
+        :return: dict of {'distance', 'duration'} dicts keyed by
+            (orig, dest)
+        """
+        chunks = [
+            (chunk, dests) for origins, dests in requests
+            for chunk in self.split(origins, dests)]
+        if not chunks:
+            return dict()
+        if len(chunks) > 1:
+            logger.info(
+                '{} unique route requests. {} API calls required.'.format(
+                    sum(len(o) * len(d) for o, d in requests), len(chunks)))
+
+        dh_data = dict()
+        executor = ThreadPoolExecutor(min(self.workers, len(chunks)))
+        try:
+            futures = [
+                executor.submit(self._fetch_chunk, chunk, dests, stats)
+                for chunk, dests in chunks]
+            for c, future in enumerate(as_completed(futures)):
+                chunk_data = future.result()
+                logger.info('API request {} of {} complete.'.format(
+                    c + 1, len(chunks)))
+                if on_chunk is not None:
+                    on_chunk(chunk_data)
+                dh_data.update(chunk_data)
+        finally:
+            executor.shutdown(cancel_futures=True)
+        return dh_data
+
+
+def _n_calls(n_orig, n_dest, max_elements):
+    """Number of requests needed for an n_orig x n_dest matrix."""
+    if max_elements is None:
+        return 1
+    return -(-n_orig // max(1, max_elements // n_dest))
+
+
+def plan_requests(pairs, max_elements=None):
+    """
+    Group OD pairs into rectangular (origins x destinations) matrix
+    requests.
+
+    Origins that need the same set of destinations are grouped into
+    one rectangle, which covers exactly their pairs. Rectangles are
+    then merged greedily, largest first, whenever the merged rectangle
+    needs no more requests than the two separately; the extra pairs
+    this fetches fill capacity that would otherwise go unused.
+
+    :param pairs: iterable of (orig, dest) coordinate pairs
+    :param max_elements: maximum number of pairs per request, or None
+        if unlimited
+    :return: list of (origins, dests) tuples
+    """
+    dests_by_orig = dict()
+    for o, d in pairs:
+        dests_by_orig.setdefault(o, set()).add(d)
+    groups = dict()
+    for o, dests in dests_by_orig.items():
+        groups.setdefault(frozenset(dests), list()).append(o)
+
+    rects = list()
+    for dests, origins in sorted(
+            groups.items(), key=lambda g: -len(g[0]) * len(g[1])):
+        for r, (r_origins, r_dests) in enumerate(rects):
+            merged_dests = r_dests | dests
+            if max_elements is not None \
+                    and len(merged_dests) >= max_elements:
+                continue
+            n_sep = _n_calls(len(r_origins), len(r_dests), max_elements) \
+                + _n_calls(len(origins), len(dests), max_elements)
+            n_merged = _n_calls(
+                len(r_origins) + len(origins), len(merged_dests),
+                max_elements)
+            if n_merged <= n_sep - 1 or (
+                    n_merged <= n_sep and merged_dests == r_dests):
+                rects[r] = (r_origins + origins, merged_dests)
+                break
+        else:
+            rects.append((list(origins), set(dests)))
+
+    return [(origins, list(dests)) for origins, dests in rects]
+
+
+# Default speeds (mph) of drivable OSM highway types, used when a way
+# has no usable maxspeed tag
+ROAD_SPEEDS = {
+    'motorway': 55., 'motorway_link': 35., 'trunk': 45., 'trunk_link': 30.,
+    'primary': 35., 'primary_link': 25., 'secondary': 30.,
+    'secondary_link': 25., 'tertiary': 25., 'tertiary_link': 20.,
+    'unclassified': 20., 'residential': 20., 'living_street': 10.,
+    'service': 10., 'busway': 25., 'bus_guideway': 25., 'road': 20.
+}
+
+
+def _parse_maxspeed(tag):
+    """Parse an OSM maxspeed tag into mph, or None if not numeric."""
+    if tag is None:
+        return None
+    match = re.match(r'^\s*(\d+(?:\.\d+)?)\s*(mph)?', tag)
+    if match is None:
+        return None
+    speed = float(match.group(1))
+    return speed if match.group(2) else speed / 1.609
+
+
+def _open_osm(filename):
+    filename = str(filename)
+    if filename.endswith('.gz'):
+        return gzip.open(filename, 'rb')
+    if filename.endswith('.bz2'):
+        return bz2.open(filename, 'rb')
+    if filename.endswith('.pbf'):
+        raise ValueError(
+            'PBF extracts are not supported. Convert to OSM XML first, '
+            'e.g. with osmium cat.')
+    return open(filename, 'rb')
+
+
+class RoadGraphProvider(DeadheadProvider):
+    """
+    Offline driving deadhead from a road network loaded from an OSM XML
+    extract (.osm, optionally gzip- or bzip2-compressed).
+
+    The network is stored as a compressed sparse row (CSR) graph
+    weighted by travel time. Coordinates are snapped to their nearest
+    road node, and full OD matrices are computed with one Dijkstra pass
+    per unique origin node. Distances are measured along the fastest
+    path, plus the straight-line distance between each coordinate and
+    its snapped node. Pairs with no route fall back to Manhattan
+    distance at 20 mph, as with ORS.
+    """
+    def __init__(self, osm_file, speeds=None, source_chunk_size=None):
+        """
+        :param osm_file: path to OSM XML extract
+        :param speeds: dict of default speeds (mph) by highway type,
+            which also determines the drivable highway types. Defaults
+            to ROAD_SPEEDS.
+        :param source_chunk_size: number of origins routed at a time.
+            By default, chosen to bound memory use on large graphs.
+        """
+        self.osm_file = osm_file
+        self.speeds = ROAD_SPEEDS if speeds is None else speeds
+        self.fallback = StraightLineProvider(speed_mph=20.)
+        self._load_graph()
+        n_nodes = len(self.node_lats)
+        if source_chunk_size is None:
+            source_chunk_size = max(1, 4_000_000 // max(n_nodes, 1))
+        self.source_chunk_size = source_chunk_size
+
+    def _load_graph(self):
+        node_coords = dict()
+        ways = list()
+        with _open_osm(self.osm_file) as f:
+            for _, elem in ET.iterparse(f, events=('end',)):
+                if elem.tag == 'node':
+                    node_coords[int(elem.get('id'))] = (
+                        float(elem.get('lat')), float(elem.get('lon')))
+                elif elem.tag == 'way':
+                    tags = {
+                        t.get('k'): t.get('v') for t in elem.iter('tag')}
+                    highway = tags.get('highway')
+                    if highway in self.speeds:
+                        refs = [int(nd.get('ref')) for nd in elem.iter('nd')]
+                        ways.append((refs, highway, tags))
+                else:
+                    continue
+                elem.clear()
+
+        from_ids = list()
+        to_ids = list()
+        speeds = list()
+        for refs, highway, tags in ways:
+            refs = [r for r in refs if r in node_coords]
+            if len(refs) < 2:
+                continue
+            speed = _parse_maxspeed(tags.get('maxspeed')) \
+                or self.speeds[highway]
+            oneway = tags.get('oneway')
+            if oneway is None and (
+                    highway == 'motorway'
+                    or tags.get('junction') in ('roundabout', 'circular')):
+                oneway = 'yes'
+            if oneway == '-1':
+                refs = refs[::-1]
+            n_seg = len(refs) - 1
+            from_ids += refs[:-1]
+            to_ids += refs[1:]
+            if oneway not in ('yes', 'true', '1', '-1'):
+                from_ids += refs[1:]
+                to_ids += refs[:-1]
+                n_seg *= 2
+            speeds += [speed] * n_seg
+        if not from_ids:
+            raise ValueError(
+                'No drivable roads found in {}'.format(self.osm_file))
+
+        # Compact node index over nodes that are on drivable roads
+        node_ids, codes = np.unique(
+            np.array(from_ids + to_ids, dtype=np.int64), return_inverse=True)
+        n_edges = len(from_ids)
+        src = codes[:n_edges]
+        dst = codes[n_edges:]
+        coords = np.array([node_coords[i] for i in node_ids.tolist()])
+        self.node_lats = coords[:, 0]
+        self.node_lons = coords[:, 1]
+        lengths = haversine_np(
+            self.node_lons[src], self.node_lats[src],
+            self.node_lons[dst], self.node_lats[dst])
+        times = lengths / np.array(speeds) * 60
+        # Zero weights would be dropped from the sparse graph
+        times = np.maximum(times, 1e-9)
+
+        # Keep only the fastest of any parallel edges, sorted by
+        # (src, dst) to match CSR order
+        n_nodes = len(node_ids)
+        keys = src * n_nodes + dst
+        order = np.lexsort((times, keys))
+        keys = keys[order]
+        first = np.r_[True, keys[1:] != keys[:-1]]
+        order = order[first]
+        self.edge_keys = keys[first]
+        self.edge_lengths = lengths[order]
+        self.graph = csr_matrix(
+            (times[order], (src[order], dst[order])),
+            shape=(n_nodes, n_nodes))
+
+        # Snap in an equirectangular projection around the network
+        self._lon_scale = np.cos(np.radians(self.node_lats.mean()))
+        self._tree = cKDTree(np.column_stack(
+            [self.node_lats, self.node_lons * self._lon_scale]))
+        logger.info('Loaded road graph with {} nodes and {} edges from '
+                    '{}'.format(n_nodes, len(self.edge_keys), self.osm_file))
+
+    def snap(self, coords):
+        """
+        Find the nearest road node to each coordinate.
+
+        :param coords: list of (lat, lon) coordinates
+        :return: tuple of (node indices, distance in miles to each node)
+        """
+        lats, lons = _coord_arrays(coords)
+        _, nodes = self._tree.query(
+            np.column_stack([lats, lons * self._lon_scale]))
+        snap_dists = haversine_np(
+            lons, lats, self.node_lons[nodes], self.node_lats[nodes])
+        return nodes, snap_dists
+
+    def _path_lengths(self, preds):
+        """
+        Get the length of each node's path from the source of its
+        shortest path tree, by pointer jumping over the predecessor
+        arrays returned by Dijkstra (one row per source).
+        """
+        n_nodes = preds.shape[1]
+        nodes = np.broadcast_to(np.arange(n_nodes), preds.shape)
+        # Roots and unreachable nodes point to themselves
+        has_pred = preds >= 0
+        ptrs = np.where(has_pred, preds, nodes)
+        lens = np.zeros(preds.shape)
+        edge_ix = np.searchsorted(
+            self.edge_keys, ptrs[has_pred] * n_nodes + nodes[has_pred])
+        lens[has_pred] = self.edge_lengths[edge_ix]
+        rows = np.arange(preds.shape[0])[:, None]
+        while True:
+            next_ptrs = ptrs[rows, ptrs]
+            lens = lens + np.where(ptrs != nodes, lens[rows, ptrs], 0)
+            if (next_ptrs == ptrs).all():
+                return lens
+            ptrs = next_ptrs
+
+    def get_matrix(self, origins, dests):
+        orig_nodes, orig_snap = self.snap(origins)
+        dest_nodes, dest_snap = self.snap(dests)
+        src_nodes, src_inv = np.unique(orig_nodes, return_inverse=True)
+
+        node_times = np.empty((len(src_nodes), len(dest_nodes)))
+        node_dists = np.empty((len(src_nodes), len(dest_nodes)))
+        for i in range(0, len(src_nodes), self.source_chunk_size):
+            chunk = src_nodes[i:i + self.source_chunk_size]
+            times, preds = dijkstra(
+                self.graph, indices=chunk, return_predecessors=True)
+            node_times[i:i + len(chunk)] = times[:, dest_nodes]
+            node_dists[i:i + len(chunk)] = self._path_lengths(
+                preds)[:, dest_nodes]
+
+        # Access legs between each coordinate and its road node, at the
+        # slowest road speed
+        access = orig_snap[:, None] + dest_snap[None, :]
+        dists = node_dists[src_inv] + access
+        durations = node_times[src_inv] + access * 60 / min(
+            self.speeds.values())
+        missing = ~np.isfinite(durations)
+        if missing.any():
+            logger.warning('No road route for {} OD pairs. Using Manhattan '
+                           'distance instead.'.format(missing.sum()))
+            fb_dists, fb_durations = self.fallback.get_matrix(origins, dests)
+            dists[missing] = fb_dists[missing]
+            durations[missing] = fb_durations[missing]
+        return dists, durations
@@ -0,0 +1,235 @@
+import logging
+import pickle
+import sqlite3
+import threading
+import numpy as np
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+from googlemaps import convert
+from googlemaps import exceptions as gmaps_exceptions
+from beb_chargers.gtfs_beb.data import get_gmaps_client, get_gmap_directions
+from beb_chargers.gtfs_beb.deadhead import StraightLineProvider
+
+logger = logging.getLogger('directions')
+
+# Default location of the directions cache, and of the pickled dict of
+# encoded polylines it replaces
+DEFAULT_DIRECTIONS = (
+    Path(__file__).resolve().parent.parent / 'vis' / 'data' / 'gmaps'
+    / 'deadhead_directions.sqlite')
+LEGACY_DIRECTIONS = DEFAULT_DIRECTIONS.with_suffix('.pickle')
+
+
+def decode_polyline(points):
+    """
+    Decode a Google encoded polyline.
+
+    :param points: encoded polyline string
+    :return: float32 array of (lat, lon) points
+    """
+    decoded = convert.decode_polyline(points)
+    return np.array(
+        [(pt['lat'], pt['lng']) for pt in decoded],
+        dtype=np.float32).reshape(-1, 2)
+
+
+class DirectionsCache:
+    """
+    On-disk cache of driving directions between (origin, destination)
+    coordinate pairs, for plotting deadhead on maps.
+
+    Directions come from Google Maps and are stored in a SQLite
+    database as decoded float32 (lat, lon) arrays, so they can be
+    plotted without decoding polylines again. Missing directions are
+    requested concurrently by :py:meth:`prefetch`. When Google Maps
+    can't be reached (or no key is configured), the offline provider's
+    geometry is used instead and not cached, so it is replaced by real
+    directions the next time the network is available.
+    """
+    # Errors that mean directions are currently unavailable, as opposed
+    # to bugs
+    unavailable_errors = (
+        KeyError, IndexError, gmaps_exceptions.TransportError,
+        gmaps_exceptions.Timeout, gmaps_exceptions.HTTPError)
+
+    def __init__(self, path=None, fallback=None, workers=4, key=None):
+        """
+        :param path: path to SQLite database file, created if needed,
+            or None to use the package default. For backwards
+            compatibility, this may point to a pickled dict of encoded
+            polylines (ending in .pickle), in which case the database
+            is kept next to it and the pickle is also searched.
+        :param fallback: provider with a get_geometry(orig, dest)
+            method used when directions are unavailable. Defaults to
+            :py:class:`StraightLineProvider`.
+        :param workers: maximum number of directions requests in flight
+        :param key: Google Maps API key. If None, GMAPS_KEY is read
+            from the .env file.
+        """
+        if path is None:
+            path = DEFAULT_DIRECTIONS
+            legacy = LEGACY_DIRECTIONS
+        else:
+            path = Path(path)
+            legacy = None
+            if path.suffix == '.pickle':
+                legacy = path
+                path = path.with_suffix('.sqlite')
+        self.path = path
+        self.legacy_path = legacy
+        self._legacy = None
+        self.fallback = StraightLineProvider() if fallback is None \
+            else fallback
+        self.workers = workers
+        self.key = key
+        # One client (and so one pooled HTTP session) per thread
+        self._local = threading.local()
+
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.conn = sqlite3.connect(str(self.path), timeout=60.)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        with self.conn:
+            self.conn.execute(
+                'CREATE TABLE IF NOT EXISTS directions ('
+                'orig_lat REAL NOT NULL, orig_lon REAL NOT NULL, '
+                'dest_lat REAL NOT NULL, dest_lon REAL NOT NULL, '
+                'points BLOB NOT NULL, '
+                'PRIMARY KEY (orig_lat, orig_lon, dest_lat, dest_lon)'
+                ') WITHOUT ROWID')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __len__(self):
+        return self.conn.execute(
+            'SELECT COUNT(*) FROM directions').fetchone()[0]
+
+    def close(self):
+        self.conn.close()
+
+    def get_many(self, pairs):
+        """
+        Look up cached directions.
+
+        :param pairs: iterable of (orig, dest) tuples, where each of
+            orig and dest is a (lat, lon) tuple
+        :return: dict of (lat, lon) arrays keyed by (orig, dest), for
+            the requested pairs that are cached
+        """
+        found = dict()
+        for o, d in pairs:
+            row = self.conn.execute(
+                'SELECT points FROM directions WHERE orig_lat = ? AND '
+                'orig_lon = ? AND dest_lat = ? AND dest_lon = ?',
+                (float(o[0]), float(o[1]), float(d[0]), float(d[1]))
+            ).fetchone()
+            if row is not None:
+                found[o, d] = np.frombuffer(
+                    row[0], dtype=np.float32).reshape(-1, 2)
+        return found
+
+    def put_many(self, geometries):
+        """
+        Add directions to the cache. Pairs that are already cached keep
+        their existing directions.
+
+        :param geometries: dict of (lat, lon) arrays keyed by
+            (orig, dest)
+        """
+        with self.conn:
+            self.conn.executemany(
+                'INSERT OR IGNORE INTO directions VALUES (?, ?, ?, ?, ?)',
+                [(float(o[0]), float(o[1]), float(d[0]), float(d[1]),
+                  np.ascontiguousarray(pts, dtype=np.float32).tobytes())
+                 for (o, d), pts in geometries.items()])
+
+    def _get_legacy(self, orig, dest):
+        """Look up an encoded polyline in the legacy pickle, which is
+        keyed by origin and destination latitude only."""
+        if self.legacy_path is None:
+            return None
+        if self._legacy is None:
+            try:
+                with open(self.legacy_path, 'rb') as handle:
+                    self._legacy = pickle.load(handle)
+            except FileNotFoundError:
+                self._legacy = dict()
+        return self._legacy.get((orig[0], dest[0]))
+
+    def get_client(self):
+        client = getattr(self._local, 'client', None)
+        if client is None:
+            client = get_gmaps_client(self.key)
+            self._local.client = client
+        return client
+
+    def _fetch(self, orig, dest):
+        try:
+            return decode_polyline(get_gmap_directions(
+                orig, dest, client=self.get_client()))
+        except self.unavailable_errors as e:
+            logger.debug('Directions from {} to {} unavailable ({!r})'.format(
+                orig, dest, e))
+            return None
+
+    def prefetch(self, pairs):
+        """
+        Get directions for many pairs, requesting the ones that aren't
+        cached concurrently.
+
+        :param pairs: iterable of (orig, dest) tuples, where each of
+            orig and dest is a (lat, lon) tuple
+        :return: dict of float32 (lat, lon) arrays keyed by
+            (orig, dest)
+        """
+        pairs = list(dict.fromkeys(
+            (tuple(o), tuple(d)) for o, d in pairs))
+        geometries = self.get_many(pairs)
+        missing = [p for p in pairs if p not in geometries]
+
+        new = dict()
+        to_fetch = list()
+        for o, d in missing:
+            points = self._get_legacy(o, d)
+            if points is None:
+                to_fetch.append((o, d))
+            else:
+                new[o, d] = decode_polyline(points)
+
+        if to_fetch:
+            with ThreadPoolExecutor(
+                    min(self.workers, len(to_fetch))) as executor:
+                fetched = list(executor.map(
+                    lambda p: self._fetch(*p), to_fetch))
+            n_unavailable = 0
+            for (o, d), points in zip(to_fetch, fetched):
+                if points is None:
+                    n_unavailable += 1
+                    geometries[o, d] = self.fallback.get_geometry(o, d)
+                else:
+                    new[o, d] = points
+            if n_unavailable:
+                logger.warning(
+                    'Directions unavailable for {} of {} pairs. Using '
+                    'offline geometry instead.'.format(
+                        n_unavailable, len(to_fetch)))
+
+        if new:
+            self.put_many(new)
+            geometries.update(new)
+        return geometries
+
+    def get(self, orig, dest):
+        """
+        Get directions between a pair of points.
+
+        :param orig: origin (lat, lon) tuple
+        :param dest: destination (lat, lon) tuple
+        :return: float32 array of (lat, lon) points
+        """
+        orig = tuple(orig)
+        dest = tuple(dest)
+        return self.prefetch([(orig, dest)])[orig, dest]
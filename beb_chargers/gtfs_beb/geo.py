@@ -0,0 +1,270 @@
+import numpy as np
+from scipy.spatial import cKDTree
+
+# Earth radius in miles, as used by haversine_np
+EARTH_RADIUS_MI = 6378.137 / 1.609
+
+
+def haversine_np(lon1, lat1, lon2, lat2):
+    """
+    Calculate the great circle distance between two points
+    on the earth (specified in decimal degrees)
+
+    All args must be of equal length.
+
+    credit: https://stackoverflow.com/a/29546836/8576714
+
+    """
+    lon1, lat1, lon2, lat2 = map(np.radians, [lon1, lat1, lon2, lat2])
+
+    dlon = lon2 - lon1
+    dlat = lat2 - lat1
+
+    a = np.sin(dlat / 2.0) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin(dlon / 2.0) ** 2
+
+    c = 2 * np.arcsin(np.sqrt(a))
+    km = 6378.137 * c
+    miles = km / 1.609
+    return miles
+
+
+def manhattan_np(lon1, lat1, lon2, lat2):
+    """
+    Calculate the Manhattan (l1-norm) distance between two points
+    on the earth (specified in decimal degrees)
+
+    Works by calculating 2 haversine distances.
+
+    """
+    return haversine_np(lon1, lat1, lon2, lat1) + haversine_np(
+        lon2, lat1, lon2, lat2
+    )
+
+
+def _pairwise(dist_fn, lon1, lat1, lon2, lat2, dtype, chunk_size):
+    lon1, lat1, lon2, lat2 = (
+        np.asarray(x, dtype=dtype).ravel() for x in (lon1, lat1, lon2, lat2))
+    out = np.empty((len(lon1), len(lon2)), dtype=dtype)
+    if chunk_size is None:
+        chunk_size = max(len(lon1), 1)
+    for i in range(0, len(lon1), chunk_size):
+        rows = slice(i, i + chunk_size)
+        out[rows] = dist_fn(
+            lon1[rows, None], lat1[rows, None], lon2[None, :], lat2[None, :])
+    return out
+
+
+def haversine_pairwise(lon1, lat1, lon2, lat2, dtype=np.float64,
+                       chunk_size=None):
+    """
+    Calculate the great circle distance in miles between every point
+    in one set and every point in another.
+
+    :param lon1: longitudes of the first set of points
+    :param lat1: latitudes of the first set of points
+    :param lon2: longitudes of the second set of points
+    :param lat2: latitudes of the second set of points
+    :param dtype: floating point type to calculate in. float32 halves
+        memory use and is accurate to a few meters.
+    :param chunk_size: if given, number of rows calculated at a time,
+        to bound the memory used by intermediate arrays for large sets
+    :return: array of shape (len(lon1), len(lon2))
+    """
+    return _pairwise(
+        haversine_np, lon1, lat1, lon2, lat2, dtype, chunk_size)
+
+
+def manhattan_pairwise(lon1, lat1, lon2, lat2, dtype=np.float64,
+                       chunk_size=None):
+    """
+    Calculate the Manhattan distance in miles between every point in
+    one set and every point in another. See
+    :py:func:`haversine_pairwise` for parameters.
+
+    :return: array of shape (len(lon1), len(lon2))
+    """
+    return _pairwise(
+        manhattan_np, lon1, lat1, lon2, lat2, dtype, chunk_size)
+
+
+def _to_xyz(lats, lons):
+    """Convert (lat, lon) to 3D coordinates on a sphere in miles."""
+    lats = np.radians(np.asarray(lats, dtype=float))
+    lons = np.radians(np.asarray(lons, dtype=float))
+    return EARTH_RADIUS_MI * np.column_stack([
+        np.cos(lats) * np.cos(lons), np.cos(lats) * np.sin(lons),
+        np.sin(lats)])
+
+
+class SpatialIndex:
+    """
+    Index of (lat, lon) points for finding all points within a given
+    distance of many query points at once.
+
+    Points are stored in a k-d tree of their 3D positions on the
+    earth's surface, where straight-line (chord) distance increases
+    with great circle distance, so radius queries are exact for the
+    haversine metric. Manhattan distance is never shorter than great
+    circle distance, so Manhattan queries filter the great circle
+    matches.
+    """
+    def __init__(self, coords):
+        """
+        :param coords: list of (lat, lon) tuples
+        """
+        self.coords = np.asarray(coords, dtype=float).reshape(-1, 2)
+        self._tree = cKDTree(_to_xyz(self.coords[:, 0], self.coords[:, 1]))
+
+    def __len__(self):
+        return len(self.coords)
+
+    def query_radius(self, coords, radius, metric='haversine'):
+        """
+        Find all indexed points within radius of each query point.
+
+        :param coords: list of (lat, lon) query tuples
+        :param radius: maximum distance in miles (inclusive)
+        :param metric: 'haversine' or 'manhattan'
+        :return: tuple of arrays (query_ix, point_ix, dists) giving the
+            index of the query point, the index of the indexed point
+            and the distance between them for each match, sorted by
+            query_ix and then point_ix
+        """
+        if metric not in ('haversine', 'manhattan'):
+            raise ValueError('metric must be "haversine" or "manhattan"')
+        coords = np.asarray(coords, dtype=float).reshape(-1, 2)
+        if not len(coords) or not len(self):
+            return (np.empty(0, dtype=int), np.empty(0, dtype=int),
+                    np.empty(0))
+
+        # Chord length of the radius, padded for rounding
+        chord = 2 * EARTH_RADIUS_MI * np.sin(
+            min(radius / (2 * EARTH_RADIUS_MI), np.pi / 2))
+        matches = cKDTree(_to_xyz(coords[:, 0], coords[:, 1])) \
+            .sparse_distance_matrix(
+                self._tree, chord * (1 + 1e-9) + 1e-9,
+                output_type='ndarray')
+        query_ix = matches['i'].astype(int)
+        point_ix = matches['j'].astype(int)
+        dist_fn = haversine_np if metric == 'haversine' else manhattan_np
+        dists = dist_fn(
+            coords[query_ix, 1], coords[query_ix, 0],
+            self.coords[point_ix, 1], self.coords[point_ix, 0])
+        keep = dists <= radius
+        order = np.lexsort((point_ix[keep], query_ix[keep]))
+        return (query_ix[keep][order], point_ix[keep][order],
+                dists[keep][order])
+
+
+class LocationRegistry:
+    """
+    Registry that clusters nearby coordinates so they can share one
+    representative location.
+
+    GTFS terminals often appear with slightly different coordinates,
+    e.g. from the endpoints of different shapes serving the same stop.
+    Mapping them to one representative before requesting deadhead
+    shrinks the OD matrix quadratically and lets more lookups hit the
+    cache.
+
+    Coordinates are clustered greedily in the order they are added:
+    each new coordinate joins the nearest existing representative
+    within the tolerance, or otherwise becomes a new representative
+    along with all unassigned coordinates within the tolerance of it.
+    Representatives are always coordinates that were actually added.
+    """
+    def __init__(self, tolerance=10.):
+        """
+        :param tolerance: maximum distance in meters between a
+            coordinate and its representative
+        """
+        self.tolerance = tolerance
+        self.reps = list()
+        self._rep_xy = np.empty((0, 2))
+        self._tree = None
+        self._lookup = dict()
+        self._lat0 = None
+
+    def __len__(self):
+        return len(self.reps)
+
+    def _project(self, coords):
+        """Project (lat, lon) coordinates to local x/y in meters."""
+        coords = np.asarray(coords, dtype=float).reshape(-1, 2)
+        if self._lat0 is None:
+            self._lat0 = coords[0, 0]
+        return np.column_stack([
+            coords[:, 1] * np.cos(np.radians(self._lat0)) * 111320.,
+            coords[:, 0] * 110540.])
+
+    def add(self, coords):
+        """
+        Register coordinates and get the index of each one's
+        representative.
+
+        :param coords: list of (lat, lon) tuples
+        :return: array of indices into reps
+        """
+        coords = [tuple(c) for c in coords]
+        new = [c for c in dict.fromkeys(coords) if c not in self._lookup]
+        if new:
+            xy = self._project(new)
+            assigned = np.full(len(new), -1)
+            if self._tree is not None:
+                dists, nearest = self._tree.query(
+                    xy, distance_upper_bound=self.tolerance)
+                found = np.isfinite(dists)
+                assigned[found] = nearest[found]
+
+            unassigned = np.flatnonzero(assigned < 0)
+            if len(unassigned):
+                nbrs = cKDTree(xy[unassigned]).query_ball_point(
+                    xy[unassigned], self.tolerance)
+                for i, ix in enumerate(unassigned.tolist()):
+                    if assigned[ix] >= 0:
+                        continue
+                    rep = len(self.reps)
+                    self.reps.append(new[ix])
+                    for j in nbrs[i]:
+                        if assigned[unassigned[j]] < 0:
+                            assigned[unassigned[j]] = rep
+                added = self.reps[len(self._rep_xy):]
+                self._rep_xy = np.vstack([self._rep_xy, self._project(added)])
+                self._tree = cKDTree(self._rep_xy)
+
+            self._lookup.update(zip(new, assigned.tolist()))
+
+        return np.array([self._lookup[c] for c in coords], dtype=int)
+
+    def resolve(self, coords):
+        """
+        Map coordinates to their representatives, registering any new
+        ones.
+
+        :param coords: list of (lat, lon) tuples
+        :return: list of representative (lat, lon) tuples
+        """
+        return [self.reps[i] for i in self.add(coords).tolist()]
+
+    def get_reduction(self, origins, dests):
+        """
+        Count the unique OD pairs between origins and destinations
+        before and after mapping them to representatives.
+
+        :param origins: list of (lat, lon) origin tuples
+        :param dests: list of (lat, lon) destination tuples
+        :return: dict with the number of unique origins, destinations
+            and OD pairs before and after clustering, and the fraction
+            of OD pairs removed
+        """
+        n_orig = len(set(map(tuple, origins)))
+        n_dest = len(set(map(tuple, dests)))
+        n_rep_orig = len(set(self.add(origins).tolist()))
+        n_rep_dest = len(set(self.add(dests).tolist()))
+        n_pairs = n_orig * n_dest
+        n_rep_pairs = n_rep_orig * n_rep_dest
+        return {
+            'origins': n_orig, 'dests': n_dest, 'pairs': n_pairs,
+            'rep_origins': n_rep_orig, 'rep_dests': n_rep_dest,
+            'rep_pairs': n_rep_pairs,
+            'reduction': 1 - n_rep_pairs / n_pairs if n_pairs else 0.}
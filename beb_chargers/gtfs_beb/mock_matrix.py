@@ -0,0 +1,133 @@
+import json
+import logging
+import threading
+import numpy as np
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from beb_chargers.gtfs_beb.geo import haversine_pairwise
+
+logger = logging.getLogger('mock_matrix')
+
+
+class MockMatrixServer:
+    """
+    Local stand-in for the OpenRouteService matrix API, for testing
+    deadhead fetching without an API key or network access.
+
+    The server answers POST /v2/matrix/<profile> requests in the same
+    format as ORS, with distances from the haversine distance times a
+    circuity factor and durations at a constant speed. It can also
+    reject a share of requests (with HTTP 429 by default) to exercise
+    retries.
+
+    Usage::
+
+        with MockMatrixServer(fail_rate=0.2) as server:
+            provider = ORSProvider(base_url=server.url)
+            get_updated_osm_data(origins, dests, provider=provider)
+    """
+    def __init__(self, host='127.0.0.1', port=0, speed_mph=20.,
+                 circuity=1.3, max_elements=3500, fail_rate=0., seed=None,
+                 fail_status=429):
+        """
+        :param host: host to listen on
+        :param port: port to listen on, or 0 to pick a free port
+        :param speed_mph: constant speed used for durations
+        :param circuity: factor applied to straight-line distances
+        :param max_elements: largest matrix allowed per request
+        :param fail_rate: probability of rejecting a request
+        :param seed: seed for the failure draws
+        :param fail_status: HTTP status of rejected requests, e.g. 429
+            (rate limit exceeded) or 500
+        """
+        self.speed_mph = speed_mph
+        self.circuity = circuity
+        self.max_elements = max_elements
+        self.fail_rate = fail_rate
+        self.fail_status = fail_status
+        self.rng = np.random.default_rng(seed)
+        self.n_requests = 0
+        self.n_failures = 0
+        self.lock = threading.Lock()
+        self.httpd = ThreadingHTTPServer((host, port), self._make_handler())
+        self.thread = None
+
+    @property
+    def url(self):
+        host, port = self.httpd.server_address[:2]
+        return 'http://{}:{}'.format(host, port)
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def start(self):
+        self.thread = threading.Thread(
+            target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+        logger.debug('Mock matrix server listening at {}'.format(self.url))
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        if self.thread is not None:
+            self.thread.join()
+
+    def get_matrix(self, body):
+        """
+        Build the response to a matrix request body.
+
+        :param body: dict of request parameters (locations, sources,
+            destinations) with locations as [lon, lat] pairs
+        :return: tuple of (HTTP status, response dict)
+        """
+        locations = np.asarray(body['locations'], dtype=float)
+        sources = body.get('sources', list(range(len(locations))))
+        dests = body.get('destinations', list(range(len(locations))))
+        if len(sources) * len(dests) > self.max_elements:
+            return 400, {'error': {
+                'code': 6004, 'message': 'Request exceeds {} routes.'.format(
+                    self.max_elements)}}
+
+        orig = locations[sources]
+        dest = locations[dests]
+        miles = self.circuity * haversine_pairwise(
+            orig[:, 0], orig[:, 1], dest[:, 0], dest[:, 1])
+        return 200, {
+            'distances': (miles * 1609).tolist(),
+            'durations': (miles / self.speed_mph * 3600).tolist()}
+
+    def _make_handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                with server.lock:
+                    server.n_requests += 1
+                    fail = server.rng.random() < server.fail_rate
+                    if fail:
+                        server.n_failures += 1
+                if fail:
+                    status = server.fail_status
+                    response = {'error': 'Request rejected'}
+                elif not self.path.startswith('/v2/matrix/'):
+                    status = 404
+                    response = {'error': 'Not found'}
+                else:
+                    length = int(self.headers.get('Content-Length', 0))
+                    status, response = server.get_matrix(
+                        json.loads(self.rfile.read(length)))
+
+                payload = json.dumps(response).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, format, *args):
+                logger.debug(format % args)
+
+        return Handler
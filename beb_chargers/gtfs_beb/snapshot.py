@@ -0,0 +1,294 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+import zipfile
+import numpy as np
+import pandas as pd
+from pathlib import Path
+
+logger = logging.getLogger('gtfs_snapshot')
+
+# Bump whenever the on-disk layout or the parsing done by GTFSData
+# changes, so that stale snapshots are never reused.
+SNAPSHOT_VERSION = 4
+
+
+def hash_files(filenames, chunk_size=1 << 20):
+    """
+    Calculate a content hash of the given source files.
+
+    Files that don't exist are skipped (e.g. a feed without
+    calendar.txt), but their names still contribute to the hash so
+    adding or removing a file changes the key.
+
+    :param filenames: iterable of file paths
+    :param chunk_size: number of bytes read at a time
+    :return: hex digest string
+    """
+    h = hashlib.blake2b(digest_size=16)
+    h.update('snapshot-v{}'.format(SNAPSHOT_VERSION).encode())
+    for fname in filenames:
+        fname = Path(fname)
+        h.update(fname.name.encode())
+        try:
+            with open(fname, 'rb') as f:
+                for chunk in iter(lambda: f.read(chunk_size), b''):
+                    h.update(chunk)
+        except FileNotFoundError:
+            h.update(b'<missing>')
+    return h.hexdigest()
+
+
+def _file_stats(filenames):
+    """
+    Get the resolved path, size, and modification time of each file,
+    with None for the size and time of files that don't exist.
+    """
+    stats = list()
+    for fname in filenames:
+        fname = Path(fname).resolve()
+        try:
+            st = os.stat(fname)
+        except FileNotFoundError:
+            stats.append([str(fname), None, None])
+        else:
+            stats.append([str(fname), st.st_size, st.st_mtime_ns])
+    return stats
+
+
+def cached_hash_files(filenames, cache_file):
+    """
+    Get the content hash of the given files (see :py:func:`hash_files`)
+    without reading them if they haven't changed since it was last
+    calculated.
+
+    The hash is saved in cache_file along with the size and
+    modification time of each file. If these all still match, the
+    saved hash is returned. Otherwise the files are hashed again and
+    the cache is updated, so a file that was only touched maps to the
+    same hash as before.
+
+    :param filenames: iterable of file paths
+    :param cache_file: JSON file where hashes are cached. Failing to
+        write it is not an error.
+    :return: hex digest string
+    """
+    filenames = list(filenames)
+    cache_file = Path(cache_file)
+    stats = _file_stats(filenames)
+    key = '\n'.join(path for path, _, _ in stats)
+    try:
+        with open(cache_file) as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        cache = dict()
+
+    entry = cache.get(key)
+    if entry is not None and entry.get('version') == SNAPSHOT_VERSION \
+            and entry.get('stats') == stats:
+        return entry['hash']
+
+    digest = hash_files(filenames)
+    cache[key] = {'version': SNAPSHOT_VERSION, 'stats': stats, 'hash': digest}
+    try:
+        cache_file.parent.mkdir(parents=True, exist_ok=True)
+        fd, tmp_name = tempfile.mkstemp(
+            prefix='.tmp-', suffix='.json', dir=cache_file.parent)
+        with os.fdopen(fd, 'w') as f:
+            json.dump(cache, f)
+        os.replace(tmp_name, cache_file)
+    except OSError as e:
+        logger.debug('Could not save file hashes to {}: {}'.format(
+            cache_file, e))
+    return digest
+
+
+def hash_zip_members(zip_path, names):
+    """
+    Calculate a hash of the given members of a zip archive from the
+    CRC-32 and size recorded for each of them in the archive, which
+    avoids decompressing the members.
+
+    Members that don't exist are skipped, but their names still
+    contribute to the hash, as in :py:func:`hash_files`.
+
+    :param zip_path: path to .zip file
+    :param names: iterable of member names
+    :return: hex digest string
+    """
+    h = hashlib.blake2b(digest_size=16)
+    h.update('snapshot-v{}'.format(SNAPSHOT_VERSION).encode())
+    with zipfile.ZipFile(zip_path) as zf:
+        for name in names:
+            h.update(Path(name).name.encode())
+            try:
+                info = zf.getinfo(name)
+            except KeyError:
+                h.update(b'<missing>')
+                continue
+            h.update('{}:{}'.format(info.CRC, info.file_size).encode())
+    return h.hexdigest()
+
+
+def _save_column(table_dir, name, srs):
+    """
+    Save a single column as one or more .npy files and return the
+    metadata needed to restore it.
+    """
+    dtype_str = str(srs.dtype)
+    if pd.api.types.is_datetime64_any_dtype(srs):
+        np.save(table_dir / '{}.npy'.format(name),
+                srs.to_numpy(dtype='datetime64[ns]').view('int64'))
+        return {'name': name, 'kind': 'datetime', 'dtype': 'datetime64[ns]'}
+
+    if isinstance(srs.dtype, pd.CategoricalDtype):
+        # Codes are saved in the dtype pandas uses for them, so they
+        # can be memory-mapped straight into a Categorical
+        categories = srs.cat.categories
+        np.save(table_dir / '{}.npy'.format(name), srs.cat.codes.to_numpy())
+        np.save(table_dir / '{}.categories.npy'.format(name),
+                categories.to_numpy(
+                    dtype=str if categories.dtype == object else None))
+        return {'name': name, 'kind': 'categorical', 'dtype': 'category'}
+
+    if pd.api.types.is_numeric_dtype(srs) or pd.api.types.is_bool_dtype(srs):
+        np.save(table_dir / '{}.npy'.format(name), srs.to_numpy())
+        return {'name': name, 'kind': 'numeric', 'dtype': dtype_str}
+
+    # Strings are stored as integer codes plus an array of unique
+    # values. IDs repeat heavily in GTFS tables (e.g. trip_id in
+    # stop_times.txt), so this is much smaller than the raw strings.
+    codes, uniques = pd.factorize(srs, use_na_sentinel=True)
+    np.save(table_dir / '{}.npy'.format(name), codes.astype(np.int32))
+    np.save(table_dir / '{}.categories.npy'.format(name),
+            np.asarray(uniques, dtype=str))
+    return {'name': name, 'kind': 'string', 'dtype': dtype_str}
+
+
+def _load_column(table_dir, meta, mmap_mode):
+    name = meta['name']
+    arr = np.load(table_dir / '{}.npy'.format(name), mmap_mode=mmap_mode)
+    if meta['kind'] == 'datetime':
+        return arr.view('datetime64[ns]')
+
+    if meta['kind'] == 'numeric':
+        return arr
+
+    if meta['kind'] == 'categorical':
+        categories = np.load(table_dir / '{}.categories.npy'.format(name))
+        if categories.dtype.kind == 'U':
+            categories = categories.astype(object)
+        return pd.Categorical.from_codes(
+            arr, dtype=pd.CategoricalDtype(categories), validate=False)
+
+    categories = np.load(
+        table_dir / '{}.categories.npy'.format(name)).astype(object)
+    values = np.empty(len(arr), dtype=object)
+    if len(categories):
+        values[:] = categories[np.maximum(arr, 0)]
+    values[np.asarray(arr) < 0] = np.nan
+    srs = pd.Series(values, name=name, copy=False)
+    if meta['dtype'] != 'object':
+        srs = srs.astype(meta['dtype'])
+    return srs
+
+
+def save_tables(snapshot_dir, tables):
+    """
+    Write a snapshot of the given tables to disk.
+
+    Each table is stored as a directory with one .npy file per column,
+    which can later be memory-mapped by :py:func:`load_tables`. The
+    snapshot is written to a temporary directory first and then moved
+    into place, so concurrent readers never see a partial snapshot.
+
+    :param snapshot_dir: directory to write the snapshot to
+    :param tables: dict mapping table names to DataFrames (or None for
+        optional tables that are absent)
+    """
+    snapshot_dir = Path(snapshot_dir)
+    snapshot_dir.parent.mkdir(parents=True, exist_ok=True)
+    tmp_dir = Path(tempfile.mkdtemp(
+        prefix='.tmp-', dir=snapshot_dir.parent))
+    try:
+        manifest = {'version': SNAPSHOT_VERSION, 'tables': dict()}
+        for table_name, df in tables.items():
+            if df is None:
+                manifest['tables'][table_name] = None
+                continue
+
+            table_dir = tmp_dir / table_name
+            table_dir.mkdir()
+            index_cols = [n for n in df.index.names if n is not None]
+            if index_cols:
+                df = df.reset_index()
+            manifest['tables'][table_name] = {
+                'index': index_cols,
+                'columns': [
+                    _save_column(table_dir, c, df[c]) for c in df.columns]
+            }
+
+        with open(tmp_dir / 'manifest.json', 'w') as f:
+            json.dump(manifest, f)
+
+        try:
+            os.replace(tmp_dir, snapshot_dir)
+        except OSError:
+            # Another process wrote the same snapshot first. It has the
+            # same content, so just keep theirs.
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    except BaseException:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise
+
+    logger.debug('Saved GTFS snapshot to {}'.format(snapshot_dir))
+
+
+def load_tables(snapshot_dir, mmap=True):
+    """
+    Load tables saved by :py:func:`save_tables`.
+
+    Numeric, datetime, and categorical columns are memory-mapped
+    copy-on-write, so loading is nearly free and processes that load
+    the same snapshot share its pages through the OS cache. Other
+    string columns are rebuilt as object arrays, so large columns of
+    repeated IDs should be saved as categoricals.
+
+    :param snapshot_dir: directory the snapshot was written to
+    :param mmap: True to memory-map columns, False to read them fully
+    :return: dict of DataFrames keyed by table name, or None if no
+        usable snapshot exists
+    """
+    snapshot_dir = Path(snapshot_dir)
+    try:
+        with open(snapshot_dir / 'manifest.json') as f:
+            manifest = json.load(f)
+    except FileNotFoundError:
+        return None
+
+    if manifest.get('version') != SNAPSHOT_VERSION:
+        return None
+
+    mmap_mode = 'c' if mmap else None
+    tables = dict()
+    for table_name, table_meta in manifest['tables'].items():
+        if table_meta is None:
+            tables[table_name] = None
+            continue
+
+        table_dir = snapshot_dir / table_name
+        cols = {
+            m['name']: _load_column(table_dir, m, mmap_mode)
+            for m in table_meta['columns']
+        }
+        df = pd.DataFrame(cols, copy=False)
+        if table_meta['index']:
+            df = df.set_index(table_meta['index'])
+        tables[table_name] = df
+
+    logger.debug('Loaded GTFS snapshot from {}'.format(snapshot_dir))
+    return tables
@@ -608,6 +608,9 @@ def extract_iis(iis_model):
     iis_model.computeIIS()
     iis_trips = list()
     iis_arcs = list()
+    # Block IDs are recovered from constraint names as strings. Map
+    # them back to the keys used in the model, which may be int codes.
+    block_keys = {str(v): v for (v, _) in iis_model._trips}
     for c in iis_model.getConstrs():
         if c.IISConstr:
             if 'no_chg' in c.constrname:
@@ -617,7 +620,7 @@ def extract_iis(iis_model):
                 #   present in block_id strings
                 c_c, v_c, i_c = c.constrname.split('_')[2:]
                 # Convert strings to ints
-                iis_trips.append((c_c, v_c, int(i_c)))
+                iis_trips.append((c_c, block_keys.get(v_c, v_c), int(i_c)))
 
             if 'plugin' in c.constrname:
                 # Recover index from name we gave constraint
@@ -627,7 +630,8 @@ def extract_iis(iis_model):
                 c_ix = c.constrname.split('_')[1:]
                 # Convert strings to ints
                 iis_arcs.append(
-                    (c_ix[0], c_ix[1], int(c_ix[2]), c_ix[3], int(c_ix[4]))
+                    (c_ix[0], block_keys.get(c_ix[1], c_ix[1]), int(c_ix[2]),
+                     block_keys.get(c_ix[3], c_ix[3]), int(c_ix[4]))
                 )
 
     # Don't add indices that don't have a variable
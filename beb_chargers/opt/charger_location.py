@@ -12,7 +12,8 @@ from pathlib import Path
 from pyomo.environ import ConcreteModel, Set, Var, Binary, Constraint, \
     Objective, SolverFactory, value, NonNegativeIntegers, NonNegativeReals, \
     SolverStatus, TerminationCondition
-from beb_chargers.gtfs_beb import get_updated_osm_data
+from beb_chargers.gtfs_beb import get_updated_osm_data, decode_id_columns, \
+    DeadheadMatrix
 # Suppress matplotlib log (gets annoying at DEBUG level)
 logging.getLogger('matplotlib.pyplot').setLevel(logging.WARNING)
 logging.getLogger('pyomo').setLevel(logging.WARNING)
@@ -26,7 +27,8 @@ class ChargerLocationModel:
                  inter_trip_dists, trip_start_chg_dists, trip_end_chg_dists,
                  trip_start_chg_times, trip_end_chg_times, inter_trip_times,
                  chg_rates, energy_rates, site_costs, charger_costs,
-                 max_chargers, zero_time, depot_coords, trips_df):
+                 max_chargers, zero_time, depot_coords, trips_df,
+                 id_index=None):
         """
         Initialize BEB Optimal Charger Location model.
 
@@ -51,6 +53,9 @@ class ChargerLocationModel:
         :param zero_time: zero offset time as float
         :param depot_coords: coordinates of depot as tuple
         :param trips_df: DataFrame of all necessary trip attributes
+        :param id_index: dict of ID indexes (see
+            :py:attr:`GTFSData.id_index`) used to decode block and trip
+            IDs in output if the inputs use int32 ID codes
         """
         super().__init__()
         # Set attributes
@@ -95,6 +100,7 @@ class ChargerLocationModel:
         # TODO: restructure inputs to this class now that trips DF is
         #   contained within it
         self.trips_df = trips_df
+        self.id_index = id_index
 
         # Initialize result attributes
         self.model = None
@@ -118,6 +124,19 @@ class ChargerLocationModel:
         self.chg_schedule = None
         self.prior_chgs = None
 
+    @classmethod
+    def from_opt_arrays(cls, opt_arrays, **kwargs):
+        """
+        Initialize model from the array inputs built by
+        :py:meth:`GTFSData.build_opt_arrays`.
+
+        :param opt_arrays: :py:class:`OptInputArrays` instance
+        :param kwargs: remaining arguments to :py:meth:`__init__`
+            (vehicles, chargers, costs, etc.)
+        :return: ChargerLocationModel
+        """
+        return cls(**opt_arrays.to_kwargs(), **kwargs)
+
     def set_max_chg_time(self):
         """
         Set self.chg_time_avail based on trip start/end times
@@ -485,12 +504,10 @@ class ChargerLocationModel:
         # Filter down to just trips on infeasible blocks
         trips_df = trips_df.loc[bu_vts]
         # Get start and end coordinates of all trips (for deadhead lookup)
-        end_coords = [self.depot_coords] + list(
-            trips_df.apply(
-                lambda x: (x['end_lat'], x['end_lon']), axis=1).unique())
-        start_coords = [self.depot_coords] + list(
-            trips_df.apply(
-                lambda x: (x['start_lat'], x['start_lon']), axis=1).unique())
+        end_coords = [self.depot_coords] + list(dict.fromkeys(
+            zip(trips_df['end_lat'], trips_df['end_lon'])))
+        start_coords = [self.depot_coords] + list(dict.fromkeys(
+            zip(trips_df['start_lat'], trips_df['start_lon'])))
 
         start_srs = trips_df['start_time']
         end_srs = trips_df['end_time']
@@ -503,9 +520,39 @@ class ChargerLocationModel:
             dh_distance_fname = 'data/osm/osm_charge_data.pickle'
 
         # Get DH data from OSM
-        dh_by_coords = get_updated_osm_data(
+        dh_matrix = DeadheadMatrix.from_dh_data(get_updated_osm_data(
             origins=end_coords, dests=start_coords,
-            filename=dh_distance_fname)
+            filename=dh_distance_fname))
+        # Position of each trip's end and start in the DH matrix
+        end_ix = dh_matrix.get_indexer(
+            trips_df['end_lat'], trips_df['end_lon'])
+        start_ix = dh_matrix.get_indexer(
+            trips_df['start_lat'], trips_df['start_lon'], dest=True)
+        trip_starts = list(zip(trips_df['start_lat'].tolist(),
+                               trips_df['start_lon'].tolist()))
+        trip_ends = list(zip(trips_df['end_lat'].tolist(),
+                             trips_df['end_lon'].tolist()))
+
+        def check_found(dists, get_pair):
+            # gather() gives NaN for pairs missing from the DH data.
+            # Raise a KeyError of the first missing (orig, dest) pair
+            # rather than treating the arc as incompatible.
+            missing = np.flatnonzero(np.isnan(dists))
+            if len(missing) > 0:
+                raise KeyError(get_pair(missing[0]))
+
+        # Leaving: DH goes from depot to start of trip. Returning: DH
+        # goes from end of trip to depot.
+        from_depot_dists, _ = dh_matrix.gather(
+            dh_matrix.orig_index[self.depot_coords], start_ix)
+        check_found(from_depot_dists,
+                    lambda i: (self.depot_coords, trip_starts[i]))
+        to_depot_dists, _ = dh_matrix.gather(
+            end_ix, dh_matrix.dest_index[self.depot_coords])
+        check_found(to_depot_dists,
+                    lambda i: (trip_ends[i], self.depot_coords))
+        from_depot_dists = dict(zip(trips_df.index, from_depot_dists.tolist()))
+        to_depot_dists = dict(zip(trips_df.index, to_depot_dists.tolist()))
 
         # Initialize DH distances (indexed by v-t pairs)
         dh_dist = dict()
@@ -531,31 +578,15 @@ class ChargerLocationModel:
 
             # While we're here, establish distances for driving to and
             # from the depot.
-            # Leaving: DH goes from depot to start of trip (u, i)
-            # Where does next trip start?
-            dest_loc = (trips_df.loc[(u, i), 'start_lat'],
-                        trips_df.loc[(u, i), 'start_lon'])
-
-            dh_params = dh_by_coords[self.depot_coords, dest_loc]
-            dh_dist_od = dh_params['distance']
-
+            dh_dist_od = from_depot_dists[u, i]
             # Index for backup blocks
             dh_dist[(*depot_vt, u, i)] = dh_dist_od
-
             # Index for original blocks
             dh_dist[(u, 0, u, i)] = dh_dist_od
 
-            # Returning: DH goes from end of trip (u, i) to depot
-            # Where does v, j end?
-            src_loc = (trips_df.loc[(u, i), 'end_lat'],
-                       trips_df.loc[(u, i), 'end_lon'])
-            dh_params = dh_by_coords[src_loc, self.depot_coords]
-
-            dh_dist_od = dh_params['distance']
-
+            dh_dist_od = to_depot_dists[u, i]
             # Index for backup blocks
             dh_dist[(u, i, *depot_vt)] = dh_dist_od
-
             # Index for original blocks
             dh_dist[(u, i, u, 0)] = dh_dist_od
 
@@ -563,34 +594,30 @@ class ChargerLocationModel:
             'Number of compatible trips (without considering DH): {}'.format(
                 len(compat_no_dh)))
 
-        compat_arcs = list()
-        for (u, i, v, j) in compat_no_dh:
-            # Where does this trip end?
-            src_loc = (trips_df.loc[(u, i), 'end_lat'],
-                       trips_df.loc[(u, i), 'end_lon'])
-            # Where does next trip start?
-            dest_loc = (trips_df.loc[(v, j), 'start_lat'],
-                        trips_df.loc[(v, j), 'start_lon'])
-
-            dh_params = dh_by_coords[src_loc, dest_loc]
-            dh_dist_od = dh_params['distance']
-            dh_time_od = dh_params['duration']
-
-            dh_dist[u, i, v, j] = dh_dist_od
-            dh_tdelta = datetime.timedelta(minutes=dh_time_od)
-
-            if u == v:
-                # Assume always compatible within original block
-                compat_arcs.append((u, i, v, j))
-
-            else:
-                # Determine whether arcs are really compatible with DH time
-                time_diff = trips_df.loc[(v, j), 'start_time'] - dh_tdelta - \
-                            trips_df.loc[(u, i), 'end_time']
-                layover_td = datetime.timedelta(minutes=min_layover)
-                max_layover_td = datetime.timedelta(minutes=max_layover)
-                if max_layover_td >= time_diff >= layover_td:
-                    compat_arcs.append((u, i, v, j))
+        # Look up DH from the end of each trip to the start of each
+        # candidate next trip all at once
+        src_pos = trips_df.index.get_indexer(
+            [(u, i) for (u, i, _, _) in compat_no_dh])
+        dest_pos = trips_df.index.get_indexer(
+            [(v, j) for (_, _, v, j) in compat_no_dh])
+        arc_dists, arc_times = dh_matrix.gather(
+            end_ix[src_pos], start_ix[dest_pos])
+        check_found(arc_dists, lambda i: (
+            trip_ends[src_pos[i]], trip_starts[dest_pos[i]]))
+        for arc, dh_dist_od in zip(compat_no_dh, arc_dists.tolist()):
+            dh_dist[arc] = dh_dist_od
+
+        # Determine whether arcs are really compatible with DH time.
+        # Assume always compatible within original block.
+        time_diff = (
+            start_srs.to_numpy()[dest_pos] - end_srs.to_numpy()[src_pos]
+        ) / np.timedelta64(1, 'm') - arc_times
+        same_block = np.array(
+            [u == v for (u, _, v, _) in compat_no_dh], dtype=bool)
+        is_compat = same_block | (
+            (time_diff >= min_layover) & (time_diff <= max_layover))
+        compat_arcs = [
+            arc for arc, c in zip(compat_no_dh, is_compat.tolist()) if c]
 
         return compat_arcs, dh_dist
 
@@ -1165,6 +1192,12 @@ class ChargerLocationModel:
         :return: results DataFrame
         """
         trips_df = self.trips_df.set_index(['block_id', 'trip_idx'])
+        # Models pickled before id_index was added don't have it
+        id_index = getattr(self, 'id_index', None)
+        if id_index is not None:
+            # Look up trips by block code, but report their trip_id
+            trips_df = decode_id_columns(
+                trips_df, id_index, cols=['trip_id'])
         if self.solver_status != 'optimal':
             raise ValueError('Cannot output solution when solver status was '
                              'not optimal.')
@@ -1252,6 +1285,8 @@ class ChargerLocationModel:
             'dh2': opt_dh2,
             'dh3': opt_dh3}
         out_df = pd.DataFrame(out_dict)
+        if id_index is not None:
+            out_df = decode_id_columns(out_df, id_index, cols=['block_id'])
         return out_df
 
     def to_csv(self, fname):
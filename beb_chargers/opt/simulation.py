@@ -1,12 +1,18 @@
 import copy
+import heapq
+import itertools
+import math
+import numbers
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
 import numpy as np
 import pandas as pd
 import datetime
 import logging
 import time
-from bisect import insort
 from scipy.stats import t as tstat
-from beb_chargers.gtfs_beb.data import get_dh_dict
+from beb_chargers.gtfs_beb.data import get_dh_dict, decode_id_columns, \
+    DeadheadMatrix, DeadheadProvider
 
 logger = logging.getLogger('simulation')
 
@@ -154,39 +160,68 @@ class ChargerDeparture(Event):
         self.chg_time = chg_time
 
 
+def to_minutes(t):
+    """
+    Convert an event time to float minutes. Numbers are assumed to be
+    minutes already; datetimes are converted to minutes since the
+    epoch.
+
+    :param t: float minutes or datetime-like
+    :return: float minutes
+    """
+    if isinstance(t, float):
+        return t
+    if isinstance(t, pd.Timestamp):
+        return t.value / 6e10
+    if isinstance(t, numbers.Real):
+        return float(t)
+    return pd.Timestamp(t).value / 6e10
+
+
 class Calendar:
+    """
+    Simulation calendar: a priority queue of events ordered by time.
+
+    Events are kept in a binary heap keyed by (time in float minutes,
+    sequence number), so adding or removing an event is O(log n) and
+    comparisons never touch the events themselves. The sequence number
+    increases with each event added, so events at the same time are
+    processed in the order they were added.
+    """
     def __init__(self):
         """
         Constructor for simulation calendar class
         """
-        self.events = list()
+        self._heap = list()
+        self._seq = itertools.count()
 
     def __len__(self):
-        return len(self.events)
+        return len(self._heap)
+
+    @property
+    def events(self):
+        """List of events in the order they will be processed."""
+        return [ev for _, _, ev in sorted(self._heap)]
 
     def add_event(self, event):
         if not isinstance(event, Event):
             raise TypeError('Only objects of type Event may be added'
                             ' to calendar.')
-
-        # insort() right-inserts in the event of a tie, so our queue
-        # will reflect the order in which items were added, as
-        # intended.
-        insort(self.events, event)
+        heapq.heappush(
+            self._heap, (to_minutes(event.time), next(self._seq), event))
 
     def remove_event(self):
         """
         Remove first event from calendar. Call after event has been
         processed.
         """
-        _ = self.events.pop(0)
+        heapq.heappop(self._heap)
 
     def get_next_event(self):
-        return self.events[0]
+        return self._heap[0][2]
 
     def head(self, i=5):
-        i_adj = max(i, len(self.events))
-        return self.events[:i_adj]
+        return [ev for _, _, ev in heapq.nsmallest(i, self._heap)]
 
 
 def get_object_by_id(obj_id, obj_list):
@@ -214,30 +249,103 @@ def get_object_by_id(obj_id, obj_list):
         return obj_matches[0]
 
 
+def block_ids_as_keys(srs, id_index=None):
+    """
+    Normalize block IDs so that all simulation inputs use the same
+    keys. If id_index is given, inputs are keyed by interned int32
+    codes (see :py:meth:`GTFSData.encode_ids`), which are kept as
+    integers. Any other IDs are compared as strings.
+
+    :param srs: Series of block IDs
+    :param id_index: dict of ID indexes, if block IDs are encoded
+    :return: Series of block IDs used as keys
+    """
+    if id_index is not None and pd.api.types.is_integer_dtype(srs):
+        return srs
+    return srs.astype(str)
+
+
+def share_arrays(arrays):
+    """
+    Copy arrays into a new block of shared memory, so worker processes
+    can read them without each getting a pickled copy.
+
+    :param arrays: dict of arrays
+    :return: tuple of the SharedMemory block, which the caller must
+        close and unlink when done, and its layout, to be passed to
+        :py:func:`attach_arrays`
+    """
+    layout = list()
+    offset = 0
+    for key, arr in arrays.items():
+        arr = np.ascontiguousarray(arr)
+        # Align each array to 64 bytes
+        offset = -(-offset // 64) * 64
+        layout.append((key, arr.dtype.str, arr.shape, offset))
+        offset += arr.nbytes
+    shm = shared_memory.SharedMemory(create=True, size=max(offset, 1))
+    for (key, dtype, shape, start), arr in zip(layout, arrays.values()):
+        np.ndarray(shape, dtype=dtype, buffer=shm.buf, offset=start)[...] = arr
+    return shm, layout
+
+
+def attach_arrays(name, layout):
+    """
+    Get read-only views of arrays in shared memory.
+
+    :param name: name of SharedMemory block created by
+        :py:func:`share_arrays`
+    :param layout: layout returned by :py:func:`share_arrays`
+    :return: tuple of the SharedMemory block, which must be kept open
+        while the arrays are used, and a dict of arrays
+    """
+    shm = shared_memory.SharedMemory(name=name)
+    arrays = dict()
+    for key, dtype, shape, start in layout:
+        arr = np.ndarray(shape, dtype=dtype, buffer=shm.buf, offset=start)
+        arr.flags.writeable = False
+        arrays[key] = arr
+    return shm, arrays
+
+
 class SimulationRun:
     # Class for conducting a single simulation run with fixed parameters
+    # Columns of trip_arrays that may change between runs
+    trip_state_cols = ('duration', 'kwh_per_mi')
+
     def __init__(
             self, trip_data_df: pd.DataFrame, chg_plan_df: pd.DataFrame | None,
             chargers_df: pd.DataFrame, depot_df: pd.DataFrame,
             vehicles_df: pd.DataFrame, deadhead_df: pd.DataFrame = None,
-            ignore_deadhead: bool = False
+            ignore_deadhead: bool = False, id_index: dict = None,
+            dh_provider: DeadheadProvider = None,
+            dh_matrix: DeadheadMatrix = None
     ):
         """
         Constructor for simulation run class
+
+        :param id_index: dict of ID indexes (see
+            :py:attr:`GTFSData.id_index`), required if the inputs use
+            int32 ID codes. Block IDs in results are decoded with it.
+        :param dh_provider: :py:class:`DeadheadProvider` used to
+            calculate deadhead if neither deadhead_df nor dh_matrix is
+            given (OpenRouteService by default)
+        :param dh_matrix: :py:class:`DeadheadMatrix` of deadhead between
+            trips, chargers and depot. Used instead of deadhead_df if
+            given. It is only read, so it can be shared between runs.
         """
         MIN_CHARGE_TIME = 1
         self.trip_data_df = trip_data_df.reset_index()
-        self.trip_data_df['block_id'] = self.trip_data_df['block_id'].astype(
-            str)
+        self.trip_data_df['block_id'] = block_ids_as_keys(
+            self.trip_data_df['block_id'], id_index)
         self.trip_data_df.set_index(['block_id', 'trip_idx'], inplace=True)
         if chg_plan_df is not None:
             self.chg_plan_df = chg_plan_df.reset_index()
             self.chg_plan_df = self.chg_plan_df[
                 self.chg_plan_df['chg_time'] > MIN_CHARGE_TIME
             ].copy()
-            self.chg_plan_df['block_id'] = self.chg_plan_df['block_id'].astype(
-                str
-            )
+            self.chg_plan_df['block_id'] = block_ids_as_keys(
+                self.chg_plan_df['block_id'], id_index)
             self.chg_plan_df.set_index(
             ['block_id', 'trip_idx', 'charger'], inplace=True)
         else:
@@ -249,9 +357,13 @@ class SimulationRun:
         self.depot_df = depot_df.copy()
         self.vehicles_df = vehicles_df.copy()
         self.ignore_deadhead = ignore_deadhead
+        self.id_index = id_index
+
+        if dh_matrix is not None:
+            self.dh_matrix = dh_matrix
 
-        if deadhead_df is not None:
-            self.deadhead_df = deadhead_df.copy()
+        elif deadhead_df is not None:
+            self.dh_matrix = DeadheadMatrix.from_frame(deadhead_df)
 
         else:
             trip_start_locs = list(
@@ -279,26 +391,29 @@ class SimulationRun:
                 trip_start_locs=trip_start_locs,
                 trip_end_locs=trip_end_locs,
                 charger_locs=charger_locs,
-                depot_coords=depot_coords
+                depot_coords=depot_coords,
+                provider=dh_provider
             )
+            self.dh_matrix = DeadheadMatrix.from_dh_data(dh_dict)
 
-            df = pd.DataFrame.from_dict(dh_dict, orient='index')
-            df.index.set_names(['orig', 'dest'], inplace=True)
-            df = df.reset_index()
-            df[['orig_lat', 'orig_lon']] = pd.DataFrame(df['orig'].tolist())
-            df[['dest_lat', 'dest_lon']] = pd.DataFrame(df['dest'].tolist())
-            df = df.set_index(
-                ['orig_lat', 'orig_lon', 'dest_lat', 'dest_lon']
-            ).drop(columns=['orig', 'dest'])
-            self.deadhead_df = df
+        self.compile_trips()
+        self.compile_deadhead()
+        self.reset()
 
+    def reset(self):
+        """
+        Set up vehicles, chargers, the charging plan and output tracking
+        for a new run.
+        """
         self.vehicles = list()
         # Initialize vehicles
         vids = self.vehicles_df.index.tolist()
-        for v in vids:
+        v_keys = block_ids_as_keys(
+            self.vehicles_df.index.to_series(), self.id_index).tolist()
+        for v, v_key in zip(vids, v_keys):
             self.vehicles.append(
                 Vehicle(
-                    id=str(v),
+                    id=v_key,
                     min_chg=self.vehicles_df.loc[v, 'min_kwh'],
                     max_chg=self.vehicles_df.loc[v, 'max_kwh']
                 )
@@ -314,6 +429,8 @@ class SimulationRun:
                     num_chargers=self.chargers_df.loc[c, 'n_chargers']
                 )
             )
+        self.charger_by_id = {s.id: s for s in self.chargers}
+        self.compile_charge_plan()
         self.calendar = Calendar()
 
         # Attributes that track outputs
@@ -342,15 +459,233 @@ class SimulationRun:
         self.trip_times_df = None
 
     def copy(self):
-        return SimulationRun(
-            trip_data_df=self.trip_data_df,
-            chg_plan_df=self.chg_plan_df,
-            chargers_df=self.chargers_df,
-            depot_df=self.depot_df,
-            vehicles_df=self.vehicles_df,
-            deadhead_df=self.deadhead_df,
-            ignore_deadhead=self.ignore_deadhead
-        )
+        """
+        Create a new run with the same inputs. The compiled trip and
+        deadhead arrays are read-only and shared with the copy rather
+        than compiled again.
+
+        :return: :py:class:`SimulationRun`
+        """
+        sim = copy.copy(self)
+        sim.trip_data_df = self.trip_data_df.copy()
+        sim.trip_arrays = dict(self.trip_arrays)
+        sim.reset()
+        return sim
+
+    def compile_trips(self):
+        """
+        Compile the trip table into NumPy arrays indexed by a dense
+        integer trip ID (the trip's row in trip_data_df), so the event
+        loop never looks anything up in a DataFrame.
+
+        Sets trip_ids, mapping (block_id, trip_idx) to trip ID;
+        trip_arrays, a dict of per-trip arrays; next_trip, the ID of the
+        next trip of the same block (or -1); and block_trips, the IDs
+        of each block's trips in trip order, where the trips of the
+        block with index block_index[block_id] start at
+        block_offsets[i]. Times are in float minutes after t_ref,
+        midnight of the first service day.
+        """
+        trips = self.trip_data_df
+        block_keys = trips.index.get_level_values('block_id')
+        trip_idx = trips.index.get_level_values('trip_idx').to_numpy()
+        self.trip_ids = {
+            key: row for row, key in enumerate(
+                zip(block_keys.tolist(), trip_idx.tolist()))}
+        self.trip_idx = trip_idx
+
+        codes, blocks = pd.factorize(block_keys)
+        self.block_index = {b: i for i, b in enumerate(blocks.tolist())}
+        self.block_trips = np.lexsort((trip_idx, codes))
+        sorted_codes = codes[self.block_trips]
+        sorted_idx = trip_idx[self.block_trips]
+        self.block_offsets = np.searchsorted(
+            sorted_codes, np.arange(len(blocks) + 1))
+        has_next = (sorted_codes[1:] == sorted_codes[:-1]) \
+            & (sorted_idx[1:] == sorted_idx[:-1] + 1)
+        self.next_trip = np.full(len(trips), -1)
+        self.next_trip[self.block_trips[:-1][has_next]] = \
+            self.block_trips[1:][has_next]
+
+        self.t_ref = trips['start_time'].min().normalize()
+        self.trip_arrays = {
+            'start_time': (
+                trips['start_time'] - self.t_ref
+            ).dt.total_seconds().to_numpy() / 60}
+        for col in ['start_lat', 'start_lon', 'end_lat', 'end_lon',
+                    'total_dist', 'dh_dist']:
+            self.trip_arrays[col] = trips[col].to_numpy(dtype=float)
+        # These are shared by copies of this run, so protect them
+        for arr in [self.trip_idx, self.block_trips, self.block_offsets,
+                    self.next_trip, *self.trip_arrays.values()]:
+            arr.flags.writeable = False
+        self.update_trip_state()
+
+    def compile_deadhead(self):
+        """
+        Look up the deadhead the event loop needs for each trip, so
+        handling an event never searches dh_matrix.
+
+        Sets dh_arrays, a dict of read-only arrays of distance and
+        duration: next_dist and next_duration from the end of each trip
+        to the start of the next trip of its block (NaN for the last
+        trip); to_charger_dist and to_charger_duration, of shape
+        (n_trips, n_chargers), from the end of each trip to each
+        charger; and from_charger_dist and from_charger_duration, of
+        the same shape, from each charger to the start of each trip.
+        Columns are in the order of chargers_df, and charger_cols maps
+        each charger ID to its column. Pairs missing from dh_matrix are
+        NaN. Also sets zero_dh_arrays, read-only arrays of zeros with
+        the same keys and shapes, used when deadhead is ignored.
+        """
+        chg_sites = self.chargers_df.index.tolist()
+        chg_lats = self.chargers_df['lat'].to_numpy(dtype=float)
+        chg_lons = self.chargers_df['lon'].to_numpy(dtype=float)
+        self.charger_cols = {c: i for i, c in enumerate(chg_sites)}
+        self.charger_coords = {
+            c: (lat, lon) for c, lat, lon in zip(
+                chg_sites, chg_lats.tolist(), chg_lons.tolist())}
+
+        ta = self.trip_arrays
+        dhm = self.dh_matrix
+        trip_ends = dhm.get_indexer(ta['end_lat'], ta['end_lon'])
+        trip_starts = dhm.get_indexer(
+            ta['start_lat'], ta['start_lon'], dest=True)
+        next_starts = np.where(
+            self.next_trip >= 0, trip_starts[self.next_trip], -1)
+        chg_origs = dhm.get_indexer(chg_lats, chg_lons)
+        chg_dests = dhm.get_indexer(chg_lats, chg_lons, dest=True)
+
+        self.dh_arrays = dict()
+        self.dh_arrays['next_dist'], self.dh_arrays['next_duration'] = \
+            dhm.gather(trip_ends, next_starts)
+        self.dh_arrays['to_charger_dist'], \
+            self.dh_arrays['to_charger_duration'] = dhm.gather(
+                trip_ends[:, None], chg_dests[None, :])
+        self.dh_arrays['from_charger_dist'], \
+            self.dh_arrays['from_charger_duration'] = dhm.gather(
+                chg_origs[None, :], trip_starts[:, None])
+        for arr in self.dh_arrays.values():
+            arr.flags.writeable = False
+        # Broadcast views of a single zero, so these take no memory
+        self.zero_dh_arrays = {
+            k: np.broadcast_to(np.zeros((), dtype=v.dtype), v.shape)
+            for k, v in self.dh_arrays.items()}
+
+    def get_deadhead_arrays(self, ignore_deadhead=None):
+        """
+        :param ignore_deadhead: True to get arrays of zeros, as used
+            when deadhead is ignored. Defaults to self.ignore_deadhead.
+        :return: dict of deadhead arrays (see
+            :py:meth:`compile_deadhead`)
+        """
+        if ignore_deadhead is None:
+            ignore_deadhead = self.ignore_deadhead
+        if not ignore_deadhead:
+            return self.dh_arrays
+        return self.zero_dh_arrays
+
+    def get_shared_arrays(self):
+        """
+        :return: dict of the read-only arrays that copies of this run
+            share, keyed by attribute (see :py:meth:`set_shared_arrays`)
+        """
+        arrays = {
+            'trip_idx': self.trip_idx,
+            'block_trips': self.block_trips,
+            'block_offsets': self.block_offsets,
+            'next_trip': self.next_trip,
+            'dh_matrix.distances': self.dh_matrix.distances,
+            'dh_matrix.durations': self.dh_matrix.durations,
+        }
+        for k, arr in self.trip_arrays.items():
+            if k not in self.trip_state_cols:
+                arrays['trip_arrays.' + k] = arr
+        for k, arr in self.dh_arrays.items():
+            arrays['dh_arrays.' + k] = arr
+        return arrays
+
+    def set_shared_arrays(self, arrays):
+        """
+        Replace the arrays given by :py:meth:`get_shared_arrays`, e.g.
+        with views of shared memory. The dicts and dh_matrix that hold
+        them are copied first, so other runs are not affected.
+
+        :param arrays: dict of arrays with the same keys as
+            :py:meth:`get_shared_arrays`
+        """
+        self.trip_arrays = dict(self.trip_arrays)
+        self.dh_arrays = dict(self.dh_arrays)
+        self.dh_matrix = copy.copy(self.dh_matrix)
+        for key, arr in arrays.items():
+            if '.' in key:
+                attr, k = key.split('.')
+                container = getattr(self, attr)
+                if isinstance(container, dict):
+                    container[k] = arr
+                else:
+                    setattr(container, k, arr)
+            else:
+                setattr(self, key, arr)
+
+    def update_trip_state(self):
+        """
+        Copy trip energy rates and durations, which are varied between
+        runs (see :py:class:`SimulationBatch`), from trip_data_df into
+        trip_arrays.
+        """
+        duration = self.trip_data_df['duration']
+        if pd.api.types.is_timedelta64_dtype(duration):
+            duration = duration.dt.total_seconds() / 60
+        self.trip_arrays['duration'] = duration.to_numpy(dtype=float)
+        self.trip_arrays['kwh_per_mi'] = self.trip_data_df[
+            'kwh_per_mi'].to_numpy(dtype=float)
+
+    def compile_charge_plan(self):
+        """
+        Look up the planned charge after each trip. Sets
+        planned_charges, a dict keyed by block ID of dicts keyed by
+        trip index of (charger, charge time). If more than one charger
+        is planned after a trip, the longest charge is used (the first
+        charger in chargers_df if tied).
+        """
+        charger_order = {s.id: i for i, s in enumerate(self.chargers)}
+        self.planned_charges = dict()
+        self._replanned_blocks = list()
+        for (b, t, c), chg_time in self.chg_plan_df['chg_time'].items():
+            if c not in charger_order or not chg_time > 0:
+                continue
+            block_plan = self.planned_charges.setdefault(b, dict())
+            best = block_plan.get(t)
+            if best is None or chg_time > best[1] or (
+                    chg_time == best[1]
+                    and charger_order[c] < charger_order[best[0]]):
+                block_plan[t] = (c, chg_time)
+
+    def get_block_trips(self, block_id):
+        """
+        :param block_id: block ID
+        :return: array of trip IDs of the block, in the order they
+            appear in trip_data_df
+        """
+        b = self.block_index[block_id]
+        return np.sort(self.block_trips[
+            self.block_offsets[b]:self.block_offsets[b + 1]])
+
+    def to_timestamps(self, times):
+        """
+        Convert simulation times to Timestamps.
+
+        :param times: dict of float minutes after t_ref
+        :return: Series of Timestamps with the same keys
+        """
+        return self.t_ref + pd.to_timedelta(
+            pd.Series(times, dtype=float), unit='min')
+
+    @property
+    def deadhead_df(self):
+        """DataFrame of deadhead data, indexed by coordinates."""
+        return self.dh_matrix.to_frame()
 
     def look_up_deadhead(self, lat1, lon1, lat2, lon2, ignore_deadhead=None):
         if ignore_deadhead is None:
@@ -362,7 +697,7 @@ class SimulationRun:
                 'duration': 0
             }
         else:
-            dh = self.deadhead_df.loc[(lat1, lon1, lat2, lon2)]
+            dh = self.dh_matrix.lookup((lat1, lon1), (lat2, lon2))
         return dh
 
     def check_charging_needed(
@@ -386,35 +721,32 @@ class SimulationRun:
         eps = 5
 
         # Calculate needed energy
-        this_trip = self.trip_data_df.loc[(v, t)]
+        this_trip = self.trip_ids[v, t]
         if kwh_per_mi is None:
             energy_rate = self.trip_data_df.xs(key=v, level='block_id')[
                 'kwh_per_mi'].mean()
         else:
             energy_rate = kwh_per_mi
-        trip_dist = this_trip['total_dist']
-        all_charger_dists = {
-            s.id: self.look_up_deadhead(
-                this_trip['end_lat'], this_trip['end_lon'],
-                self.chargers_df.loc[s.id, 'lat'],
-                self.chargers_df.loc[s.id, 'lon']
-            )['distance']
-            for s in self.chargers
-        }
-        min_charger_dist = min(all_charger_dists.values())
+        trip_dist = self.trip_arrays['total_dist'][this_trip]
+        dh = self.get_deadhead_arrays()
+        charger_dists = dh['to_charger_dist'][this_trip]
+        missing = np.flatnonzero(np.isnan(charger_dists))
+        if len(missing) > 0:
+            raise self._missing_deadhead(
+                this_trip, charger=self.chargers[missing[0]].id,
+                from_charger=False)
+        min_charger_dist = float(charger_dists.min())
 
         # TODO: be more careful with this calc, may not be tight enough
-        if t == 0 or (v, t+1) not in self.trip_data_df.index:
+        if t == 0 or self.next_trip[this_trip] < 0:
             # Initial depot trips have artificially high distances, set
             # to 0. Return trips can charge at base, so also set to 0.
             next_dist = 0
 
         else:
-            next_trip = self.trip_data_df.loc[(v, t+1)]
-            inter_trip_dist = self.look_up_deadhead(
-                this_trip['end_lat'], this_trip['end_lon'],
-                next_trip['start_lat'], next_trip['start_lon']
-            )['distance']
+            inter_trip_dist = float(dh['next_dist'][this_trip])
+            if math.isnan(inter_trip_dist):
+                raise self._missing_deadhead(this_trip)
 
             next_trip_dist = inter_trip_dist + trip_dist
             next_dist = min(min_charger_dist, next_trip_dist)
@@ -430,7 +762,9 @@ class SimulationRun:
     def set_charging_plan(self, v, t, avg_e_rate, buffer=0):
         """
         After determining that charging is required, choose where and
-        how much to charge.
+        how much to charge. Any charges still planned for the vehicle
+        are cancelled; they are removed from chg_plan_df at the end of
+        :py:meth:`run_sim`.
 
         :param v: vehicle ID
         :param t: trip number
@@ -452,13 +786,12 @@ class SimulationRun:
         vid = v.id
         chg = v.chg
         # Select charging amount
-        trips_reset = self.trip_data_df.reset_index()
-        trips_left = trips_reset[
-            (trips_reset['block_id'] == vid) & (trips_reset['trip_idx'] > t)
-        ]
+        trips_left = self.get_block_trips(vid)
+        trips_left = trips_left[self.trip_idx[trips_left] > t]
 
         req_chg = avg_e_rate * (
-            trips_left['total_dist'].sum() + trips_left['dh_dist'].sum()
+            self.trip_arrays['total_dist'][trips_left].sum()
+            + self.trip_arrays['dh_dist'][trips_left].sum()
         )
         addl_chg = v.min_chg + req_chg + buffer - chg
 
@@ -470,22 +803,23 @@ class SimulationRun:
             raise ValueError('Calculated negative additional charge required')
 
         # Select the charger that gets the job done fastest
-        current_trip = self.trip_data_df.loc[(vid, t)]
-        next_trip = self.trip_data_df.loc[(vid, t)]
+        current_trip = self.trip_ids[vid, t]
+        next_trip = self.trip_ids[vid, t]
+        to_charger_times = self.dh_arrays['to_charger_duration'][
+            current_trip].tolist()
+        from_charger_times = self.dh_arrays['from_charger_duration'][
+            next_trip].tolist()
         times = dict()
         to_and_from_times = dict()
         for s in self.chargers:
-            charger_lat = self.chargers_df.loc[s.id, 'lat']
-            charger_lon = self.chargers_df.loc[s.id, 'lon']
-            to_charger_time = self.look_up_deadhead(
-                current_trip['end_lat'], current_trip['end_lon'],
-                charger_lat, charger_lon, ignore_deadhead=False
-            )['duration']
-            from_charger_time = self.look_up_deadhead(
-                charger_lat, charger_lon,
-                next_trip['start_lat'], next_trip['start_lon'],
-                ignore_deadhead=False
-            )['duration']
+            col = self.charger_cols[s.id]
+            to_charger_time = to_charger_times[col]
+            from_charger_time = from_charger_times[col]
+            if math.isnan(to_charger_time):
+                raise self._missing_deadhead(
+                    current_trip, charger=s.id, from_charger=False)
+            if math.isnan(from_charger_time):
+                raise self._missing_deadhead(next_trip, charger=s.id)
             chg_time = addl_chg / s.power
             to_and_from_times[s.id] = to_charger_time + from_charger_time
             times[s.id] = to_charger_time + from_charger_time \
@@ -506,16 +840,8 @@ class SimulationRun:
 
         # Update the charging plan for this vehicle so we don't charge
         # more than needed
-        try:
-            self.chg_plan_df = self.chg_plan_df.drop(
-                labels=vid,
-                axis='index',
-                level='block_id'
-            )
-        except KeyError:
-            # Some vehicles might not be in the charge plan at all, and
-            # that is okay. There's nothing to remove.
-            pass
+        self.planned_charges.pop(vid, None)
+        self._replanned_blocks.append(vid)
 
         logger.debug(
             'Scheduled an unplanned charge on block {} at {} for {:.2f} minutes, '
@@ -525,6 +851,16 @@ class SimulationRun:
         )
         return min_time_charger, addl_chg
 
+    def _drop_replanned_charges(self):
+        """Remove charges cancelled by :py:meth:`set_charging_plan`
+        from chg_plan_df."""
+        if not self._replanned_blocks:
+            return
+        self.chg_plan_df = self.chg_plan_df[
+            ~self.chg_plan_df.index.get_level_values('block_id').isin(
+                self._replanned_blocks)]
+        self._replanned_blocks = list()
+
     def calculate_exogenous_delay(self, method='sim'):
         # Evaluate baseline exogenous delay: the amount of delay that
         # would be present if buses didn't charge at all
@@ -544,14 +880,13 @@ class SimulationRun:
                 if len(v_df) <= 1:
                     # If there's only one trip, it will never be delayed
                     continue
-                v_df['dh_dest_lat'] = v_df['start_lat'].shift(-1)
-                v_df['dh_dest_lon'] = v_df['start_lon'].shift(-1)
-                # Merge in deadhead times
-                v_df = v_df.merge(
-                    self.deadhead_df['duration'].rename('dh_duration'),
-                    left_on=['end_lat', 'end_lon', 'dh_dest_lat', 'dh_dest_lon'],
-                    right_index=True,
-                    how='left'
+                # Look up deadhead times to the next trip
+                _, v_df['dh_duration'] = self.dh_matrix.gather(
+                    self.dh_matrix.get_indexer(
+                        v_df['end_lat'], v_df['end_lon']),
+                    self.dh_matrix.get_indexer(
+                        v_df['start_lat'].shift(-1),
+                        v_df['start_lon'].shift(-1), dest=True)
                 )
                 v_df['dh_duration'] = pd.to_timedelta(
                     v_df['dh_duration'].fillna(0),
@@ -575,18 +910,13 @@ class SimulationRun:
 
         elif method == 'sim':
             method_2_start = time.time()
-            exog_sim = SimulationRun(
-                trip_data_df=self.trip_data_df,
-                chg_plan_df=None,
-                chargers_df=self.chargers_df,
-                depot_df=self.depot_df,
-                vehicles_df=self.vehicles_df,
-                deadhead_df=self.deadhead_df,
-                ignore_deadhead=self.ignore_deadhead
-            )
+            exog_sim = self.copy()
+            # Simulate without charging
+            exog_sim.chg_plan_df = exog_sim.chg_plan_df.iloc[:0]
+            exog_sim.compile_charge_plan()
             exog_sim.trip_data_df['kwh_per_mi'] = 0
             exog_sim.run_sim()
-            exog_sim.process_results()
+            exog_sim.process_results(save_csv=False)
             self.exog_delay = exog_sim.total_delay
             logger.debug(
                 'simluated exogenous delay: {}, took {:.3f} s'.format(
@@ -601,19 +931,65 @@ class SimulationRun:
     def process_dead_battery(self, v, t):
         self.n_dead_batteries += 1
         # Identify number of remaining trips
-        v_trips = self.trip_data_df.reset_index()[
-            self.trip_data_df.reset_index()['block_id'] == v.id
-            ]
-        n_trips_left = len(v_trips[v_trips['trip_idx'] >= t])
+        v_trips = self.get_block_trips(v.id)
+        n_trips_left = int(np.count_nonzero(self.trip_idx[v_trips] >= t))
         self.n_missed_trips += n_trips_left
         # Remove the last event from the calendar.
         self.calendar.remove_event()
 
+    def _missing_deadhead(self, trip, charger=None, from_charger=True):
+        """
+        Build the error raised when the deadhead of an event is not in
+        dh_matrix.
+
+        :param trip: trip ID. The deadhead is from the end of this trip
+            to the start of the next, unless a charger is given.
+        :param charger: charger ID, if the deadhead is to or from a
+            charger
+        :param from_charger: True if the deadhead is from the charger
+            to the start of the trip, False if it is from the end of the
+            trip to the charger
+        :return: KeyError of the missing (orig, dest) pair
+        """
+        ta = self.trip_arrays
+        trip_start = (float(ta['start_lat'][trip]),
+                      float(ta['start_lon'][trip]))
+        trip_end = (float(ta['end_lat'][trip]), float(ta['end_lon'][trip]))
+        if charger is None:
+            next_trip = self.next_trip[trip]
+            pair = (trip_end, (float(ta['start_lat'][next_trip]),
+                               float(ta['start_lon'][next_trip])))
+        elif from_charger:
+            pair = (self.charger_coords[charger], trip_start)
+        else:
+            pair = (trip_end, self.charger_coords[charger])
+        return KeyError(pair)
+
     def run_sim(self):
+        # Read trip data from arrays (as lists, since indexing those is
+        # fastest for one element at a time)
+        self.update_trip_state()
+        trip_ids = self.trip_ids
+        next_trips = self.next_trip.tolist()
+        start_times = self.trip_arrays['start_time'].tolist()
+        durations = self.trip_arrays['duration'].tolist()
+        kwh_per_mi = self.trip_arrays['kwh_per_mi'].tolist()
+        total_dists = self.trip_arrays['total_dist'].tolist()
+        # Deadhead between trips and to and from chargers. The charger
+        # arrays stay 2D and are indexed as needed.
+        dh = self.get_deadhead_arrays()
+        next_dists = dh['next_dist'].tolist()
+        next_durations = dh['next_duration'].tolist()
+        to_chg_dist = dh['to_charger_dist']
+        to_chg_duration = dh['to_charger_duration']
+        from_chg_dist = dh['from_charger_dist']
+        from_chg_duration = dh['from_charger_duration']
+        charger_cols = self.charger_cols
+
         # Initialize calendar with first trip of all vehicles
         for v in self.vehicles:
             # Create event for first trip
-            start_time = self.trip_data_df.loc[(v.id, 0), 'start_time']
+            start_time = start_times[trip_ids[v.id, 0]]
             first_trip_start = TripStart(time=start_time, veh=v, trip=0)
             self.calendar.add_event(first_trip_start)
 
@@ -639,8 +1015,9 @@ class SimulationRun:
 
                 self.actual_start_times[v.id, t] = current_ev.time
 
-                sched_start = self.trip_data_df.loc[(v.id, t), 'start_time']
-                time_diff = (sched_start - current_ev.time).total_seconds() / 60
+                trip = trip_ids[v.id, t]
+                sched_start = start_times[trip]
+                time_diff = sched_start - current_ev.time
                 if time_diff >= -0.01:
                     # Ahead of schedule, so add to wait time
                     self.delay[v.id, t] = 0
@@ -648,13 +1025,12 @@ class SimulationRun:
                     self.delay[v.id, t] = -time_diff
 
                 # Update vehicle charge
-                e_rate = self.trip_data_df.loc[(v.id, t), 'kwh_per_mi']
-                trip_dist = self.trip_data_df.loc[(v.id, t), 'total_dist']
+                e_rate = kwh_per_mi[trip]
+                trip_dist = total_dists[trip]
                 v.chg -= e_rate * trip_dist
 
                 # Add end of trip to calendar
-                t_end_time = current_ev.time + self.trip_data_df.loc[
-                    (v.id, t), 'duration']
+                t_end_time = current_ev.time + durations[trip]
                 new_ev = TripEnd(time=t_end_time, veh=v, trip=t)
                 self.calendar.add_event(new_ev)
 
@@ -669,45 +1045,32 @@ class SimulationRun:
                     continue
 
                 # Grab some key parameters
-                trip_end_lat = self.trip_data_df.loc[(v.id, t), 'end_lat']
-                trip_end_lon = self.trip_data_df.loc[(v.id, t), 'end_lon']
-                vt_energy_rate = self.trip_data_df.loc[(v.id, t), 'kwh_per_mi']
+                trip = trip_ids[v.id, t]
+                vt_energy_rate = kwh_per_mi[trip]
 
                 # Are any trips left on the schedule? If not, return to
                 # base and do not add any new events.
                 # TODO: re-evaluate how we handle depot trips
-                if (v.id, t+1) not in self.trip_data_df.index:
+                next_trip = next_trips[trip]
+                if next_trip < 0:
                     self.calendar.remove_event()
                     continue
 
                 # If a charge is scheduled at this time, drive to
-                # the charger.
-                charges = dict()
-                for s in self.chargers:
-                    try:
-                        charges[s.id] = self.chg_plan_df.loc[
-                            (v.id, t, s.id), 'chg_time'
-                        ]
-                    except KeyError:
-                        # This KeyError may be raised if (1) we are on
-                        # trip zero for some vehicle, which never has
-                        # charging because it's just driving from the
-                        # depot or (2) the key was not provided because
-                        # the charging plan input only contains blocks
-                        # that are expected to require charging. So we
-                        # specify manually that no charging is planned
-                        # in either case.
-                        charges[s.id] = 0
-
-                chg_planned = max(charges.values()) > 0
-
-                if chg_planned:
+                # the charger. No charge is planned after trip zero of
+                # any vehicle, which is just driving from the depot, or
+                # after any trip of blocks that aren't expected to
+                # require charging.
+                planned = self.planned_charges.get(v.id)
+                if planned is not None:
+                    planned = planned.get(t)
+
+                if planned is not None:
                     chg_next = True
                     # Charging is scheduled for after this trip.
                     # Identify charging site, drive time, and
                     # charge required to drive there.
-                    chg_site = max(charges, key=charges.get)
-                    chg_time = charges[chg_site]
+                    chg_site, chg_time = planned
 
                 else:
                     # Charging is not scheduled after this trip.
@@ -722,38 +1085,32 @@ class SimulationRun:
                         self.unplanned_chgs += 1
                         # Charging must be done. Choose where and
                         # how much.
-                        avg_energy_rate = self.trip_data_df.xs(
-                            key=v.id, level='block_id'
-                        )['kwh_per_mi'].mean()
+                        avg_energy_rate = self.trip_arrays['kwh_per_mi'][
+                            self.get_block_trips(v.id)].mean()
                         chg_site, chg_amt = self.set_charging_plan(
                             v, t, avg_energy_rate)
-                        chg_time = chg_amt / (self.chargers_df.loc[
-                            chg_site, 'kw'] / 60)
+                        chg_time = chg_amt / self.charger_by_id[
+                            chg_site].power
 
                     else:
                         chg_next = False
 
                 if chg_next:
                     # Next step is to charge (scheduled or not)
-                    chg_site_lat = self.chargers_df.loc[chg_site, 'lat']
-                    chg_site_lon = self.chargers_df.loc[chg_site, 'lon']
-                    dh = self.look_up_deadhead(
-                        trip_end_lat, trip_end_lon, chg_site_lat, chg_site_lon
-                    )
-                    time_to_site = datetime.timedelta(
-                        minutes=dh['duration']
-                    )
-                    dist_to_site = dh['distance']
+                    col = charger_cols[chg_site]
+                    time_to_site = float(to_chg_duration[trip, col])
+                    dist_to_site = float(to_chg_dist[trip, col])
+                    if math.isnan(dist_to_site):
+                        raise self._missing_deadhead(
+                            trip, charger=chg_site, from_charger=False)
                     charger_arrival_time = current_ev.time + time_to_site
-                    chg_used = self.trip_data_df.loc[
-                                   (v.id, t), 'kwh_per_mi'
-                               ] * dist_to_site
+                    chg_used = vt_energy_rate * dist_to_site
                     v.chg -= chg_used
 
                     # Ensure that we aren't going to exceed the maximum
                     # battery charge. If we are, reduce the charging
                     # duration.
-                    chg_pwr = get_object_by_id(chg_site, self.chargers).power
+                    chg_pwr = self.charger_by_id[chg_site].power
                     if v.chg + chg_pwr * chg_time > v.max_chg:
                         # Calculate time to reach max charge
                         max_kwh_gain = v.max_chg - v.chg
@@ -771,9 +1128,7 @@ class SimulationRun:
                                 'Negative charge time found for block {}, trip '
                                 '{}. Current battery level is {} and maximum is '
                                 '{}. Last trip used {} kWh/mi.'.format(
-                                    v.id, t, v.chg, v.max_chg,
-                                    self.trip_data_df.loc[
-                                        (v.id, t), 'kwh_per_mi']
+                                    v.id, t, v.chg, v.max_chg, vt_energy_rate
                                 )
                             )
                             chg_time = 0
@@ -785,29 +1140,19 @@ class SimulationRun:
 
                 else:
                     # No need to charge. Move to next trip.
-                    next_trip = self.trip_data_df.loc[
-                        (v.id, t + 1)
-                    ]
-                    next_trip_dh = self.look_up_deadhead(
-                        trip_end_lat, trip_end_lon,
-                        next_trip['start_lat'], next_trip['start_lon']
-                    )
-
-                    time_to_next = datetime.timedelta(
-                        minutes=next_trip_dh['duration']
-                    )
+                    time_to_next = next_durations[trip]
+                    next_start_dist = next_dists[trip]
+                    if math.isnan(next_start_dist):
+                        raise self._missing_deadhead(trip)
                     # Next trip starts either when we get there, or when
                     # scheduled
                     ready_time = current_ev.time + time_to_next
-                    sched_start = self.trip_data_df.loc[
-                        (v.id, t+1), 'start_time'
-                    ]
+                    sched_start = start_times[next_trip]
 
                     next_start_time = max(ready_time, sched_start)
                     self.rec_time[v.id, t+1] = max(
-                        0., (sched_start - ready_time).total_seconds() / 60
+                        0., sched_start - ready_time
                     )
-                    next_start_dist = next_trip_dh['distance']
                     v.chg -= next_start_dist * vt_energy_rate
                     new_ev = TripStart(
                         time=next_start_time, veh=v, trip=t+1
@@ -815,7 +1160,7 @@ class SimulationRun:
                     self.calendar.add_event(new_ev)
 
             elif current_ev.type == 'chg_arr':
-                chg_site = get_object_by_id(current_ev.chg_site, self.chargers)
+                chg_site = self.charger_by_id[current_ev.chg_site]
                 v = current_ev.veh
                 t = current_ev.trip
                 if v.chg < 0:
@@ -840,9 +1185,7 @@ class SimulationRun:
                     # If charger is available, start charging and add
                     # event for charge completion to calendar.
                     chg_site.start_charging(chg_req)
-                    chg_end_time = current_ev.time + datetime.timedelta(
-                        minutes=current_ev.chg_time
-                    )
+                    chg_end_time = current_ev.time + current_ev.chg_time
                     new_ev = ChargerDeparture(
                         time=chg_end_time, veh=v, trip=current_ev.trip,
                         chg_site=current_ev.chg_site,
@@ -859,7 +1202,7 @@ class SimulationRun:
                 t = current_ev.trip
                 s = current_ev.chg_site
 
-                chg_site = get_object_by_id(s, self.chargers)
+                chg_site = self.charger_by_id[s]
 
                 try:
                     chg_site.finish_charging(v.id)
@@ -877,14 +1220,12 @@ class SimulationRun:
                 if new_req is not None:
                     # Track how long this request waited for
                     self.queue_delay[new_req.veh.id, new_req.trip, s] = \
-                        (current_ev.time - new_req.time_made).total_seconds() / 60
+                        current_ev.time - new_req.time_made
                     self.plugin_times[new_req.veh.id, new_req.trip] = \
                         current_ev.time
                     # Process new charging request, add departure to
                     # calendar.
-                    req_chg_end = current_ev.time + datetime.timedelta(
-                        minutes=new_req.chg_time
-                    )
+                    req_chg_end = current_ev.time + new_req.chg_time
                     new_dept = ChargerDeparture(
                         time=req_chg_end, veh=new_req.veh, trip=new_req.trip,
                         chg_site=s, chg_time=new_req.chg_time)
@@ -901,24 +1242,17 @@ class SimulationRun:
                     )
 
                 # Move vehicle to start of next trip
-                next_trip = self.trip_data_df.loc[(v.id, t+1)]
-                this_charger = self.chargers_df.loc[s]
-                dh = self.look_up_deadhead(
-                    this_charger['lat'], this_charger['lon'],
-                    next_trip['start_lat'], next_trip['start_lon']
-                )
-
-                dist_to_start = dh['distance']
-                time_to_start = datetime.timedelta(
-                    minutes=dh['duration']
-                )
-                v.chg -= dist_to_start * self.trip_data_df.loc[
-                    (v.id, t), 'kwh_per_mi'
-                ]
+                trip = trip_ids[v.id, t]
+                next_trip = next_trips[trip]
+                col = charger_cols[s]
+                dist_to_start = float(from_chg_dist[next_trip, col])
+                time_to_start = float(from_chg_duration[next_trip, col])
+                if math.isnan(dist_to_start):
+                    raise self._missing_deadhead(next_trip, charger=s)
+                v.chg -= dist_to_start * kwh_per_mi[trip]
 
                 next_start_time = max(
-                    current_ev.time + time_to_start,
-                    self.trip_data_df.loc[(v.id, t+1), 'start_time']
+                    current_ev.time + time_to_start, start_times[next_trip]
                 )
                 new_ev = TripStart(time=next_start_time, veh=v, trip=t+1)
                 self.calendar.add_event(new_ev)
@@ -930,6 +1264,8 @@ class SimulationRun:
             # Remove completed event from calendar
             self.calendar.remove_event()
 
+        self._drop_replanned_charges()
+
     def check_battery_level(self, veh, t):
         # TODO: set this based on battery capacity and SoC
         abs_min_soc = 5
@@ -943,7 +1279,15 @@ class SimulationRun:
             n_trips_left = len(v_trips[v_trips['trip_idx'] > t])
             self.n_missed_trips += n_trips_left
 
-    def process_results(self):
+    def process_results(self, save_csv=True):
+        """
+        Summarize the results of :py:meth:`run_sim`.
+
+        :param save_csv: True to also write charges_df and trip_times_df
+            to test_results.csv and test_trip_times.csv in the current
+            directory. Replications of a :py:class:`SimulationBatch`
+            don't, since they may run in parallel processes.
+        """
         # Total delay
         self.total_delay = sum(self.delay.values())
         # Add penalty for all missed trips (at least 60 min)
@@ -974,8 +1318,8 @@ class SimulationRun:
         self.charges_df = pd.DataFrame(
             data={
                 'charger': self.chargers_used,
-                'arrival_time': self.charger_arrivals,
-                'plugin_time': self.plugin_times,
+                'arrival_time': self.to_timestamps(self.charger_arrivals),
+                'plugin_time': self.to_timestamps(self.plugin_times),
                 'chg_time': self.charge_times,
                 'chg_kwh': self.charge_amts
             }
@@ -989,19 +1333,28 @@ class SimulationRun:
             self.charges_df.index.set_names(
                 ['block_id', 'trip_idx'], inplace=True
             )
+            if self.id_index is not None:
+                self.charges_df = decode_id_columns(
+                    self.charges_df, self.id_index, cols=['block_id'])
 
-        self.charges_df.to_csv('test_results.csv')
+        if save_csv:
+            self.charges_df.to_csv('test_results.csv')
 
         # Trip timing DF
         self.trip_times_df = pd.DataFrame(
             data={
-                'actual_start_time': self.actual_start_times,
-                'actual_end_time': self.actual_end_times,
+                'actual_start_time': self.to_timestamps(
+                    self.actual_start_times),
+                'actual_end_time': self.to_timestamps(self.actual_end_times),
                 'delay': self.delay
             }
         )
         self.trip_times_df.index.set_names(['block_id', 'trip_idx'], inplace=True)
-        self.trip_times_df.to_csv('test_trip_times.csv')
+        if self.id_index is not None:
+            self.trip_times_df = decode_id_columns(
+                self.trip_times_df, self.id_index, cols=['block_id'])
+        if save_csv:
+            self.trip_times_df.to_csv('test_trip_times.csv')
 
     def print_results(self):
         logger.info('Total recovery time: {:.2f} minutes'.format(
@@ -1034,8 +1387,18 @@ class SimulationBatch:
             vehicles_df: pd.DataFrame, n_sims: int,
             deadhead_df: pd.DataFrame = None, seed: int = None,
             ignore_deadhead: bool = False, vary_duration: bool = True,
-            vary_energy: bool = True
+            vary_energy: bool = True, id_index: dict = None,
+            dh_provider: DeadheadProvider = None,
+            dh_matrix: DeadheadMatrix = None, workers: int = 1
     ):
+        """
+        :param seed: random seed. Each replication draws from its own
+            stream spawned from it, so results don't depend on the
+            number of workers.
+        :param workers: number of processes to run replications in. If
+            more than 1, the trip and deadhead arrays are passed to
+            the processes in shared memory.
+        """
         # Create a baseline simulation instance
         self.base_sim = SimulationRun(
             trip_data_df=trip_data_df,
@@ -1044,12 +1407,17 @@ class SimulationBatch:
             depot_df=depot_df,
             vehicles_df=vehicles_df,
             deadhead_df=deadhead_df,
-            ignore_deadhead=ignore_deadhead
+            ignore_deadhead=ignore_deadhead,
+            id_index=id_index,
+            dh_provider=dh_provider,
+            dh_matrix=dh_matrix
         )
 
         self.vary_duration = vary_duration
         self.vary_energy = vary_energy
         self.n_sims = n_sims
+        self.workers = workers
+        self.dur_pcts = None
         self.delay = np.zeros(n_sims)
         self.exog_delay = np.zeros(n_sims)
         self.charging_delay = np.zeros(n_sims)
@@ -1058,75 +1426,130 @@ class SimulationBatch:
         self.n_dead_batteries = np.zeros(n_sims)
         self.n_missed_trips = np.zeros(n_sims)
 
-        if seed is not None:
-            # Instantiate random number generator
-            self.rng = np.random.default_rng(seed)
+        # Replications get streams spawned from this. If seed is None,
+        # fresh entropy is used.
+        self.seed_seq = np.random.SeedSequence(seed)
 
-        else:
-            self.rng = np.random.default_rng()
+    def get_seeds(self):
+        """
+        :return: list of one SeedSequence per replication. These are
+            the same every time this is called.
+        """
+        return np.random.SeedSequence(self.seed_seq.entropy).spawn(
+            self.n_sims)
 
-    def run(self):
+    def load_duration_deviations(self):
+        """
+        Read the observed schedule deviation of the routes in the batch.
+
+        :return: dict of arrays of percent differences between actual
+            and scheduled trip duration, keyed by route
+        """
+        dur_df = pd.read_csv(
+            '../data/processed/schedule_deviation_distributions.csv',
+            parse_dates=['date'],
+            dtype={'trip_id': str, 'route': str}
+        )
+        dur_df = dur_df[
+            dur_df['route'].isin(self.base_sim.trip_data_df['route'].unique())
+        ]
+        return {
+            r: r_df['duration_difference_pct'].to_numpy()
+            for r, r_df in dur_df.groupby('route')
+        }
+
+    def run_replication(self, seed_seq):
+        """
+        Run one replication with randomly varied trip data.
+
+        :param seed_seq: SeedSequence of this replication
+        :return: tuple of total delay, exogenous delay, % of trips
+            delayed, number of unplanned charges, number of dead
+            batteries and number of missed trips
+        """
+        rng = np.random.default_rng(seed_seq)
+        sim = self.base_sim.copy()
+        exog_delay = 0
         if self.vary_energy:
-            energy_loc = self.base_sim.trip_data_df['kwh_per_mi_mean']
-            energy_scale = self.base_sim.trip_data_df['kwh_per_mi_err']
+            sim.trip_data_df['kwh_per_mi'] = rng.normal(
+                loc=sim.trip_data_df['kwh_per_mi_mean'],
+                scale=sim.trip_data_df['kwh_per_mi_err'])
+        if self.vary_duration:
+            sample = True
+            if sample:
+                # Randomly sample an observed deviation for each trip
+                # of each route
+                routes = sim.trip_data_df['route']
+                dur_pct = np.zeros(len(routes))
+                for r, ix in routes.groupby(routes, sort=True).indices.items():
+                    dur_pct[ix] = rng.choice(self.dur_pcts[r], size=len(ix))
+                sim.trip_data_df['duration'] = pd.to_timedelta(
+                    sim.trip_data_df['duration_sched'] * (1 + dur_pct / 100),
+                    unit='min'
+                )
+
+            else:
+                sim.trip_data_df['duration'] = pd.to_timedelta(
+                    sim.trip_data_df['duration_mean']
+                )
+                # Calculate exogenous delay
+                sim.calculate_exogenous_delay()
+                exog_delay = sim.exog_delay
 
+        else:
+            # We only need to get the exogenous delay once, from
+            # the base simulation, if duration isn't varied
+            exog_delay = self.base_sim.exog_delay
+
+        sim.run_sim()
+        sim.process_results(save_csv=False)
+        return (sim.total_delay, exog_delay, sim.pct_trips_delayed,
+                sim.unplanned_chgs, sim.n_dead_batteries, sim.n_missed_trips)
+
+    def run(self):
         if self.vary_duration:
             # Read in schedule deviation info
-            dur_df = pd.read_csv(
-                '../data/processed/schedule_deviation_distributions.csv',
-                parse_dates=['date'],
-                dtype={'trip_id': str, 'route': str}
-            )
-            dur_df = dur_df[
-                dur_df['route'].isin(self.base_sim.trip_data_df['route'].unique())
-            ].copy()
-            dur_gb = dur_df.groupby('route')
+            self.dur_pcts = self.load_duration_deviations()
 
         if not self.vary_duration:
             self.base_sim.calculate_exogenous_delay()
 
-        for n in range(self.n_sims):
-            sim = self.base_sim.copy()
-            if self.vary_energy:
-                sim.trip_data_df['kwh_per_mi'] = \
-                    self.rng.normal(loc=energy_loc, scale=energy_scale)
-            if self.vary_duration:
-                sample = True
-                if sample:
-                    # Randomly sample
-                    sim.trip_data_df['duration'] = pd.to_timedelta(
-                        sim.trip_data_df.apply(
-                            lambda rw: rw['duration_sched'] * (
-                                1 + dur_gb.get_group(
-                                    rw['route'])['duration_difference_pct'].sample(
-                                        n=1).tolist()[0] / 100
-                            ),
-                            axis=1
-                        ),
-                        unit='min'
-                    )
+        seeds = self.get_seeds()
+        if self.workers > 1 and self.n_sims > 1:
+            results = self.run_parallel(seeds)
+        else:
+            results = [self.run_replication(ss) for ss in seeds]
 
-                else:
-                    sim.trip_data_df['duration'] = pd.to_timedelta(
-                        sim.trip_data_df['duration_mean']
-                    )
-                    # Calculate exogenous delay
-                    sim.calculate_exogenous_delay()
-                    self.exog_delay[n] = sim.exog_delay
+        for n, res in enumerate(results):
+            self.delay[n], self.exog_delay[n], self.pct_trips_delayed[n], \
+                self.n_unplanned_charges[n], self.n_dead_batteries[n], \
+                self.n_missed_trips[n] = res
+        self.charging_delay = self.delay - self.exog_delay
 
-            else:
-                # We only need to get the exogenous delay once, from
-                # the base simulation, if duration isn't varied
-                self.exog_delay[n] = self.base_sim.exog_delay
-
-            sim.run_sim()
-            sim.process_results()
-            self.delay[n] = sim.total_delay
-            self.charging_delay[n] = sim.total_delay - self.exog_delay[n]
-            self.pct_trips_delayed[n] = sim.pct_trips_delayed
-            self.n_unplanned_charges[n] = sim.unplanned_chgs
-            self.n_dead_batteries[n] = sim.n_dead_batteries
-            self.n_missed_trips[n] = sim.n_missed_trips
+    def run_parallel(self, seeds):
+        """
+        Run replications in a pool of processes. Each process gets a
+        copy of this batch without its shared arrays, which it reads
+        from shared memory instead.
+
+        :param seeds: list of SeedSequence, one per replication
+        :return: list of results of :py:meth:`run_replication`
+        """
+        shm, layout = share_arrays(self.base_sim.get_shared_arrays())
+        try:
+            worker_batch = copy.copy(self)
+            worker_batch.base_sim = copy.copy(self.base_sim)
+            worker_batch.base_sim.set_shared_arrays(
+                {key: None for key, _, _, _ in layout})
+            with ProcessPoolExecutor(
+                    max_workers=min(self.workers, len(seeds)),
+                    initializer=_init_worker,
+                    initargs=(worker_batch, shm.name, layout)) as executor:
+                results = list(executor.map(_run_worker_replication, seeds))
+        finally:
+            shm.close()
+            shm.unlink()
+        return results
 
     def process_results(self):
         delay_mean = np.mean(self.delay)
@@ -1146,6 +1569,18 @@ class SimulationBatch:
         )
 
 
+# Batch and shared memory of this worker process, see
+# SimulationBatch.run_parallel
+_worker_batch = None
+_worker_shm = None
+
 
+def _init_worker(batch, shm_name, layout):
+    global _worker_batch, _worker_shm
+    _worker_shm, arrays = attach_arrays(shm_name, layout)
+    batch.base_sim.set_shared_arrays(arrays)
+    _worker_batch = batch
 
 
+def _run_worker_replication(seed_seq):
+    return _worker_batch.run_replication(seed_seq)
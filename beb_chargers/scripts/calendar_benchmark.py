@@ -0,0 +1,117 @@
+"""
+Micro-benchmark of the discrete-event simulation calendar.
+
+Replays the calendar workload of SimulationRun.run_sim without any of
+its trip logic: every vehicle starts with one event, and processing an
+event schedules the vehicle's next one (trip start -> trip end -> next
+trip start) until its block is finished. Reports events processed per
+second for fleets of various sizes, for the heap-based Calendar with
+float-minute and Timestamp event times, and for the sorted-list
+calendar it replaced.
+"""
+import datetime
+import logging
+import time
+from bisect import insort
+import numpy as np
+import pandas as pd
+from beb_chargers.opt.simulation import Calendar, Event
+
+logger = logging.getLogger('calendar_benchmark')
+
+
+class ListCalendar:
+    # Sorted-list calendar used before Calendar was heap-based, kept
+    # here as a baseline
+    def __init__(self):
+        self.events = list()
+
+    def __len__(self):
+        return len(self.events)
+
+    def add_event(self, event):
+        insort(self.events, event)
+
+    def remove_event(self):
+        _ = self.events.pop(0)
+
+    def get_next_event(self):
+        return self.events[0]
+
+
+def run_workload(calendar, start_times, gaps, as_datetime):
+    """
+    Process all events of a synthetic fleet.
+
+    :param calendar: empty calendar instance
+    :param start_times: array of first event time of each vehicle, in
+        minutes
+    :param gaps: array of shape (n_vehicles, n_events) giving the
+        minutes between consecutive events of each vehicle
+    :param as_datetime: True to use pandas Timestamps as event times,
+        as the simulation originally did, or False to use float minutes
+    :return: number of events processed
+    """
+    t0 = pd.Timestamp(2024, 3, 28)
+    n_events = gaps.shape[1]
+    for v, start in enumerate(start_times.tolist()):
+        ev_time = t0 + datetime.timedelta(minutes=start) if as_datetime \
+            else start
+        calendar.add_event(Event(ev_time, 'trip_start', v, 0))
+
+    gaps = gaps.tolist()
+    n_done = 0
+    while len(calendar) > 0:
+        ev = calendar.get_next_event()
+        n_done += 1
+        if ev.trip + 1 < n_events:
+            gap = gaps[ev.veh][ev.trip]
+            next_time = ev.time + datetime.timedelta(minutes=gap) \
+                if as_datetime else ev.time + gap
+            calendar.add_event(
+                Event(next_time, 'trip_end', ev.veh, ev.trip + 1))
+        calendar.remove_event()
+    return n_done
+
+
+def run_benchmark(fleet_sizes=(100, 250, 500, 1000, 2000),
+                  events_per_vehicle=40, seed=0):
+    """
+    Time each calendar implementation on fleets of the given sizes.
+
+    :param fleet_sizes: numbers of blocks (vehicles) to simulate
+    :param events_per_vehicle: events processed per vehicle, e.g. 40
+        for 20 trips with a start and end each
+    :param seed: random seed for event times
+    :return: DataFrame of events per second, indexed by fleet size
+    """
+    rng = np.random.default_rng(seed)
+    configs = {
+        'heap, float minutes': (Calendar, False),
+        'heap, Timestamp': (Calendar, True),
+        'sorted list, Timestamp': (ListCalendar, True),
+    }
+    results = list()
+    for n_blocks in fleet_sizes:
+        # Pull-outs spread over the morning, then trips and layovers of
+        # 5 to 60 minutes
+        start_times = rng.uniform(240, 600, n_blocks)
+        gaps = rng.uniform(5, 60, (n_blocks, events_per_vehicle))
+        row = {'n_blocks': n_blocks}
+        for name, (cal_cls, as_datetime) in configs.items():
+            bench_start = time.perf_counter()
+            n_events = run_workload(cal_cls(), start_times, gaps, as_datetime)
+            elapsed = time.perf_counter() - bench_start
+            row['n_events'] = n_events
+            row[name] = n_events / elapsed
+            logger.info('{} blocks, {}: {:,.0f} events/sec'.format(
+                n_blocks, name, row[name]))
+        results.append(row)
+
+    return pd.DataFrame(results).set_index('n_blocks')
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    results_df = run_benchmark()
+    print(results_df.round(0).to_string())
@@ -47,7 +47,8 @@ def run_facility_location(
         depot_coords=depot_coords,
         route_method='exclusive',
         add_depot_dh=False,
-        routes_60=route_list
+        routes_60=route_list,
+        intern_ids=True
     )
     # Set kWh per mile
     all_trips_df['kwh_per_mi'] = kwh_per_mile
@@ -58,7 +59,7 @@ def run_facility_location(
     print('Number of blocks: {}'.format(len(all_blocks)))
 
     # Add all necessary fields
-    all_trips_df.to_csv('../data/all_trip_data.csv')
+    gtfs.decode_ids(all_trips_df).to_csv('../data/all_trip_data.csv')
 
     # Load candidate charging sites given by Metro
     loc_df = pd.read_csv(site_file)
@@ -83,7 +84,8 @@ def run_facility_location(
     lo_blocks = [v for v in flm.charging_vehs if v not in flm.infeas_vehs]
     layover_trips_df = all_trips_df[all_trips_df['block_id'].isin(lo_blocks)]
     inst_map = plot_trips_and_terminals(
-        trips_df=layover_trips_df, locs_df=loc_df, shapes_df=gtfs.shapes_df)
+        trips_df=gtfs.decode_ids(layover_trips_df), locs_df=loc_df,
+        shapes_df=gtfs.shapes_df)
     inst_map.show()
 
     flm.solve(
@@ -1,5 +1,7 @@
 from beb_chargers.gtfs_beb import GTFSData
-from beb_chargers.gtfs_beb.data import get_updated_osm_data
+from beb_chargers.gtfs_beb.data import encode_id_columns, get_deadhead_data, \
+    DeadheadMatrix
+from beb_chargers.gtfs_beb.geo import SpatialIndex
 import logging
 import pandas as pd
 import numpy as np
@@ -11,59 +13,50 @@ def build_trips_df(
     gtfs, date, routes, depot_coords, routes_60, route_method='exclusive',
     add_depot_dh=True, add_trip_dh=False, add_kwh_per_mi=False,
     add_durations=False, rng=None
-    , osm_fname=None
+    , osm_fname=None, intern_ids=False
 ):
-    # Initialize GTFS
+    # Select blocks from all trips in service on this date, before
+    # looking up any trip data
     day_trips = gtfs.get_trips_from_date(date)
 
     # Determine which blocks have trips exclusively on these routes
-    gb = day_trips.groupby('block_id')
-    route_blocks = list()
-    for block_id, subdf in gb:
-        if route_method == 'exclusive':
-            include_block = all(subdf['route_short_name'].isin(routes))
+    on_routes = day_trips['route_short_name'].isin(routes).groupby(
+        day_trips['block_id'])
+    if route_method == 'exclusive':
+        include_block = on_routes.all()
 
-        elif route_method == 'inclusive':
-            include_block = any(subdf['route_short_name'].isin(routes))
+    elif route_method == 'inclusive':
+        include_block = on_routes.any()
 
-        else:
-            raise ValueError(
-                'route_method must be either "exclusive" or "inclusive"'
-            )
-
-        if include_block:
-            route_blocks.append(block_id)
+    else:
+        raise ValueError(
+            'route_method must be either "exclusive" or "inclusive"'
+        )
+    route_blocks = include_block.index[include_block]
 
-    beb_trips = day_trips[
-        day_trips['block_id'].isin(route_blocks)
-    ]
-    # Add all trip data columns (e.g. locations and distances)
-    beb_trips = gtfs.add_trip_data(beb_trips, date)
+    # Get all trip data columns (e.g. locations and distances) for
+    # trips on these blocks
+    beb_trips = gtfs.get_trips_from_date(
+        date, add_data=True, block_ids=route_blocks)
     beb_trips['duration_sched'] = (
             beb_trips['end_time'] - beb_trips['start_time']
         ).dt.total_seconds() / 60
 
     beb_trips = beb_trips.rename(columns={'route_short_name': 'route'})
-    block_types = beb_trips.groupby('block_id')['route'].unique().apply(
-        lambda x: any(rt in routes_60 for rt in x)
-    ).astype(int).rename('60_dummy')
+    block_types = beb_trips['route'].isin(routes_60).groupby(
+        beb_trips['block_id']).any().astype(int).rename('60_dummy')
     beb_trips = beb_trips.merge(
         block_types, left_on='block_id', right_index=True
     )
 
     if add_trip_dh:
-        # Add deadhead to next trip
+        # Add deadhead to next trip (this also sorts trips by block
+        # and trip index)
         beb_trips = GTFSData.add_deadhead(beb_trips)
-        block_gb = beb_trips.groupby('block_id')
-        dh_dfs = list()
-        for block_id, block_df in block_gb:
-            block_df = block_df.sort_values(by='trip_idx', ascending=True)
-
-            # Associate DH with the next trip, since we assume charging
-            # would happen before DH in charge scheduling approach.
-            block_df['dh_dist'] = block_df['dh_dist'].shift(1).fillna(0)
-            dh_dfs.append(block_df)
-        beb_trips = pd.concat(dh_dfs)
+        # Associate DH with the next trip, since we assume charging
+        # would happen before DH in charge scheduling approach.
+        beb_trips['dh_dist'] = beb_trips.groupby('block_id')[
+            'dh_dist'].shift(1).fillna(0)
 
     # Add pull-in and pull-out trip distances (note that scheduling
     # and charger location code handle these differently, and depot DH
@@ -86,6 +79,11 @@ def build_trips_df(
     # Optimization expects trips to be indexed from zero
     beb_trips['trip_idx'] -= 1
 
+    if intern_ids:
+        # Key optimization and simulation inputs by int32 codes rather
+        # than ID strings. Results are decoded with gtfs.id_index.
+        beb_trips = gtfs.encode_ids(beb_trips)
+
     return beb_trips
 
 
@@ -136,6 +134,10 @@ def build_charger_location_inputs(
     opt_kwargs['max_chargers'] = max_ch
     opt_kwargs['depot_coords'] = depot_coords
     opt_kwargs['trips_df'] = trips_df
+    if pd.api.types.is_integer_dtype(trips_df['block_id']):
+        # Trips use ID codes (see build_trips_df), so decode them in
+        # model results
+        opt_kwargs['id_index'] = gtfs.id_index
 
     return opt_kwargs
 
@@ -168,9 +170,6 @@ def build_scheduling_inputs(
     tau = dict()
     max_chg_time = dict()
 
-    # Track terminal coords to get dist to chargers
-    term_coords = list()
-
     # Set reference time (midnight on first day observed)
     t_ref = pd.to_datetime(beb_trips['start_time'].dt.date).min()
 
@@ -232,31 +231,49 @@ def build_scheduling_inputs(
         # Set the trip duration parameter based on the supplied method
         tau[dict_ix] = duration
 
-        if (rw['end_lon'], rw['end_lat']) not in term_coords:
-            term_coords.append((rw['end_lat'], rw['end_lon']))
-
     # Set charging upper bound
-    # First, get all DH distances
+    # First, get DH distances from each terminal to nearby chargers.
+    # Driving distance is never shorter than great circle distance, so
+    # chargers farther than dh_cutoff_dist in a straight line can be
+    # skipped. haversine_np uses the equatorial radius, which overstates
+    # distances by up to ~0.3% at mid latitudes, so the radius is padded
+    # to keep chargers just inside the cutoff.
+    term_codes, term_coords = pd.MultiIndex.from_arrays(
+        [beb_trips['end_lat'], beb_trips['end_lon']]).factorize()
+    term_coords = term_coords.tolist()
     charger_coords = list(
         zip(
             chargers_df['lat'].tolist(),
             chargers_df['lon'].tolist()
         )
     )
-    charger_dh = get_updated_osm_data(term_coords, charger_coords)
-    # chargers_df = chargers_df.copy().set_index('name')
+    term_ix, charger_ix, _ = SpatialIndex(charger_coords).query_radius(
+        term_coords, dh_cutoff_dist * 1.01)
+    near_chargers = dict()
+    for t, c in zip(term_ix.tolist(), charger_ix.tolist()):
+        near_chargers.setdefault(t, list()).append(charger_coords[c])
     # Use it to set charging limit
-    for ix, rw in beb_trips.iterrows():
-        for c in chargers_df.index:
-            if charger_dh[
-                (rw['end_lat'], rw['end_lon']),
-                (chargers_df.loc[c, 'lat'], chargers_df.loc[c, 'lon'])
-            ]['distance'] < dh_cutoff_dist:
-                max_chg_time[c, rw['block_id'], rw['trip_idx']] = \
-                    60 * u_max / chargers_df.loc[c, 'kw']
-
-            else:
-                max_chg_time[c, rw['block_id'], rw['trip_idx']] = 0
+    term_in_range = np.zeros(
+        (len(term_coords), len(charger_coords)), dtype=bool)
+    if near_chargers:
+        charger_dh = DeadheadMatrix.from_dh_data(get_deadhead_data(
+            [([term_coords[t]], cs) for t, cs in near_chargers.items()]))
+        term_lats, term_lons = np.array(term_coords, dtype=float).T
+        charger_dists, _ = charger_dh.gather(
+            charger_dh.get_indexer(term_lats[term_ix], term_lons[term_ix]),
+            charger_dh.get_indexer(
+                chargers_df['lat'].to_numpy(dtype=float)[charger_ix],
+                chargers_df['lon'].to_numpy(dtype=float)[charger_ix],
+                dest=True))
+        term_in_range[term_ix, charger_ix] = charger_dists < dh_cutoff_dist
+    in_range = term_in_range[term_codes].tolist()
+    max_chg = [60 * u_max / kw for kw in chargers_df['kw'].tolist()]
+    for b, t, trip_in_range in zip(
+            beb_trips['block_id'].tolist(), beb_trips['trip_idx'].tolist(),
+            in_range):
+        for c, c_max_chg, c_in_range in zip(
+                chargers_df.index, max_chg, trip_in_range):
+            max_chg_time[c, b, t] = c_max_chg if c_in_range else 0
 
     case_data = {
         'sigma': sigma,
@@ -269,11 +286,20 @@ def build_scheduling_inputs(
 
 
 def build_sim_inputs(
-    opt_df, beb_trips, depot_coords, min_soc, max_soc, battery_kwh
+    opt_df, beb_trips, depot_coords, min_soc, max_soc, battery_kwh,
+    id_index=None
 ):
     chg_plan_df = opt_df[
         ['block_id', 'trip_idx', 'charger', 'chg_time']
     ].copy()
+    if pd.api.types.is_integer_dtype(beb_trips['block_id']):
+        # Trips use ID codes, so the plan must too. Optimization
+        # results report decoded IDs (see ChargerLocationModel.to_df).
+        if id_index is None:
+            raise ValueError(
+                'id_index is required when beb_trips uses ID codes')
+        chg_plan_df = encode_id_columns(
+            chg_plan_df, id_index, cols=['block_id'])
     chg_plan_df = chg_plan_df[
         chg_plan_df['chg_time'] > 0
         ]
@@ -319,7 +345,8 @@ def build_sim_inputs(
         trip_data_df=trips_sim,
         chg_plan_df=chg_plan_df,
         vehicles_df=vehicles_df,
-        depot_df=depot_df
+        depot_df=depot_df,
+        id_index=id_index
     )
 
 
@@ -3,17 +3,15 @@ import pandas as pd
 import plotly.express as px
 import plotly.graph_objects as go
 from plotly.subplots import make_subplots
-import polyline
 import matplotlib.pyplot as plt
 import streamlit as st
 import seaborn as sns
 import logging
-import pickle
 from matplotlib.dates import HourLocator, DateFormatter
 from matplotlib import ticker
-from pathlib import Path
 import datetime
-from beb_chargers.gtfs_beb import get_gmap_directions, GTFSData, get_shape
+from beb_chargers.gtfs_beb import GTFSData, get_shape
+from beb_chargers.gtfs_beb.directions import DirectionsCache
 from dotenv import dotenv_values, find_dotenv
 
 plt.rcParams.update({
@@ -257,7 +255,8 @@ def plot_trips_and_terminals(
 
 
 def plot_one_trip(result_df: pd.DataFrame, loc_df: pd.DataFrame,
-                  gtfs: GTFSData, v: int, t: int, depot_coords: tuple):
+                  gtfs: GTFSData, v: int, t: int, depot_coords: tuple,
+                  directions: DirectionsCache = None):
     """
     Plot a single trip using plotly. Will show trip and any deadheading
     that follows.
@@ -267,6 +266,9 @@ def plot_one_trip(result_df: pd.DataFrame, loc_df: pd.DataFrame,
     :param gtfs:
     :param v:
     :param t:
+    :param depot_coords:
+    :param directions: DirectionsCache used for deadhead paths. A
+        cache at the default location is opened if not given.
     :return:
     """
 
@@ -302,7 +304,6 @@ def plot_one_trip(result_df: pd.DataFrame, loc_df: pd.DataFrame,
     fig2.update_traces(textposition='bottom center', textfont_size=18)
     st.text(trip_id)
 
-    od_directions = dict()
     # Add trip terminals
     if trip_id == 0:
         # Starts at depot
@@ -337,6 +338,25 @@ def plot_one_trip(result_df: pd.DataFrame, loc_df: pd.DataFrame,
                 block_df.at[next_tid, 'start_lon']
             )
 
+    # Get directions for all deadhead on the plot at once
+    chg_site = result_df.at[(v, t), 'chg_site']
+    dh_pairs = list()
+    if trip_id in [0, 100]:
+        dh_pairs.append((start_coords, end_coords))
+    if pd.isna(chg_site):
+        if next_start_coords and end_coords != next_start_coords:
+            dh_pairs.append((end_coords, next_start_coords))
+    else:
+        chg_coords = (loc_df.at[chg_site, 'y'], loc_df.at[chg_site, 'x'])
+        dh_pairs.append((end_coords, chg_coords))
+        if next_start_coords:
+            dh_pairs.append((chg_coords, next_start_coords))
+    if directions is None:
+        with DirectionsCache() as directions:
+            dh_paths = directions.prefetch(dh_pairs)
+    else:
+        dh_paths = directions.prefetch(dh_pairs)
+
     # Plot trip
     if trip_id not in [0, 100]:
         shp = block_df.at[trip_id, 'shape_id']
@@ -351,86 +371,49 @@ def plot_one_trip(result_df: pd.DataFrame, loc_df: pd.DataFrame,
 
     else:
         # Depot trip, need google maps directions
-        try:
-            directions = od_directions[start_coords, end_coords]
-        except KeyError:
-            directions = get_gmap_directions(
-                start_coords, end_coords)
-            od_directions[start_coords, end_coords] = directions
-
         if t == 0:
             text_label = 'Deadhead from depot to first trip start'
         else:
             text_label = 'Deadhead from last trip end to depot'
 
-        plot_line = polyline.decode(directions)
-        lat = [pt[0] for pt in plot_line]
-        lon = [pt[1] for pt in plot_line]
+        plot_line = dh_paths[start_coords, end_coords]
         new_trace = go.Scattermapbox(
-            mode='lines', lat=lat, lon=lon, showlegend=False,
-            hoverinfo='text', text=text_label, line={'color': 'green'})
+            mode='lines', lat=plot_line[:, 0], lon=plot_line[:, 1],
+            showlegend=False, hoverinfo='text', text=text_label,
+            line={'color': 'green'})
         fig1.add_trace(new_trace)
 
     # Plot deadhead
-    chg_site = result_df.at[(v, t), 'chg_site']
     if pd.isna(chg_site):
         # No charging after this trip
         # Plot deadhead to next trip
         if next_start_coords:
             if end_coords != next_start_coords:
-                try:
-                    directions = od_directions[end_coords, next_start_coords]
-                except KeyError:
-                    directions = get_gmap_directions(
-                        end_coords, next_start_coords)
-                    od_directions[end_coords, next_start_coords] = directions
-
-                plot_line = polyline.decode(directions)
-                lat = [pt[0] for pt in plot_line]
-                lon = [pt[1] for pt in plot_line]
+                plot_line = dh_paths[end_coords, next_start_coords]
                 new_trace = go.Scattermapbox(
-                    mode='lines', lat=lat, lon=lon, showlegend=False,
-                    hoverinfo='text', text='Deadhead to next trip',
-                    line={'color': 'yellow'})
+                    mode='lines', lat=plot_line[:, 0], lon=plot_line[:, 1],
+                    showlegend=False, hoverinfo='text',
+                    text='Deadhead to next trip', line={'color': 'yellow'})
                 fig2.add_trace(new_trace)
 
     else:
         # Visit a charger after this trip. Plot deadhead to and from.
         # First DH trip: terminal to charger
-        orig1 = end_coords
-        dest1 = (loc_df.at[chg_site, 'y'], loc_df.at[chg_site, 'x'])
-
-        try:
-            directions1 = od_directions[orig1, dest1]
-        except KeyError:
-            directions1 = get_gmap_directions(orig1, dest1)
-            od_directions[orig1, dest1] = directions1
-
-        plot_line = polyline.decode(directions1)
-        lat = [pt[0] for pt in plot_line]
-        lon = [pt[1] for pt in plot_line]
+        plot_line = dh_paths[end_coords, chg_coords]
         # trip_text = 'trips' if r['n_trips'] > 1 else 'trip'
         # text = '{:d} {} to {}'.format(r['n_trips'], trip_text, r['chg_site'])
         new_trace = go.Scattermapbox(
-            mode='lines', lat=lat, lon=lon, showlegend=False,
-            hoverinfo='text', line={'color': 'yellow'},
+            mode='lines', lat=plot_line[:, 0], lon=plot_line[:, 1],
+            showlegend=False, hoverinfo='text', line={'color': 'yellow'},
             text='Deadhead to charger')
         fig2.add_trace(new_trace)
 
         # Second DH trip: charger to next trip
         if next_start_coords:
-            try:
-                directions2 = od_directions[dest1, next_start_coords]
-            except KeyError:
-                directions2 = get_gmap_directions(dest1, next_start_coords)
-                od_directions[dest1, next_start_coords] = directions2
-
-            plot_line = polyline.decode(directions2)
-            lat = [pt[0] for pt in plot_line]
-            lon = [pt[1] for pt in plot_line]
+            plot_line = dh_paths[chg_coords, next_start_coords]
             new_trace = go.Scattermapbox(
-                mode='lines', lat=lat, lon=lon, showlegend=False,
-                hoverinfo='text', line={'color': 'yellow'},
+                mode='lines', lat=plot_line[:, 0], lon=plot_line[:, 1],
+                showlegend=False, hoverinfo='text', line={'color': 'yellow'},
                 text='Deadhead to next trip')
             fig2.add_trace(new_trace)
 
@@ -469,13 +452,16 @@ def plot_one_trip(result_df: pd.DataFrame, loc_df: pd.DataFrame,
 
 
 def plot_deadhead(result_df: pd.DataFrame, loc_df: pd.DataFrame,
-                  coords_df: pd.DataFrame):
+                  coords_df: pd.DataFrame,
+                  directions: DirectionsCache = None):
     """
     Plot deadhead trips to chargers on a map using plotly.
 
     :param result_df: DF of model results
     :param loc_df: DF providing charger details/locations
     :param coords_df: DF giving coordinates of bus terminals
+    :param directions: DirectionsCache used for deadhead paths. A
+        cache at the default location is opened if not given.
     :return: plot of all deadhead trips
     """
     result_df = result_df.copy()
@@ -495,17 +481,6 @@ def plot_deadhead(result_df: pd.DataFrame, loc_df: pd.DataFrame,
 
     px.set_mapbox_access_token(token)
 
-    directions_path_str = str(
-        Path(__file__).resolve().parent / 'data' / 'gmaps'
-        / 'deadhead_directions.pickle')
-
-    try:
-        with open(directions_path_str, 'rb') as handle:
-            od_directions = pickle.load(handle)
-    except FileNotFoundError:
-        # If file doesn't exist, create new dict
-        od_directions = dict()
-
     if 'trip_id' in coords_df.columns:
         coords_df.set_index('trip_id', inplace=True)
 
@@ -558,20 +533,20 @@ def plot_deadhead(result_df: pd.DataFrame, loc_df: pd.DataFrame,
 
     fig.add_trace(new_trace)
 
-    for idx, r in chg_cts.iterrows():
-        orig = chg_cts.iloc[idx][['term_y', 'term_x']].tolist()
-        dest = chg_cts.iloc[idx][['chg_y', 'chg_x']].tolist()
-
-        try:
-            directions = od_directions[orig[0], dest[0]]
-
-        except KeyError:
-            directions = get_gmap_directions(orig, dest)
-            od_directions[orig[0], dest[0]] = directions
+    # Get directions for all deadhead trips at once
+    dh_pairs = list(zip(
+        zip(chg_cts['term_y'].tolist(), chg_cts['term_x'].tolist()),
+        zip(chg_cts['chg_y'].tolist(), chg_cts['chg_x'].tolist())))
+    if directions is None:
+        with DirectionsCache() as directions:
+            dh_paths = directions.prefetch(dh_pairs)
+    else:
+        dh_paths = directions.prefetch(dh_pairs)
 
-        plot_line = polyline.decode(directions)
-        lat = [pt[0] for pt in plot_line]
-        lon = [pt[1] for pt in plot_line]
+    for (idx, r), od in zip(chg_cts.iterrows(), dh_pairs):
+        plot_line = dh_paths[od]
+        lat = plot_line[:, 0]
+        lon = plot_line[:, 1]
         trip_text = 'trips' if r['n_trips'] > 1 else 'trip'
         text = '{:d} {} to {}'.format(r['n_trips'], trip_text, r['chg_site'])
         new_trace = go.Scattermapbox(
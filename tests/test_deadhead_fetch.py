@@ -0,0 +1,145 @@
+import time
+import numpy as np
+import pytest
+from openrouteservice import exceptions as ors_exceptions
+from beb_chargers.gtfs_beb.deadhead import BatchFetcher, DeadheadStats, \
+    DeadheadStore, ORSProvider, StraightLineProvider, TokenBucket
+from beb_chargers.gtfs_beb.mock_matrix import MockMatrixServer
+
+
+def make_coords(n, seed):
+    rng = np.random.default_rng(seed)
+    lats = rng.uniform(47.4, 47.7, n).round(6)
+    lons = rng.uniform(-122.4, -122.1, n).round(6)
+    return list(zip(lats.tolist(), lons.tolist()))
+
+
+ORIGINS = make_coords(20, 0)
+DESTS = make_coords(10, 1)
+
+
+def make_fetcher(server, max_elements=50, **kwargs):
+    provider = ORSProvider(base_url=server.url)
+    provider.max_elements = max_elements
+    kwargs.setdefault('requests_per_minute', 60_000)
+    kwargs.setdefault('backoff', 0.01)
+    return BatchFetcher(provider, **kwargs)
+
+
+def check_values(dh_data, origins=ORIGINS, dests=DESTS):
+    # The mock server uses haversine distance times a circuity factor
+    expected = StraightLineProvider(
+        speed_mph=20., metric='haversine', circuity=1.3).get_dh_data(
+        origins, dests)
+    assert dh_data.keys() == expected.keys()
+    for k, v in expected.items():
+        assert dh_data[k]['distance'] == pytest.approx(v['distance'], rel=1e-3)
+        assert dh_data[k]['duration'] == pytest.approx(v['duration'], rel=1e-3)
+
+
+def test_chunking():
+    with MockMatrixServer() as server:
+        fetcher = make_fetcher(server, workers=3)
+        # 20 x 10 pairs at 50 per request is 4 requests of 5 origins
+        chunks = fetcher.split(ORIGINS, DESTS)
+        assert [len(c) for c in chunks] == [5, 5, 5, 5]
+        dh_data = fetcher.fetch(ORIGINS, DESTS)
+        assert server.n_requests == 4
+    check_values(dh_data)
+
+
+def test_too_many_destinations():
+    with MockMatrixServer() as server:
+        fetcher = make_fetcher(server, max_elements=10)
+        with pytest.raises(ValueError):
+            fetcher.split(ORIGINS, DESTS)
+
+
+def test_token_bucket():
+    bucket = TokenBucket(rate=20.)
+    start = time.monotonic()
+    for _ in range(6):
+        bucket.acquire()
+    # The first token is available right away, then one every 0.05 s
+    assert time.monotonic() - start >= 0.24
+
+
+def test_rate_limit():
+    with MockMatrixServer() as server:
+        fetcher = make_fetcher(server, workers=4, requests_per_minute=600)
+        start = time.monotonic()
+        fetcher.fetch(ORIGINS, DESTS)
+        # 4 requests at 10 per second, with no burst beyond the first
+        assert time.monotonic() - start >= 0.29
+        assert server.n_requests == 4
+
+
+@pytest.mark.parametrize('fail_status', [429, 500])
+def test_retry(fail_status):
+    stats = DeadheadStats()
+    with MockMatrixServer(
+            fail_rate=0.5, seed=0, fail_status=fail_status) as server:
+        fetcher = make_fetcher(server, workers=2, max_retries=20)
+        dh_data = fetcher.fetch(ORIGINS, DESTS, stats=stats)
+        assert server.n_failures > 0
+        assert stats.retries == server.n_failures
+        assert stats.api_calls == server.n_requests
+    check_values(dh_data)
+
+
+@pytest.mark.parametrize('fail_status', [400, 403])
+def test_no_retry_on_client_error(fail_status):
+    stats = DeadheadStats()
+    with MockMatrixServer(fail_rate=1., fail_status=fail_status) as server:
+        fetcher = make_fetcher(server, workers=1, max_elements=200)
+        with pytest.raises(ors_exceptions.ApiError):
+            fetcher.fetch(ORIGINS, DESTS, stats=stats)
+        assert server.n_requests == 1
+        assert stats.retries == 0
+
+
+def test_request_too_large_not_retried():
+    # The server rejects requests over its limit with HTTP 400
+    with MockMatrixServer(max_elements=50) as server:
+        fetcher = make_fetcher(server, max_elements=200)
+        with pytest.raises(ors_exceptions.ApiError):
+            fetcher.fetch(ORIGINS, DESTS)
+        assert server.n_requests == 1
+
+
+def test_on_chunk_persists(tmp_path):
+    with MockMatrixServer() as server, \
+            DeadheadStore(tmp_path / 'dh.sqlite') as store:
+        fetcher = make_fetcher(server, workers=3)
+        fetcher.fetch(ORIGINS, DESTS, on_chunk=store.put_many)
+        pairs = [(o, d) for o in ORIGINS for d in DESTS]
+        assert len(store) == len(pairs)
+        check_values(store.get_many(pairs))
+
+
+def test_on_chunk_keeps_chunks_before_failure(tmp_path):
+    # With seed 5, the first 3 requests succeed and the 4th fails
+    with MockMatrixServer(fail_rate=0.5, seed=5) as server, \
+            DeadheadStore(tmp_path / 'dh.sqlite') as store:
+        fetcher = make_fetcher(server, max_elements=30, workers=1,
+                               max_retries=0)
+        with pytest.raises(ors_exceptions.ApiError):
+            fetcher.fetch(ORIGINS, DESTS, on_chunk=store.put_many)
+        # Each request covers 3 origins. The chunks fetched before the
+        # failure are kept, but not the whole matrix.
+        first_pairs = [(o, d) for o in ORIGINS[:9] for d in DESTS]
+        assert len(store.get_many(first_pairs)) == len(first_pairs)
+        assert len(store) < len(ORIGINS) * len(DESTS)
+
+
+def test_fetch_many_single_pool():
+    with MockMatrixServer() as server:
+        fetcher = make_fetcher(server, workers=2)
+        requests = [(ORIGINS[:10], DESTS), (ORIGINS[10:], DESTS[:5])]
+        dh_data = fetcher.fetch_many(requests)
+        # 10 x 10 in 2 requests and 10 x 5 in 1 request
+        assert server.n_requests == 3
+    assert len(dh_data) == 100 + 50
+    check_values(
+        {k: v for k, v in dh_data.items() if k[0] in ORIGINS[:10]},
+        ORIGINS[:10], DESTS)